@@ -0,0 +1,124 @@
+import datetime
+import gzip
+import json
+import os
+import time
+import zlib
+
+
+class ResponseArchive:
+    '''
+    Append-only archive of raw OpenWeatherMap responses on local disk.
+
+    Responses are written to root/kind/ in segment files named after the time the segment was
+    opened. Every response is its own gzip member, so a segment is still a valid .gz file and any
+    single response can be read back without decompressing the rest. Each segment has a tab
+    separated .idx file next to it with one line per response:
+
+        location_id  fetched_at (unix seconds)  offset  length
+
+    A new segment is started for every run and whenever the current one reaches segment_bytes.
+    '''
+    def __init__(self, root, kind, segment_bytes=64 * 1024 * 1024, compresslevel=6):
+        self.directory = os.path.join(root, kind)
+        self.segment_bytes = segment_bytes
+        self.compresslevel = compresslevel
+        self.data_file = None
+        self.index_file = None
+        self.offset = 0
+        self.segment = 0
+        os.makedirs(self.directory, exist_ok=True)
+
+    def _open_segment(self):
+        self.close()
+        stamp = datetime.datetime.utcnow().strftime('%Y%m%dT%H%M%S')
+        name = f'{stamp}-{os.getpid()}-{self.segment:04d}'
+        self.segment += 1
+        self.data_file = open(os.path.join(self.directory, name + '.gz'), 'ab')
+        self.index_file = open(os.path.join(self.directory, name + '.idx'), 'a')
+        self.offset = self.data_file.tell()
+
+    #Append one raw response body for location_id
+    def append(self, location_id, body, fetched_at=None):
+        if self.data_file is None or self.offset >= self.segment_bytes:
+            self._open_segment()
+        if fetched_at is None:
+            fetched_at = time.time()
+
+        member = gzip.compress(body, compresslevel=self.compresslevel)
+        self.data_file.write(member)
+        # The member reaches the file before its index entry does, so a crash can leave unindexed
+        # data at the end of a segment but never an index entry pointing past it
+        self.data_file.flush()
+        self.index_file.write(f'{location_id}\t{fetched_at:.0f}\t{self.offset}\t{len(member)}\n')
+        self.index_file.flush()
+        self.offset += len(member)
+
+    def flush(self):
+        if self.data_file is not None:
+            self.data_file.flush()
+            self.index_file.flush()
+
+    def close(self):
+        if self.data_file is not None:
+            self.data_file.close()
+            self.index_file.close()
+            self.data_file = None
+            self.index_file = None
+
+
+#List the segments in root/kind, oldest first
+def list_segments(root, kind):
+    directory = os.path.join(root, kind)
+    if not os.path.isdir(directory):
+        return []
+    names = sorted(name[:-4] for name in os.listdir(directory) if name.endswith('.idx'))
+    return [os.path.join(directory, name) for name in names]
+
+
+#Read a segment's index as (location_id, fetched_at, offset, length) tuples
+def read_index(segment):
+    entries = []
+    with open(segment + '.idx') as index_file:
+        for line in index_file:
+            fields = line.split('\t')
+            # Skip a partially written last line
+            if len(fields) != 4 or not line.endswith('\n'):
+                continue
+            entries.append((int(fields[0]), int(fields[1]), int(fields[2]), int(fields[3])))
+    return entries
+
+
+def read_archive(root, kind, location_ids=None, since=None, until=None):
+    '''
+    Yield (location_id, fetched_at, payload) for every archived response, oldest segment first.
+    location_ids restricts the locations returned, since/until are datetimes (UTC) bounding fetch time.
+    Entries that are truncated or don't decode, e.g. from a crash mid-write, are reported and skipped.
+    '''
+    since_ts = since.replace(tzinfo=datetime.timezone.utc).timestamp() if since else None
+    until_ts = until.replace(tzinfo=datetime.timezone.utc).timestamp() if until else None
+    if location_ids is not None:
+        location_ids = set(location_ids)
+
+    for segment in list_segments(root, kind):
+        entries = [
+            entry for entry in read_index(segment)
+            if (location_ids is None or entry[0] in location_ids)
+            and (since_ts is None or entry[1] >= since_ts)
+            and (until_ts is None or entry[1] < until_ts)
+        ]
+        if not entries:
+            continue
+
+        with open(segment + '.gz', 'rb') as data_file:
+            for location_id, fetched_at, offset, length in entries:
+                data_file.seek(offset)
+                member = data_file.read(length)
+                try:
+                    if len(member) < length:
+                        raise EOFError('segment ends before the entry does')
+                    payload = json.loads(gzip.decompress(member))
+                except (EOFError, OSError, zlib.error, ValueError) as error:
+                    print(f'Skipping archived response for {location_id} at offset {offset} of {segment}.gz: {error}')
+                    continue
+                yield location_id, fetched_at, payload
@@ -0,0 +1,331 @@
+import argparse
+import asyncio
+import contextlib
+import datetime
+import importlib
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+
+import psycopg2
+
+import fetchforecast
+import fetchhistorical
+from db import configure_pool, get_connection
+from extract import ForecastBatch, extract_forecast_data
+from mockserver import MockWeatherServer
+from partitions import ensure_partitions_for_range
+from ratelimiter import RateScheduler
+
+#Runs against the database in the DB_* environment variables. It inserts locations and writes
+#forecasts, so point it at a scratch database, never the real one.
+db_conn_params = {
+    "dbname": os.getenv('DB_NAME'),
+    "user": os.getenv('DB_USER'),
+    "password": os.getenv('DB_PASSWORD'),
+    "host": os.getenv('DB_HOST')
+}
+
+default_sizes = [1000, 4000, 16000, 65341]
+
+
+#Peak resident set size of this process so far, in MB (ru_maxrss is KB on Linux)
+def peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+@contextlib.contextmanager
+def timed(module, name, totals, key):
+    '''
+    Replace module.name with a wrapper that adds each call's duration to totals[key].
+    Works for plain and async functions, the original is restored on exit.
+    '''
+    original = getattr(module, name)
+    totals.setdefault(key, 0.0)
+
+    if asyncio.iscoroutinefunction(original):
+        async def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return await original(*args, **kwargs)
+            finally:
+                totals[key] += time.perf_counter() - started
+    else:
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return original(*args, **kwargs)
+            finally:
+                totals[key] += time.perf_counter() - started
+
+    setattr(module, name, wrapper)
+    try:
+        yield
+    finally:
+        setattr(module, name, original)
+
+
+@contextlib.contextmanager
+def counted(module, name, totals, key):
+    '''
+    Replace module.name with a wrapper that adds the length of each result to totals[key], for
+    counting the rows write_forecasts reports as inserted or changed. The original is restored on exit.
+    '''
+    original = getattr(module, name)
+    totals.setdefault(key, 0)
+
+    def wrapper(*args, **kwargs):
+        result = original(*args, **kwargs)
+        if result is not None:
+            totals[key] += len(result)
+        return result
+
+    setattr(module, name, wrapper)
+    try:
+        yield
+    finally:
+        setattr(module, name, original)
+
+
+#Delete the forecasts of the benchmark locations so the next stage writes new rows rather than
+#finding them unchanged from an earlier stage or run
+def clear_forecasts(locations):
+    location_ids = [location[0] for location in locations]
+    with get_connection(db_conn_params) as conn:
+        with conn.cursor() as cursor:
+            cursor.execute("""
+                DELETE FROM Rain USING Forecast f
+                WHERE Rain.ForecastID = f.ForecastID AND f.LocationID = ANY(%(ids)s);
+                DELETE FROM Snow USING Forecast f
+                WHERE Snow.ForecastID = f.ForecastID AND f.LocationID = ANY(%(ids)s);
+                DELETE FROM Forecast WHERE LocationID = ANY(%(ids)s);
+                DELETE FROM ForecastRollup WHERE LocationID = ANY(%(ids)s);
+            """, {'ids': location_ids})
+        conn.commit()
+
+
+#Make sure the Location table has at least size points, adding finer world grids as needed
+def ensure_locations(size):
+    populate = importlib.import_module('populate-locations')
+    with get_connection(db_conn_params) as conn:
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT COUNT(*) FROM Location;")
+            count = cursor.fetchone()[0]
+        conn.rollback()
+    if count >= size:
+        return
+
+    step = 1.0
+    while len(populate.create_location_points(-90, 90, -180, 180, step)) < size:
+        step /= 2
+    populate.bulk_insert_locations(db_conn_params, populate.create_location_points(-90, 90, -180, 180, step))
+
+
+def first_locations(size):
+    with get_connection(db_conn_params) as conn:
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT LocationID, Latitude, Longitude FROM Location ORDER BY LocationID LIMIT %s;", (size,))
+            locations = cursor.fetchall()
+        conn.rollback()
+    return locations
+
+
+#Extraction alone on generated payloads, no network or database
+def bench_extract(server, locations):
+    start = (int(time.time()) // 10800 + 1) * 10800
+    payloads = [[server.entry(lat, lon, start + i * 10800, pop=True) for i in range(40)]
+                for location_id, lat, lon in locations]
+
+    batch = ForecastBatch()
+    started = time.perf_counter()
+    for (location_id, lat, lon), entries in zip(locations, payloads):
+        extract_forecast_data(batch, location_id, entries)
+    elapsed = time.perf_counter() - started
+    return batch, {'seconds': elapsed, 'rows': len(batch), 'rows_per_second': len(batch) / elapsed}
+
+
+#One upsert of an already extracted batch with the given loader into cleared rows.
+#rows is what was sent, rows_changed what the merge reported as inserted or changed.
+def bench_upsert(batch, loader, locations):
+    clear_forecasts(locations)
+    started = time.perf_counter()
+    written = fetchforecast.write_forecasts(db_conn_params, batch, loader)
+    elapsed = time.perf_counter() - started
+    if written is None:
+        raise RuntimeError(f'{loader} upsert failed, see the error above.')
+    return {'seconds': elapsed, 'rows': len(batch), 'rows_changed': len(written), 'rows_per_second': len(batch) / elapsed}
+
+
+#fetchforecast.main_streaming end to end against the mock server
+async def bench_forecast(server, base_url, locations, args):
+    fetchforecast.forecast_url = f'{base_url}/data/2.5/forecast'
+    scheduler = RateScheduler(args.requests_per_minute, args.max_in_flight)
+    stages = {}
+    clear_forecasts(locations)
+    requests_before = server.requests
+
+    started = time.perf_counter()
+    # A wrapped extractor can't be sent to worker processes, extraction is only timed in process here
+    extract_timer = contextlib.nullcontext() if args.decode_workers else \
+        timed(fetchforecast, 'extract_forecast_data', stages, 'extract_seconds')
+    with extract_timer, counted(fetchforecast, 'write_forecasts', stages, 'rows_changed'), \
+            timed(fetchforecast, 'write_forecasts', stages, 'write_seconds'):
+        rows = await fetchforecast.main_streaming('benchmark', locations, db_conn_params,
+                                                  write_batch_size=args.write_batch_size, scheduler=scheduler,
+                                                  loader=args.loader, decode_workers=args.decode_workers)
+    elapsed = time.perf_counter() - started
+    requests = server.requests - requests_before
+    return dict(stages, seconds=elapsed, requests=requests, requests_per_second=requests / elapsed,
+                rows=rows, rows_per_second=rows / elapsed)
+
+
+#fetchhistorical.main end to end against the mock server, args.history_weeks windows per location
+async def bench_history(server, base_url, locations, args):
+    fetchhistorical.history_url = f'{base_url}/data/2.5/history/city'
+    scheduler = RateScheduler(args.requests_per_minute, args.max_in_flight)
+    # Start every location's backfill just behind now so each run writes the same windows
+    watermark = datetime.datetime.utcnow().replace(minute=0, second=0, microsecond=0)
+    clear_forecasts(locations)
+    locations = [(location_id, lat, lon, watermark) for location_id, lat, lon in locations]
+    stages = {}
+    requests_before = server.requests
+
+    started = time.perf_counter()
+    with counted(fetchforecast, 'write_forecasts', stages, 'rows_changed'), \
+            timed(fetchforecast, 'write_forecasts', stages, 'write_seconds'):
+        rows = await fetchhistorical.main('benchmark', locations, batch_size=args.write_batch_size,
+                                          scheduler=scheduler, loader=args.loader, weeks=args.history_weeks,
+                                          decode_workers=args.decode_workers)
+    elapsed = time.perf_counter() - started
+    requests = server.requests - requests_before
+    return dict(stages, seconds=elapsed, requests=requests, requests_per_second=requests / elapsed,
+                rows=rows, rows_per_second=rows / elapsed)
+
+
+#Run every stage for one grid size in this process and return the results
+async def run_size(size, args):
+    ensure_locations(size)
+    locations = first_locations(size)
+    now = datetime.datetime.utcnow()
+    ensure_partitions_for_range(db_conn_params, now - datetime.timedelta(weeks=args.history_weeks + 1),
+                                now + datetime.timedelta(days=6))
+
+    server = MockWeatherServer(args.latency, args.jitter, args.error_rate, args.rate_limit_rate,
+                               args.unavailable_rate)
+    base_url = await server.start()
+    results = {'size': len(locations)}
+    try:
+        batch, results['extract'] = bench_extract(server, locations)
+        results['upsert_copy'] = bench_upsert(batch, 'copy', locations)
+        if args.values_loader:
+            results['upsert_values'] = bench_upsert(batch, 'values', locations)
+        del batch
+        results['forecast'] = await bench_forecast(server, base_url, locations, args)
+        if args.history_weeks:
+            results['history'] = await bench_history(server, base_url, locations, args)
+    finally:
+        await server.stop()
+    results['status_counts'] = {str(status): count for status, count in server.counts.items()}
+    results['peak_rss_mb'] = peak_rss_mb()
+    return results
+
+
+#Run one size in a fresh interpreter so peak RSS belongs to that size alone
+def run_size_subprocess(size, argv):
+    output = subprocess.run([sys.executable, os.path.abspath(__file__), '--single', str(size)] + argv,
+                            stdout=subprocess.PIPE, check=True, text=True).stdout
+    # The result is the last line, anything before it is progress output
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def print_report(all_results):
+    print(f"{'size':>7} {'stage':<14} {'seconds':>9} {'req/s':>9} {'rows/s':>11} {'changed':>9} {'write s':>9} {'peak MB':>8}")
+    for results in all_results:
+        for stage in ('extract', 'upsert_copy', 'upsert_values', 'forecast', 'history'):
+            if stage not in results:
+                continue
+            stats = results[stage]
+            requests_per_second = f"{stats['requests_per_second']:.0f}" if 'requests_per_second' in stats else '-'
+            write_seconds = f"{stats['write_seconds']:.2f}" if 'write_seconds' in stats else '-'
+            rows_changed = stats.get('rows_changed', '-')
+            print(f"{results['size']:>7} {stage:<14} {stats['seconds']:>9.2f} {requests_per_second:>9} "
+                  f"{stats['rows_per_second']:>11.0f} {rows_changed:>9} {write_seconds:>9} {results['peak_rss_mb']:>8.0f}")
+
+
+#Compare rows/s against a previous --json result, returns the stages slower by more than tolerance
+def find_regressions(all_results, baseline, tolerance):
+    previous = {results['size']: results for results in baseline}
+    regressions = []
+    for results in all_results:
+        before = previous.get(results['size'])
+        if before is None:
+            continue
+        for stage, stats in results.items():
+            if not isinstance(stats, dict) or 'rows_per_second' not in stats or stage not in before:
+                continue
+            old = before[stage]['rows_per_second']
+            if old and stats['rows_per_second'] < old * (1 - tolerance):
+                regressions.append((results['size'], stage, old, stats['rows_per_second']))
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Benchmark fetching, extraction and upserts against a local mock OpenWeatherMap server. '
+                    'Writes to the DB_* database, use a scratch database.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=default_sizes, help='Grid sizes (locations) to run.')
+    parser.add_argument('--single', type=int, help=argparse.SUPPRESS)
+    parser.add_argument('--latency', type=float, default=0.05, help='Mock server latency per response in seconds.')
+    parser.add_argument('--jitter', type=float, default=0.02, help='Extra random latency in seconds.')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Fraction of responses that are 500s.')
+    parser.add_argument('--rate-limit-rate', type=float, default=0.0, help='Fraction of responses that are 429s.')
+    parser.add_argument('--unavailable-rate', type=float, default=0.0, help='Fraction of history locations with 404.')
+    parser.add_argument('--requests-per-minute', type=int, default=600000, help='Client request budget per minute.')
+    parser.add_argument('--max-in-flight', type=int, default=500, help='Client concurrent request limit.')
+    parser.add_argument('--write-batch-size', type=int, default=10000, help='Rows per database write.')
+    parser.add_argument('--loader', choices=['copy', 'values'], default='copy', help='Loader for the end to end stages.')
+    parser.add_argument('--values-loader', action='store_true', help='Also time the execute_values loader.')
+    parser.add_argument('--decode-workers', type=int, default=0,
+                        help='Worker processes for decoding and extraction in the end to end stages.')
+    parser.add_argument('--history-weeks', type=int, default=1, help='History windows per location, 0 skips history.')
+    parser.add_argument('--json', metavar='FILE', help='Write the results to FILE for later comparison.')
+    parser.add_argument('--baseline', metavar='FILE', help='Results from an earlier --json run to compare against.')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='Report a regression when rows/s drops by more than this fraction of the baseline.')
+    args = parser.parse_args()
+
+    if args.single is not None:
+        configure_pool()
+        results = asyncio.get_event_loop().run_until_complete(run_size(args.single, args))
+        print(json.dumps(results))
+        sys.exit(0)
+
+    # Every option except the sizes is passed through to the per size runs
+    passthrough = []
+    for name in ('latency', 'jitter', 'error_rate', 'rate_limit_rate', 'unavailable_rate', 'requests_per_minute',
+                 'max_in_flight', 'write_batch_size', 'loader', 'decode_workers', 'history_weeks'):
+        passthrough += ['--' + name.replace('_', '-'), str(getattr(args, name))]
+    if args.values_loader:
+        passthrough.append('--values-loader')
+
+    try:
+        all_results = [run_size_subprocess(size, passthrough) for size in args.sizes]
+    except (subprocess.CalledProcessError, psycopg2.DatabaseError) as error:
+        print(f'Error: {error}')
+        sys.exit(1)
+
+    print_report(all_results)
+    if args.json:
+        with open(args.json, 'w') as json_file:
+            json.dump(all_results, json_file, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            regressions = find_regressions(all_results, json.load(baseline_file), args.tolerance)
+        for size, stage, old, new in regressions:
+            print(f'Regression at {size} locations in {stage}: {old:.0f} -> {new:.0f} rows/s')
+        if regressions:
+            sys.exit(1)
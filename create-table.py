@@ -1,6 +1,10 @@
-import psycopg2
+import argparse
+import datetime
 import os
 
+from db import get_connection
+from partitions import ensure_partitions, month_start, next_month
+
 db_conn_params = {
     "dbname": os.getenv('DB_NAME'),
     "user": os.getenv('DB_USER'),
@@ -8,14 +12,15 @@ db_conn_params = {
     "host": os.getenv('DB_HOST')
 }
 
-# Connect to the database
-conn = psycopg2.connect(**db_conn_params)
-
-# Create a cursor object to execute SQL statements
-cursor = conn.cursor()
-
 # SQL statements
 sql_statements = '''
+DROP TABLE IF EXISTS Observation CASCADE;
+DROP TABLE IF EXISTS ForecastIssue CASCADE;
+DROP TABLE IF EXISTS ForecastAnomaly CASCADE;
+DROP TABLE IF EXISTS ForecastStats CASCADE;
+DROP TABLE IF EXISTS ForecastRollup CASCADE;
+DROP TABLE IF EXISTS LocationRefresh CASCADE;
+DROP TABLE IF EXISTS BackfillWatermark CASCADE;
 DROP TABLE IF EXISTS Rain CASCADE;
 DROP TABLE IF EXISTS Snow CASCADE;
 DROP TABLE IF EXISTS Forecast CASCADE;
@@ -34,35 +39,108 @@ create table Location (
     Longitude float
 );
 
-create table Forecast (
-    ForecastID serial primary key,
+{forecast_table}
+
+create table Rain (
+    RainID serial primary key,
+    ForecastID int {forecast_reference}unique,
+    Volume3h float
+);
+
+create table Snow (
+    SnowID serial primary key,
+    ForecastID int {forecast_reference}unique,
+    Volume3h float
+);
+
+create table BackfillWatermark (
+    LocationID int primary key references Location(LocationID),
+    OldestTimestamp timestamp not null,
+    UpdatedAt timestamp default now()
+);
+
+create table LocationRefresh (
+    LocationID int primary key references Location(LocationID),
+    RefreshedAt timestamp not null
+);
+
+create table ForecastRollup (
     LocationID int references Location(LocationID),
+    Day date,
+    SampleCount int,
+    Temperature float,
+    Humidity float,
+    WindSpeed float,
+    Pressure float,
+    Cloudiness float,
+    Visibility float,
+    PrecipitationChance float,
+    TemperatureMin float,
+    TemperatureMax float,
+    UpdatedAt timestamp default now(),
+    primary key (LocationID, Day)
+);
+
+create index forecastrollup_day on ForecastRollup (Day);
+create index forecastrollup_updatedat on ForecastRollup (UpdatedAt);
+
+create table ForecastStats (
+    LocationID int references Location(LocationID),
+    Variable varchar(30),
+    Month smallint,
+    Hour smallint,
+    SampleCount bigint,
+    Mean float,
+    M2 float,
+    MinValue float,
+    MaxValue float,
+    UpdatedAt timestamp default now(),
+    primary key (LocationID, Variable, Month, Hour)
+);
+
+create table ForecastAnomaly (
+    LocationID int references Location(LocationID),
+    TimestampISO timestamp,
+    Variable varchar(30),
+    Value float,
+    Mean float,
+    StdDev float,
+    ZScore float,
+    FlaggedAt timestamp default now(),
+    primary key (LocationID, TimestampISO, Variable)
+);
+
+create index forecastanomaly_timestamp on ForecastAnomaly (TimestampISO);
+
+create table ForecastIssue (
+    LocationID int references Location(LocationID),
+    IssuedAt timestamp,
+    FirstTimestamp timestamp,
+    LastTimestamp timestamp,
+    Data bytea,
+    primary key (LocationID, IssuedAt)
+);
+
+create index forecastissue_lasttimestamp on ForecastIssue using brin (LastTimestamp);
+
+create table Observation (
+    LocationID int references Location(LocationID),
+    TimestampISO timestamp,
     Temperature float,
     Pressure int,
-    SeaLevelPressure int,
-    GroundLevelPressure int,
     Humidity int,
-    WeatherConditionID int references WeatherConditionTypes(WeatherConditionID),
+    WeatherConditionID int,
     Cloudiness int,
     WindSpeed float,
     WindDirection int,
     Visibility int,
     PrecipitationChance float,
-    TimestampISO timestamp,
-    constraint unique_location_timestamp unique (LocationID, TimestampISO)
+    Rain float,
+    Snow float,
+    primary key (LocationID, TimestampISO)
 );
 
-create table Rain (
-    RainID serial primary key,
-    ForecastID int references Forecast(ForecastID),
-    Volume3h float
-);
-
-create table Snow (
-    SnowID serial primary key,
-    ForecastID int references Forecast(ForecastID),
-    Volume3h float
-);
+create index observation_timestamp on Observation (TimestampISO);
 
 ALTER TABLE location
 ADD COLUMN data_available BOOLEAN DEFAULT TRUE;
@@ -72,11 +150,74 @@ ADD CONSTRAINT unique_lat_long UNIQUE (Latitude, Longitude);
 
 
 '''
+forecast_columns = '''
+    LocationID int references Location(LocationID),
+    Temperature float,
+    Pressure int,
+    SeaLevelPressure int,
+    GroundLevelPressure int,
+    Humidity int,
+    WeatherConditionID int references WeatherConditionTypes(WeatherConditionID),
+    Cloudiness int,
+    WindSpeed float,
+    WindDirection int,
+    Visibility int,
+    PrecipitationChance float,'''
+
+# Single heap table
+forecast_table = f'''create table Forecast (
+    ForecastID serial primary key,{forecast_columns}
+    TimestampISO timestamp,
+    constraint unique_location_timestamp unique (LocationID, TimestampISO)
+);
+
+create index forecast_timestamp on Forecast (TimestampISO);'''
+
+# Monthly range partitions on TimestampISO. Unique constraints have to include the partition key,
+# and BRIN keeps time range scans cheap inside each partition.
+partitioned_forecast_table = f'''create table Forecast (
+    ForecastID serial,{forecast_columns}
+    TimestampISO timestamp not null,
+    primary key (ForecastID, TimestampISO),
+    constraint unique_location_timestamp unique (LocationID, TimestampISO)
+) partition by range (TimestampISO);
+
+create index forecast_timestamp_brin on Forecast using brin (TimestampISO);'''
+
+parser = argparse.ArgumentParser(description='Drop and recreate every table.')
+parser.add_argument('--partitioned', action='store_true',
+                    help='Create Forecast as monthly range partitions on TimestampISO.')
+parser.add_argument('--history-months', type=int, default=13,
+                    help='With --partitioned, create partitions this many months back for historical data.')
+parser.add_argument('--future-months', type=int, default=2,
+                    help='With --partitioned, create partitions this many months past the current one.')
+args = parser.parse_args()
+
+if args.partitioned:
+    # Rain and Snow can't reference ForecastID alone on a partitioned table, retention cleans them up instead
+    sql_statements = sql_statements.format(forecast_table=partitioned_forecast_table, forecast_reference='')
+else:
+    sql_statements = sql_statements.format(forecast_table=forecast_table,
+                                           forecast_reference='references Forecast(ForecastID) ')
+
+# Connect to the database
+with get_connection(db_conn_params) as conn:
+    # Create a cursor object to execute SQL statements
+    cursor = conn.cursor()
+
+    # Execute the SQL statements
+    cursor.execute(sql_statements)
 
-# Execute the SQL statements
-cursor.execute(sql_statements)
+    if args.partitioned:
+        start = month_start(datetime.datetime.utcnow())
+        for _ in range(args.history_months):
+            start = month_start(start - datetime.timedelta(days=1))
+        end = month_start(datetime.datetime.utcnow())
+        for _ in range(args.future_months + 1):
+            end = next_month(end)
+        ensure_partitions(cursor, start, end)
 
-# Commit the changes and close the connection
-conn.commit()
+    # Commit the changes and close the cursor
+    conn.commit()
+    cursor.close()
 print('Tables successfully created.')
-conn.close()
@@ -3,8 +3,13 @@ from dash import dcc
 from dash import html
 from dash.dependencies import Input, Output
 import plotly.express as px
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, text
+import datetime
+import math
 import os
+import threading
+import time
+from functools import lru_cache
 import pandas as pd
 
 db_conn_params = {
@@ -17,88 +22,258 @@ db_conn_params = {
 #Mapbox access token
 px.set_mapbox_access_token(os.environ.get('MAPBOX_API_KEY'))
 
-#Create SQLAlchemy engine
+#Create SQLAlchemy engine, nothing connects until the first selection is queried
 engine = create_engine(f"postgresql://{db_conn_params['user']}:{db_conn_params['password']}@{db_conn_params['host']}/{db_conn_params['dbname']}")
 
-# Get latitude, longitude, and forecast data with locationid
-query ="""
-    SELECT DATE(f.timestampiso) AS date,
-    AVG(f.temperature) AS avg_temperature,
-    AVG(f.humidity) AS avg_humidity,
-    AVG(f.windspeed) AS avg_wind_speed,
-    AVG(f.pressure) AS avg_pressure,
-    AVG(f.cloudiness) AS avg_cloudiness,
-    AVG(f.visibility) AS avg_visibility,
-    AVG(f.precipitationchance) AS avg_precipitation_chance,
-    l.latitude, l.longitude
-    FROM location l
-    JOIN forecast f ON l.locationid = f.locationid
-    WHERE EXTRACT(HOUR FROM f.timestampiso) = 12 and DATE(f.timestampiso) >= '2024-01-16'
-    GROUP BY date, l.latitude, l.longitude
-    limit 1000000;
+#Variables that can be mapped: label, Forecast and ForecastRollup column and color scale
+map_variables = {
+    'temperature': ('Temperature', 'temperature', px.colors.cyclical.IceFire),
+    'humidity': ('Humidity', 'humidity', px.colors.sequential.Blues),
+    'wind_speed': ('Wind speed', 'windspeed', px.colors.sequential.Viridis),
+    'pressure': ('Pressure', 'pressure', px.colors.sequential.Plasma),
+    'cloudiness': ('Cloudiness', 'cloudiness', px.colors.sequential.gray_r),
+    'visibility': ('Visibility', 'visibility', px.colors.sequential.Cividis),
+    'precipitation_chance': ('Precipitation chance', 'precipitationchance', px.colors.sequential.Blues),
+}
+
+#Hours that can be mapped, the provider forecasts in 3 hour steps. DAILY maps the day's mean from the rollup.
+map_hours = list(range(0, 24, 3))
+DAILY = -1
+DEFAULT_HOUR = 12
+DEFAULT_VARIABLE = 'temperature'
+#Days shown when the page opens, starting today
+DEFAULT_DAYS = 5
+
+#Number of query results kept in memory, the least recently used selection is dropped first
+QUERY_CACHE_SIZE = int(os.environ.get('DASHBOARD_QUERY_CACHE', 32))
+#Seconds a query result is reused before it is read again, forecasts change as new ones arrive
+QUERY_CACHE_SECONDS = int(os.environ.get('DASHBOARD_QUERY_TTL', 600))
+#Number of rendered figures kept in memory, the least recently viewed view is dropped first
+FIGURE_CACHE_SIZE = int(os.environ.get('DASHBOARD_FIGURE_CACHE', 64))
+
+#Spacing of the Location grid in degrees, points are never merged below this
+GRID_STEP = float(os.environ.get('DASHBOARD_GRID_STEP', 1.0))
+#Approximate on-screen size of one aggregated marker in pixels
+LOD_CELL_PIXELS = int(os.environ.get('DASHBOARD_LOD_PIXELS', 10))
+#Viewport edges are snapped outwards to this many degrees so small pans reuse cached figures
+VIEW_SNAP = 10
+DEFAULT_ZOOM = 3
+
+# One forecast time of one variable, answered from the forecast_timestamp index.
+# The column name comes from map_variables, never from the request.
+hour_query = """
+    SELECT l.latitude, l.longitude, f.{column} AS value
+    FROM forecast f
+    JOIN location l ON l.locationid = f.locationid
+    WHERE f.timestampiso = :timestamp AND f.{column} IS NOT NULL;
 """
-# Read query results into pandas dataframe
-df = pd.read_sql(query,engine)
-
-#Convert dates to string for slider
-df['date_str'] = df['date'].astype(str)
-# Create date slider options
-date_options = [{'label': d, 'value': d} for d in df['date_str'].unique()]
-
-# Create plotly scatter mapbox figure
-fig = px.scatter_mapbox(df, lat="latitude", lon="longitude", color="avg_temperature", 
-                        color_continuous_scale=px.colors.cyclical.IceFire, size_max=15, zoom=3, hover_data=["date","avg_temperature","avg_humidity","avg_wind_speed","avg_pressure"])
-
-# Set Mapbox access token
-fig.update_layout(
-    mapbox=dict(
-        accesstoken=os.environ.get('MAPBOX_API_KEY'),
-        style="streets",
-        # Set map bounds to the world bounds to prevent zooming out past world bounds
-        bounds = {"west": -180, "east": 180, "south": -90, "north": 90},
+
+# Daily mean of one variable, answered from the forecastrollup_day index
+daily_query = """
+    SELECT l.latitude, l.longitude, r.{column} AS value
+    FROM forecastrollup r
+    JOIN location l ON l.locationid = r.locationid
+    WHERE r.day = :day AND r.{column} IS NOT NULL;
+"""
+
+#Changes every QUERY_CACHE_SECONDS, part of every cache key so old results age out of the caches
+def cache_epoch():
+    return int(time.time() // QUERY_CACHE_SECONDS)
+
+#Rows for one selection, read from the database only when it isn't cached
+@lru_cache(maxsize=QUERY_CACHE_SIZE)
+def frame_for_selection(selected_date, hour, variable, epoch=None):
+    column = map_variables[variable][1]
+    day = datetime.date.fromisoformat(selected_date)
+    if hour == DAILY:
+        return pd.read_sql(text(daily_query.format(column=column)), engine, params={'day': day})
+    timestamp = datetime.datetime.combine(day, datetime.time(hour))
+    return pd.read_sql(text(hour_query.format(column=column)), engine, params={'timestamp': timestamp})
+
+#Dates between start and end inclusive as ISO strings, the slider steps through these
+def dates_in_range(start_date, end_date):
+    start = datetime.date.fromisoformat(start_date[:10])
+    end = datetime.date.fromisoformat(end_date[:10])
+    return [(start + datetime.timedelta(days=i)).isoformat() for i in range((end - start).days + 1)]
+
+#Size in degrees of the bins used at a zoom level, None when the full grid can be shown
+def cell_degrees(level):
+    # Web mercator tiles are 256 pixels and cover 360 degrees at zoom 0
+    degrees = 360 / (256 * 2 ** level) * LOD_CELL_PIXELS
+    if degrees <= GRID_STEP:
+        return None
+    # Round up to a power of two multiple of the grid step so bins line up across levels
+    cell = GRID_STEP
+    while cell < degrees:
+        cell *= 2
+    return cell
+
+#Average the points of one selection into bins sized for a zoom level
+@lru_cache(maxsize=FIGURE_CACHE_SIZE)
+def frame_for_level(selected_date, hour, variable, level, epoch=None):
+    frame = frame_for_selection(selected_date, hour, variable, epoch)
+    cell = cell_degrees(level)
+    if cell is None or frame.empty:
+        return frame
+
+    lat_bin = (frame['latitude'] // cell).rename('lat_bin')
+    lon_bin = (frame['longitude'] // cell).rename('lon_bin')
+    return frame.groupby([lat_bin, lon_bin]).mean(numeric_only=True).reset_index(drop=True)
+
+#Keep only rows inside bounds (west, east, south, north), which may cross the antimeridian
+def in_view(frame, bounds):
+    if bounds is None:
+        return frame
+    west, east, south, north = bounds
+    lat_ok = frame['latitude'].between(south, north)
+    if west <= east:
+        lon_ok = frame['longitude'].between(west, east)
+    else:
+        lon_ok = (frame['longitude'] >= west) | (frame['longitude'] <= east)
+    return frame[lat_ok & lon_ok]
+
+#Read zoom level and snapped viewport bounds from the map's relayoutData, None when it has no view
+def view_from_relayout(relayout_data):
+    if not relayout_data or 'mapbox.zoom' not in relayout_data:
+        return None
+    level = max(0, int(relayout_data['mapbox.zoom']))
+
+    corners = relayout_data.get('mapbox._derived', {}).get('coordinates')
+    if not corners:
+        return level, None
+
+    lons = [corner[0] for corner in corners]
+    lats = [corner[1] for corner in corners]
+    if max(lons) - min(lons) >= 360:
+        return level, None
+
+    snap = lambda value, up: (math.ceil if up else math.floor)(value / VIEW_SNAP) * VIEW_SNAP
+    wrap = lambda lon: (lon + 180) % 360 - 180
+    west, east = wrap(snap(min(lons), False)), wrap(snap(max(lons), True))
+    south, north = max(snap(min(lats), False), -90), min(snap(max(lats), True), 90)
+    if east == west:
+        return level, None
+    return level, (west, east, south, north)
+
+#Render the map for one selection, zoom level and viewport, cached so revisiting a view costs nothing
+@lru_cache(maxsize=FIGURE_CACHE_SIZE)
+def figure_for_view(selected_date, hour=DEFAULT_HOUR, variable=DEFAULT_VARIABLE, level=DEFAULT_ZOOM, bounds=None,
+                    epoch=None):
+    filtered_df = in_view(frame_for_level(selected_date, hour, variable, level, epoch), bounds)
+    label, column, color_scale = map_variables[variable]
+    when = 'daily mean' if hour == DAILY else f'at {hour:02d}:00 UTC'
+
+    # Create plotly scatter mapbox figure
+    fig = px.scatter_mapbox(filtered_df, lat="latitude", lon="longitude", color="value",
+                            color_continuous_scale=color_scale, size_max=15, zoom=DEFAULT_ZOOM,
+                            labels={'value': label}, title=f'{label} on {selected_date}, {when}')
+
+    # Set Mapbox access token
+    fig.update_layout(
+        mapbox=dict(
+            accesstoken=os.environ.get('MAPBOX_API_KEY'),
+            style="streets",
+            # Set map bounds to the world bounds to prevent zooming out past world bounds
+            bounds = {"west": -180, "east": 180, "south": -90, "north": 90},
+        )
     )
-)
-fig.update_layout(uirevision=True)
+    # Keep the user's zoom and position when the figure is swapped
+    fig.update_layout(uirevision=True)
+
+    return {'data': fig.data, 'layout': fig.layout}
+
+#Default range, computed per page load so it follows the current date
+def default_range():
+    today = datetime.datetime.utcnow().date()
+    return today.isoformat(), (today + datetime.timedelta(days=DEFAULT_DAYS - 1)).isoformat()
+
+#Render the default selection's days in the background so the first slider moves are warm
+def prewarm_figures():
+    start_date, end_date = default_range()
+    for selected_date in dates_in_range(start_date, end_date):
+        try:
+            # Same positional arguments as update_map so the figure cache key matches
+            figure_for_view(selected_date, DEFAULT_HOUR, DEFAULT_VARIABLE, DEFAULT_ZOOM, None, cache_epoch())
+        except Exception as error:
+            print(f'Error: {error}')
+            return
+
 # Create dash app
 app = dash.Dash(__name__)
 
 
-# Create app layout
-app.layout = html.Div([
-    html.H1("Weather Dashboard"),
-    dcc.Graph(
-        id="scatter-map", 
-        figure=fig,
-        # Autosize height
-        style={'height': '80vh'}
-    ),
-    # Create date slider
-    dcc.Slider(
-        id='date-slider',
-        min=0,
-        max=len(date_options)-1,
-        value=0,
-        marks={i: date_options[i]['label'] for i in range(len(date_options))},
-    ),
-])
-
-# Create callback to update map figure when date slider changes
+# Create app layout, a function so nothing is queried at import and the default dates stay current
+def serve_layout():
+    start_date, end_date = default_range()
+    return html.Div([
+        html.H1("Weather Dashboard"),
+        html.Div([
+            # Create time range, hour and variable selectors
+            dcc.DatePickerRange(id='date-range', start_date=start_date, end_date=end_date),
+            dcc.Dropdown(
+                id='hour',
+                options=[{'label': f'{hour:02d}:00 UTC', 'value': hour} for hour in map_hours] +
+                        [{'label': 'Daily mean', 'value': DAILY}],
+                value=DEFAULT_HOUR,
+                clearable=False,
+                style={'width': '150px'},
+            ),
+            dcc.Dropdown(
+                id='variable',
+                options=[{'label': label, 'value': name} for name, (label, column, color_scale) in map_variables.items()],
+                value=DEFAULT_VARIABLE,
+                clearable=False,
+                style={'width': '250px'},
+            ),
+        ], style={'display': 'flex', 'gap': '10px'}),
+        dcc.Graph(
+            id="scatter-map",
+            # Autosize height
+            style={'height': '80vh'}
+        ),
+        # Create date slider, its dates follow the selected range
+        dcc.Slider(id='date-slider', min=0, max=0, step=1, value=0),
+    ])
+
+app.layout = serve_layout
+
+# Create callback to step the slider through the selected range
+@app.callback(
+    [Output('date-slider', 'max'), Output('date-slider', 'marks'), Output('date-slider', 'value')],
+    [Input('date-range', 'start_date'), Input('date-range', 'end_date')]
+)
+def update_slider(start_date, end_date):
+    if not start_date or not end_date:
+        return 0, {}, 0
+    dates = dates_in_range(start_date, end_date)
+    return max(len(dates) - 1, 0), {i: date for i, date in enumerate(dates)}, 0
+
+# Create callback to update map figure when the selection changes or the map is zoomed or panned
 @app.callback(
     Output('scatter-map', 'figure'),
-    [Input('date-slider', 'value')]
+    [Input('date-slider', 'value'), Input('date-range', 'start_date'), Input('date-range', 'end_date'),
+     Input('hour', 'value'), Input('variable', 'value'), Input('scatter-map', 'relayoutData')]
 )
-def update_map(selected_date_index):
+def update_map(selected_date_index, start_date, end_date, hour, variable, relayout_data):
+    view = view_from_relayout(relayout_data)
+    # Relayout events that don't move the map (resize, drag mode) don't need a new figure
+    if view is None and dash.callback_context.triggered_id == 'scatter-map':
+        return dash.no_update
+    level, bounds = view or (DEFAULT_ZOOM, None)
+
+    dates = dates_in_range(start_date, end_date) if start_date and end_date else []
+    if not dates or variable not in map_variables or (hour not in map_hours and hour != DAILY):
+        return {}
+
     # Get selected date from slider
-    selected_date = date_options[selected_date_index]['value']
-    # Filter dataframe to only include selected date
-    filtered_df = df[df['date_str'] == selected_date]
-    
-    # Create plotly scatter mapbox figure
-    fig = px.scatter_mapbox(filtered_df, lat="latitude", lon="longitude", color="avg_temperature", 
-                            color_continuous_scale=px.colors.cyclical.IceFire, size_max=15, zoom=3, hover_data=["date","avg_temperature","avg_humidity","avg_wind_speed","avg_pressure"])
-    
+    selected_date = dates[min(selected_date_index or 0, len(dates) - 1)]
+
     # Update the figure attribute of the dcc.Graph component
-    return {'data': fig.data, 'layout': fig.layout}
+    return figure_for_view(selected_date, hour, variable, level, bounds, cache_epoch())
+
+if os.environ.get('DASHBOARD_PREWARM', '1') == '1':
+    threading.Thread(target=prewarm_figures, daemon=True).start()
+
 # Run app
 if __name__ == "__main__":
     app.run_server(debug=True)
@@ -0,0 +1,95 @@
+import asyncio
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+from psycopg2.pool import ThreadedConnectionPool
+
+#Pool size, overridable with DB_POOL_MIN/DB_POOL_MAX or configure_pool() before the first connection
+pool_config = {
+    "minconn": int(os.getenv('DB_POOL_MIN', 1)),
+    "maxconn": int(os.getenv('DB_POOL_MAX', 8)),
+}
+
+pools = {}
+pool_lock = threading.Lock()
+executor = None
+
+
+def configure_pool(minconn=None, maxconn=None):
+    '''
+    Set the pool size. Only affects pools created after the call.
+    '''
+    if minconn is not None:
+        pool_config['minconn'] = minconn
+    if maxconn is not None:
+        pool_config['maxconn'] = maxconn
+
+
+class BlockingPool:
+    '''
+    ThreadedConnectionPool raises when it runs out of connections, this waits for one instead.
+    '''
+    def __init__(self, db_conn_params, minconn, maxconn):
+        self.pool = ThreadedConnectionPool(minconn, maxconn, **db_conn_params)
+        self.available = threading.BoundedSemaphore(maxconn)
+
+    def getconn(self):
+        self.available.acquire()
+        try:
+            return self.pool.getconn()
+        except Exception:
+            self.available.release()
+            raise
+
+    def putconn(self, conn):
+        # The pool rolls back anything left open and drops broken connections
+        try:
+            self.pool.putconn(conn, close=conn.closed != 0)
+        finally:
+            self.available.release()
+
+    def closeall(self):
+        self.pool.closeall()
+
+
+#Return the shared pool for db_conn_params, creating it on first use
+def get_pool(db_conn_params):
+    key = tuple(sorted(db_conn_params.items()))
+    with pool_lock:
+        if key not in pools:
+            pools[key] = BlockingPool(db_conn_params, pool_config['minconn'], pool_config['maxconn'])
+        return pools[key]
+
+
+@contextmanager
+def get_connection(db_conn_params):
+    '''
+    Borrow a pooled connection. Commit inside the block, anything left uncommitted is rolled back on return.
+    '''
+    pool = get_pool(db_conn_params)
+    conn = pool.getconn()
+    try:
+        yield conn
+    finally:
+        pool.putconn(conn)
+
+
+#Run a blocking database function on the DB thread pool so the event loop keeps running
+async def run_db(func, *args):
+    global executor
+    with pool_lock:
+        if executor is None:
+            # One thread per pooled connection so threads never queue on the pool itself
+            executor = ThreadPoolExecutor(max_workers=pool_config['maxconn'], thread_name_prefix='db')
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(executor, func, *args)
+
+
+#Close every pooled connection, for the end of a script
+def close_pools():
+    with pool_lock:
+        for pool in pools.values():
+            pool.closeall()
+        pools.clear()
@@ -0,0 +1,209 @@
+import argparse
+import datetime
+import json
+import os
+
+import psycopg2
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.fs
+import pyarrow.ipc
+import pyarrow.parquet as pq
+
+from db import get_connection
+
+db_conn_params = {
+    "dbname": os.getenv('DB_NAME'),
+    "user": os.getenv('DB_USER'),
+    "password": os.getenv('DB_PASSWORD'),
+    "host": os.getenv('DB_HOST')
+}
+
+#Seconds of changes the next incremental export looks at again, at least as long as a forecast write transaction
+export_overlap_seconds = int(os.getenv('EXPORT_OVERLAP_SECONDS', 900))
+
+#Columns written to every exported file, in query order
+forecast_schema = pa.schema([
+    ('ForecastID', pa.int32()),
+    ('LocationID', pa.int32()),
+    ('Latitude', pa.float64()),
+    ('Longitude', pa.float64()),
+    ('TimestampISO', pa.timestamp('s')),
+    ('Temperature', pa.float64()),
+    ('Pressure', pa.int32()),
+    ('SeaLevelPressure', pa.int32()),
+    ('GroundLevelPressure', pa.int32()),
+    ('Humidity', pa.int32()),
+    ('WeatherConditionID', pa.int32()),
+    ('WeatherMain', pa.string()),
+    ('WeatherDescription', pa.string()),
+    ('Cloudiness', pa.int32()),
+    ('WindSpeed', pa.float64()),
+    ('WindDirection', pa.int32()),
+    ('Visibility', pa.int32()),
+    ('PrecipitationChance', pa.float64()),
+    ('Rain', pa.float64()),
+    ('Snow', pa.float64()),
+])
+
+#Exported days are hive partitions, date=YYYY-MM-DD
+date_partitioning = ds.partitioning(pa.schema([('date', pa.date32())]), flavor='hive')
+
+export_query = """
+    SELECT f.ForecastID, f.LocationID, l.Latitude, l.Longitude, f.TimestampISO,
+           f.Temperature, f.Pressure, f.SeaLevelPressure, f.GroundLevelPressure, f.Humidity,
+           f.WeatherConditionID, w.Main, w.Description,
+           f.Cloudiness, f.WindSpeed, f.WindDirection, f.Visibility, f.PrecipitationChance,
+           COALESCE(r.Volume3h, 0), COALESCE(s.Volume3h, 0)
+    FROM Forecast f
+    JOIN Location l ON l.LocationID = f.LocationID
+    LEFT JOIN WeatherConditionTypes w ON w.WeatherConditionID = f.WeatherConditionID
+    LEFT JOIN Rain r ON r.ForecastID = f.ForecastID
+    LEFT JOIN Snow s ON s.ForecastID = f.ForecastID
+    WHERE f.TimestampISO >= %s AND f.TimestampISO < %s
+"""
+
+file_extensions = {'parquet': 'parquet', 'arrow': 'arrow'}
+
+
+def state_path(out_dir):
+    return os.path.join(out_dir, '_export_state.json')
+
+
+#Time of the last incremental export, None if there hasn't been one
+def read_state(out_dir):
+    try:
+        with open(state_path(out_dir)) as state_file:
+            return datetime.datetime.fromisoformat(json.load(state_file)['exported_at'])
+    except FileNotFoundError:
+        return None
+
+
+def write_state(out_dir, exported_at):
+    with open(state_path(out_dir), 'w') as state_file:
+        json.dump({'exported_at': exported_at.isoformat()}, state_file)
+
+
+#Days whose rollup rows changed after since, i.e. days with new or updated forecasts
+def changed_days(cursor, since):
+    if since is None:
+        cursor.execute("SELECT DISTINCT Day FROM ForecastRollup ORDER BY Day;")
+    else:
+        cursor.execute("SELECT DISTINCT Day FROM ForecastRollup WHERE UpdatedAt > %s ORDER BY Day;", (since,))
+    return [row[0] for row in cursor.fetchall()]
+
+
+#Write one day of Forecast to out_dir/date=YYYY-MM-DD, replacing whatever was exported for it before
+def export_day(conn, out_dir, day, file_format='parquet', chunk_size=100000):
+    directory = os.path.join(out_dir, f'date={day:%Y-%m-%d}')
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f'part-0.{file_extensions[file_format]}')
+    temp_path = path + '.tmp'
+
+    if file_format == 'parquet':
+        writer = pq.ParquetWriter(temp_path, forecast_schema, compression='zstd')
+    else:
+        # Uncompressed Arrow IPC files can be memory mapped and read without copying
+        writer = pa.ipc.new_file(temp_path, forecast_schema)
+
+    rows_written = 0
+    # A named cursor streams rows from the server instead of loading the whole day at once
+    with conn.cursor(name=f'export_{day:%Y%m%d}') as cursor:
+        cursor.itersize = chunk_size
+        cursor.execute(export_query, (day, day + datetime.timedelta(days=1)))
+        while True:
+            rows = cursor.fetchmany(chunk_size)
+            if not rows:
+                break
+            columns = list(zip(*rows))
+            writer.write_batch(pa.record_batch(
+                [pa.array(column, type=field.type) for column, field in zip(columns, forecast_schema)],
+                schema=forecast_schema))
+            rows_written += len(rows)
+
+    writer.close()
+    os.replace(temp_path, path)
+    return rows_written
+
+
+def export_forecasts(db_conn_params, out_dir, file_format='parquet', start=None, end=None, full=False,
+                     overlap_seconds=export_overlap_seconds):
+    '''
+    Export Forecast joined with Location and WeatherConditionTypes to one file per day under out_dir.
+
+    By default only days whose forecasts changed since the previous export are rewritten, using
+    ForecastRollup.UpdatedAt. start/end (dates) restrict the days exported, full ignores the previous export.
+    Only exports without start/end record their time for the next incremental export.
+    overlap_seconds is how far before this export the next incremental one looks again for changes.
+    '''
+    os.makedirs(out_dir, exist_ok=True)
+    since = None if full else read_state(out_dir)
+
+    with get_connection(db_conn_params) as conn:
+        try:
+            with conn.cursor() as cursor:
+                # UpdatedAt is stamped with a writer's transaction start, which can be earlier than this export's
+                # even though the writer commits later. Resume from before the oldest transaction still open, and
+                # at least overlap_seconds back for sessions pg_stat_activity doesn't show. Days seen twice are
+                # simply exported again.
+                cursor.execute("""
+                    SELECT LEAST(now() - make_interval(secs => %s),
+                                 (SELECT min(xact_start) FROM pg_stat_activity
+                                  WHERE datname = current_database() AND pid <> pg_backend_pid()))::timestamp;
+                """, (overlap_seconds,))
+                exported_at = cursor.fetchone()[0]
+                days = changed_days(cursor, since)
+
+            days = [day for day in days if (start is None or day >= start) and (end is None or day <= end)]
+            total = 0
+            for day in days:
+                rows = export_day(conn, out_dir, day, file_format)
+                total += rows
+                print(f'Exported {rows} rows for {day}.')
+
+            conn.commit()
+            # A ranged export leaves days outside the range unexported, moving the state forward would skip them
+            if start is None and end is None:
+                write_state(out_dir, exported_at)
+            return total
+        except (Exception, psycopg2.DatabaseError) as error:
+            print(f'Error: {error}')
+            conn.rollback()
+            return None
+
+
+def load_forecasts(out_dir, columns=None, filter=None, start=None, end=None, file_format='parquet'):
+    '''
+    Read exported forecasts as a pyarrow Table without touching the database.
+
+    Files are memory mapped, only the requested columns are read, and start/end (dates) prune whole
+    days before any file is opened. filter is an optional pyarrow.dataset expression that is pushed
+    down to row groups, e.g. ds.field('Temperature') > 90. Call .to_pandas() on the result for a DataFrame.
+    '''
+    dataset = ds.dataset(out_dir, format='parquet' if file_format == 'parquet' else 'ipc',
+                         partitioning=date_partitioning,
+                         filesystem=pyarrow.fs.LocalFileSystem(use_mmap=True),
+                         exclude_invalid_files=True)
+
+    expression = filter
+    if start is not None:
+        expression = ds.field('date') >= start if expression is None else expression & (ds.field('date') >= start)
+    if end is not None:
+        expression = ds.field('date') <= end if expression is None else expression & (ds.field('date') <= end)
+
+    return dataset.to_table(columns=columns, filter=expression)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Export Forecast data to per-day Parquet or Arrow files.')
+    parser.add_argument('--out', required=True, help='Directory to write the date=YYYY-MM-DD folders to.')
+    parser.add_argument('--format', choices=['parquet', 'arrow'], default='parquet',
+                        help='parquet is compressed, arrow is uncompressed IPC for zero-copy memory mapping.')
+    parser.add_argument('--start', type=datetime.date.fromisoformat, help='First day to export.')
+    parser.add_argument('--end', type=datetime.date.fromisoformat, help='Last day to export.')
+    parser.add_argument('--full', action='store_true', help='Export every day, not just days changed since the last export.')
+    args = parser.parse_args()
+
+    total = export_forecasts(db_conn_params, args.out, args.format, args.start, args.end, args.full)
+    if total is not None:
+        print(f'{total} forecast rows exported.')
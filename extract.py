@@ -0,0 +1,221 @@
+import json
+from array import array
+
+# orjson decodes several times faster when it's installed, the standard library is the fallback
+try:
+    import orjson
+    loads = orjson.loads
+except ImportError:
+    loads = json.loads
+
+NaN = float('nan')
+
+#Column name, SQL type and array typecode for each forecast batch column, in COPY order.
+#Nullable columns are stored as doubles with NaN standing in for NULL.
+batch_columns = [
+    ('LocationID', 'int', 'q'),
+    ('Temperature', 'float', 'd'),
+    ('Pressure', 'int', 'q'),
+    ('SeaLevelPressure', 'int', 'd'),
+    ('GroundLevelPressure', 'int', 'd'),
+    ('Humidity', 'int', 'q'),
+    ('WeatherConditionID', 'int', 'q'),
+    ('Cloudiness', 'int', 'q'),
+    ('WindSpeed', 'float', 'd'),
+    ('WindDirection', 'int', 'd'),
+    ('Visibility', 'int', 'd'),
+    ('PrecipitationChance', 'float', 'd'),
+    ('Epoch', 'bigint', 'q'),
+    ('Rain', 'float', 'd'),
+    ('Snow', 'float', 'd'),
+]
+
+
+class ForecastBatch:
+    '''
+    Forecast rows stored column by column in typed arrays.
+
+    Epoch is the forecast time in unix seconds (UTC); the database turns it into TimestampISO
+    during the merge. Rows are only ever built as tuples once, when the batch is written.
+
+    checkpoints collects (location_id, timestamp) progress markers that commit together with the
+    rows, used by the historical backfill to advance its watermarks.
+    '''
+    def __init__(self):
+        self.columns = {name: array(typecode) for name, sql_type, typecode in batch_columns}
+        self.checkpoints = []
+
+    def __len__(self):
+        return len(self.columns['LocationID'])
+
+    def __getitem__(self, name):
+        return self.columns[name]
+
+    #Append every column of another batch to this one
+    def extend(self, other):
+        for name, column in self.columns.items():
+            column.extend(other.columns[name])
+        self.checkpoints.extend(other.checkpoints)
+
+    #Drop every row from length onwards, used to undo a partly extracted response
+    def truncate(self, length):
+        for column in self.columns.values():
+            del column[length:]
+
+    #Return a new batch holding rows start to end
+    def slice(self, start, end):
+        batch = ForecastBatch()
+        for name, column in self.columns.items():
+            batch.columns[name] = column[start:end]
+        return batch
+
+    #Column values as Python objects with NaN replaced by None
+    def column_values(self, name):
+        column = self.columns[name]
+        if column.typecode == 'q':
+            return column
+        return [None if value != value else value for value in column]
+
+    #Build row tuples in batch_columns order, for execute_values
+    def rows(self):
+        return list(zip(*(self.column_values(name) for name, sql_type, typecode in batch_columns)))
+
+    #Format the batch as tab separated COPY text, \N for missing values
+    def copy_text(self):
+        formatted = []
+        for name, sql_type, typecode in batch_columns:
+            column = self.columns[name]
+            if typecode == 'q':
+                formatted.append(map(str, column))
+            elif sql_type == 'int':
+                # Integer columns held as doubles so they can be NULL, COPY won't cast 1013.0 into int
+                formatted.append(['\\N' if value != value else str(int(value)) for value in column])
+            else:
+                formatted.append(['\\N' if value != value else repr(value) for value in column])
+        if not len(self):
+            return ''
+        return '\n'.join(map('\t'.join, zip(*formatted))) + '\n'
+
+
+#Return value or NaN when it is missing
+def nullable(value):
+    return NaN if value is None else value
+
+
+#Append one location's forecast entries to batch, filtering with keep(dt) when given
+def append_entries(batch, location_id, forecast_list, keep=None):
+    location_ids = batch['LocationID'].append
+    temperatures = batch['Temperature'].append
+    pressures = batch['Pressure'].append
+    sea_levels = batch['SeaLevelPressure'].append
+    grnd_levels = batch['GroundLevelPressure'].append
+    humidities = batch['Humidity'].append
+    condition_ids = batch['WeatherConditionID'].append
+    cloudiness = batch['Cloudiness'].append
+    wind_speeds = batch['WindSpeed'].append
+    wind_directions = batch['WindDirection'].append
+    visibilities = batch['Visibility'].append
+    pops = batch['PrecipitationChance'].append
+    epochs = batch['Epoch'].append
+    rains = batch['Rain'].append
+    snows = batch['Snow'].append
+
+    for entry in forecast_list:
+        dt = entry['dt']
+        if keep is not None and not keep(dt):
+            continue
+
+        main = entry['main']
+        wind = entry['wind']
+
+        # Read every field before appending so a malformed entry can't leave the columns misaligned
+        temp = main['temp']
+        pressure = int(main['pressure'])
+        sea_level = nullable(main.get('sea_level'))
+        grnd_level = nullable(main.get('grnd_level'))
+        humidity = int(main['humidity'])
+
+        weather_condition_id = entry['weather'][0]['id']
+
+        clouds = int(entry['clouds']['all'])
+        wind_speed = wind['speed']
+        wind_direction = nullable(wind.get('deg'))
+        visibility = nullable(entry.get('visibility'))
+        pop = nullable(entry.get('pop'))
+
+        rain = entry['rain']['3h'] if 'rain' in entry and '3h' in entry['rain'] else 0
+        snow = entry['snow']['3h'] if 'snow' in entry and '3h' in entry['snow'] else 0
+
+        location_ids(location_id)
+        temperatures(temp)
+        pressures(pressure)
+        sea_levels(sea_level)
+        grnd_levels(grnd_level)
+        humidities(humidity)
+        condition_ids(weather_condition_id)
+        cloudiness(clouds)
+        wind_speeds(wind_speed)
+        wind_directions(wind_direction)
+        visibilities(visibility)
+        pops(pop)
+        epochs(dt)
+        rains(rain)
+        snows(snow)
+
+    return batch
+
+
+#Extract 5 day / 3 hour forecast entries for one location into batch
+def extract_forecast_data(batch, location_id, forecast_list):
+    return append_entries(batch, location_id, forecast_list)
+
+
+#Check 3 hour interval (UTC hour of dt divisible by 3)
+def on_three_hour_mark(dt):
+    return (dt // 3600) % 3 == 0
+
+
+#Extract hourly history entries for one location into batch, keeping only the 3 hour marks the forecast uses
+def extract_historical_data(batch, location_id, forecast_list):
+    return append_entries(batch, location_id, forecast_list, keep=on_three_hour_mark)
+
+
+#Extract one decoded response into batch, returns None or why it was left out.
+#A response that fails part way through leaves no rows behind.
+def extract_response(extract, batch, location_id, data):
+    if not isinstance(data, dict) or 'list' not in data:
+        return 'no data'
+    rows_before = len(batch)
+    try:
+        extract(batch, location_id, data['list'])
+    except (KeyError, IndexError, TypeError, ValueError) as error:
+        batch.truncate(rows_before)
+        return f'malformed: {error!r}'
+    return None
+
+
+def extract_responses(extract, responses):
+    '''
+    Decode raw response bodies and extract them into one batch, for running in a worker process.
+    responses is a list of (location_id, body, checkpoint). Returns the batch and (location_id, reason, checkpoint)
+    for every response that didn't decode or extract. As in ForecastWriter.add, a skipped response's checkpoint
+    is left out along with every later checkpoint of the same location.
+    '''
+    batch = ForecastBatch()
+    failed = []
+    blocked = set()
+    for location_id, body, checkpoint in responses:
+        try:
+            data = loads(body)
+        except ValueError as error:
+            failed.append((location_id, f'undecodable: {error}', checkpoint))
+            blocked.add(location_id)
+            continue
+        reason = extract_response(extract, batch, location_id, data)
+        if reason is not None:
+            failed.append((location_id, reason, checkpoint))
+            blocked.add(location_id)
+            continue
+        if checkpoint is not None and location_id not in blocked:
+            batch.checkpoints.append(checkpoint)
+    return batch, failed
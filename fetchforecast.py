@@ -1,18 +1,33 @@
-import requests
-import json
+import argparse
+import collections
+import datetime
+import io
+import multiprocessing
 import os
+import time
 import psycopg2
 import psycopg2.extras
-import time
-from tqdm import tqdm
-from concurrent.futures import ThreadPoolExecutor
-import aiohttp
+from concurrent.futures import ProcessPoolExecutor
 import asyncio
 from tqdm.asyncio import tqdm as async_tqdm
 
+from archive import ResponseArchive, read_archive
+from db import configure_pool, get_connection, run_db
+from partitions import ensure_partitions_for_range
+from httpclient import create_session, fetch_body
+from extract import ForecastBatch, batch_columns, extract_forecast_data, extract_response, extract_responses, loads
+from forecasthistory import record_issues_hook
+from metrics import MetricsReporter, inc, observe, timer
+from ratelimiter import RateScheduler
+from rollup import refresh_rollup_hook
+from stats import flag_anomalies_hook
+
 # OpenWeatherMap API key
 api_key = os.environ.get('OPENWEATHER_API_KEY')
 
+# Forecast endpoint, can point at a local stand-in such as mockserver.py
+forecast_url = os.environ.get('OPENWEATHER_FORECAST_URL', 'https://api.openweathermap.org/data/2.5/forecast')
+
 db_conn_params = {
     "dbname": os.getenv('DB_NAME'),
     "user": os.getenv('DB_USER'),
@@ -22,245 +37,532 @@ db_conn_params = {
 
 #fetch LocationID, Latitude, and Longitude from database and return as list of tuples
 def get_locations(db_conn_params):
-    conn = psycopg2.connect(**db_conn_params)
-    cursor = conn.cursor()
+    with get_connection(db_conn_params) as conn:
+        cursor = conn.cursor()
 
-    try:
-        cursor.execute('SELECT LocationID, Latitude, Longitude FROM Location;')
-        locations = cursor.fetchall()
-        return locations
-    except (Exception, psycopg2.DatabaseError) as error:
-        print(f'Error: {error}')
-    finally:
-        cursor.close()
-        conn.close()
+        try:
+            cursor.execute('SELECT LocationID, Latitude, Longitude FROM Location;')
+            locations = cursor.fetchall()
+            return locations
+        except (Exception, psycopg2.DatabaseError) as error:
+            print(f'Error: {error}')
+        finally:
+            cursor.close()
 
 
 #fetch forecast data from OpenWeatherMap API
 
-async def get_forecast_data(session, location, api_key):
+async def get_forecast_data(session, location, api_key, scheduler, archive=None, decode=True):
     location_id, latitude, longitude = location
-    url = f"https://api.openweathermap.org/data/2.5/forecast?lat={latitude}&lon={longitude}&appid={api_key}&units=imperial"
-    
-    max_retries = 3
-    retry_delay = 3
-
-    for attempt in range(max_retries):
-        try:
-            async with session.get(url) as response:
-                if response.status == 200:
-                    return await response.json()
-                else:
-                    print(f"Error fetching forecast data for {location_id}: {response.status}")
-                    return None
-        except:
-            if attempt < max_retries - 1:
-                print(f"Server disconnected for Location{location_id}, retrying in {retry_delay} seconds.")
-                await asyncio.sleep(retry_delay)
-            else:
-                print(f"Server disconnected, max retries exceeded.")
-                return None
-
-async def main(api_key, locations):
-    async with aiohttp.ClientSession() as session:
-        forecast_data_list = []
-        batch_size = 3000
-        batches = [locations[i:i + batch_size] for i in range(0, len(locations), batch_size)]
+    url = f"{forecast_url}?lat={latitude}&lon={longitude}&appid={api_key}&units=imperial"
+
+    status, body = await fetch_body(session, url, scheduler, 'forecast', f'Location{location_id}')
+    if status is None:
+        return None
+    if status != 200:
+        print(f"Error fetching forecast data for {location_id}: {status}")
+        inc('weather_locations_failed_total', endpoint='forecast', reason=str(status))
+        return None
+
+    # Keep the raw response so it can be replayed without spending quota
+    if archive is not None:
+        archive.append(location_id, body)
+    # Without decode the raw body is returned for a worker process to parse
+    if not decode:
+        return body
+    try:
+        with timer('weather_json_decode_seconds', endpoint='forecast'):
+            return loads(body)
+    except ValueError as error:
+        print(f"Error decoding forecast data for {location_id}: {error}")
+        inc('weather_locations_failed_total', endpoint='forecast', reason='undecodable')
+        return None
+
+#fetch forecast data for one location and return it with the location's index in the input list
+async def fetch_location(session, index, location, api_key, scheduler, archive=None, decode=True):
+    data = await get_forecast_data(session, location, api_key, scheduler, archive, decode)
+    return index, data
+
+async def main(api_key, locations, handle_response=None, scheduler=None, archive=None, decode=True):
+    # Spread requests evenly over the quota instead of bursting 3000 at the top of each minute
+    if scheduler is None:
+        scheduler = RateScheduler()
+
+    async with create_session(max_connections=scheduler.max_in_flight) as session:
+        # Results are stored by index so they line up with locations regardless of completion order
+        forecast_data_list = [None] * len(locations)
 
         # Manual tqdm progress bar for total number of locations
         pbar = async_tqdm(total=len(locations), desc='Fetching forecast data', unit='location')
 
-        for batch in batches:
-            start_time = time.time() # Start timer for batch
-
-            # Create tasks for each location in batch
-            tasks = [asyncio.ensure_future(get_forecast_data(session, location, api_key)) for location in batch]
-            
-            # Wait for all tasks in batch to complete
-            for task in asyncio.as_completed(tasks):
-                data = await task
-                forecast_data_list.append(data)
-                pbar.update(1) # Update progress bar
+        async def fetch(item):
+            index, location = item
+            return await fetch_location(session, index, location, api_key, scheduler, archive, decode)
 
-            # Calculate time elapsed for batch
-            elapsed_time = time.time() - start_time
-
-            # Calculate time to sleep to avoid rate limit, ensure not negative
-            sleep_time = max(60 - elapsed_time, 0)
-
-            if sleep_time > 0:
-                print(f"Sleeping for {sleep_time} seconds to avoid rate limit.")
-                await asyncio.sleep(sleep_time)
+        async for index, data in scheduler.map_unordered(fetch, enumerate(locations)):
+            # Streaming mode hands each response off as soon as it arrives instead of keeping it
+            if handle_response is not None:
+                await handle_response(locations[index], data)
+            else:
+                forecast_data_list[index] = data
+            pbar.update(1) # Update progress bar
         
         pbar.close()
 
+        if handle_response is not None:
+            return None
         return forecast_data_list
 
 
-#process forecast data from json response into list of tuples for bulk upsert
-def extract_forecast_data(forecast_list):
-    extracted_data = []
-    for entry in forecast_list:
-        temp = entry['main']['temp']
-        pressure = entry['main']['pressure']
-        sea_level = entry['main'].get('sea_level')
-        grnd_level = entry['main'].get('grnd_level')
-        humidity = entry['main']['humidity']
-        
-        weather_condition_id = entry['weather'][0]['id']
-        
-        cloudiness = entry['clouds']['all']
-        wind_speed = entry['wind']['speed']
-        wind_direction = entry['wind'].get('deg')
-        visibility = entry.get('visibility')
-        pop = entry.get('pop')
-        
-        rain = entry['rain']['3h'] if 'rain' in entry and '3h' in entry['rain'] else 0
-        snow = entry['snow']['3h'] if 'snow' in entry and '3h' in entry['snow'] else 0
-
-        dt_txt = entry['dt_txt']
-
-        extracted_data.append((temp, pressure, sea_level, grnd_level, humidity,
-                               weather_condition_id,
-                               cloudiness, wind_speed, wind_direction,
-                               visibility, pop, dt_txt, rain, snow))
-    return extracted_data
-
-#bulk upsert forecast data into database
-def bulk_upsert_forecasts(db_conn_params, forecast_records):
-    conn = psycopg2.connect(**db_conn_params)
-    cursor = conn.cursor()
-
-    #Remove rain and snow from forecast_records
-    forecast_records = [record[:-2] for record in forecast_records]
-
-    upsert_query = """
-    INSERT INTO Forecast (LocationID, Temperature, Pressure, SeaLevelPressure, GroundLevelPressure, Humidity,
-                          WeatherConditionID, Cloudiness, WindSpeed, WindDirection,
-                            Visibility, PrecipitationChance, TimestampISO)
-    VALUES %s
-    ON CONFLICT (LocationID, TimestampISO)
-    DO UPDATE SET
-        Temperature = EXCLUDED.Temperature,
-        Pressure = EXCLUDED.Pressure,
-        SeaLevelPressure = EXCLUDED.SeaLevelPressure,
-        GroundLevelPressure = EXCLUDED.GroundLevelPressure,
-        Humidity = EXCLUDED.Humidity,
-        WeatherConditionID = EXCLUDED.WeatherConditionID,
-        Cloudiness = EXCLUDED.Cloudiness,
-        WindSpeed = EXCLUDED.WindSpeed,
-        WindDirection = EXCLUDED.WindDirection,
-        Visibility = EXCLUDED.Visibility,
-        PrecipitationChance = EXCLUDED.PrecipitationChance;
-    """
-
+#Fetch forecasts and upsert them in bounded batches while fetching continues
+#With decode_workers > 0, responses are decoded and extracted on that many worker processes
+async def main_streaming(api_key, locations, db_conn_params, write_batch_size=10000, scheduler=None, loader='copy',
+                         archive=None, decode_workers=0, hooks=(refresh_rollup_hook,)):
+    writer = ForecastWriter(db_conn_params, batch_size=write_batch_size, loader=loader, workers=decode_workers,
+                            hooks=hooks)
+    writer.start()
     try:
-        psycopg2.extras.execute_values(cursor, upsert_query, forecast_records, template=None, page_size=100)
-        conn.commit()
-    except (Exception, psycopg2.DatabaseError) as error:
-        print(f"Error in bulk_upsert_forecasts: {error}")
-        conn.rollback()
+        await main(api_key, locations, handle_response=writer.add, scheduler=scheduler, archive=archive,
+                   decode=not decode_workers)
     finally:
-        cursor.close()
-        conn.close()
+        await writer.close()
+    return writer.rows_written
 
-#fetch forecastid from database based on locationid and timestampiso
-def get_forecast_ids(db_conn_params, forecast_records, batch_size=100):
-    conn = psycopg2.connect(**db_conn_params)
-    forecast_ids = []
 
+#Re-run extraction and upsert on archived responses without any HTTP requests
+async def replay(archive_root, db_conn_params, write_batch_size=10000, loader='copy', since=None, until=None,
+                 kind='forecast', extract=None, hooks=(refresh_rollup_hook,)):
+    writer = ForecastWriter(db_conn_params, batch_size=write_batch_size, loader=loader, extract=extract, hooks=hooks)
+    writer.start()
     try:
-        # Only include records where rain or snow is not zero
-        forecast_params = [
-            (record[0], record[-3]) for record in forecast_records 
-            if record[-2] != 0 or record[-1] != 0
-        ]
-
-        # Function to divide the forecast_params into smaller batches
-        def chunks(lst, n):
-            for i in range(0, len(lst), n):
-                yield lst[i:i + n]
-
-        # Process each batch of parameters
-        with conn.cursor() as cursor:
-            for params_chunk in chunks(forecast_params, batch_size):
-                placeholders = ','.join(cursor.mogrify('(%s,%s)', p).decode('utf-8') for p in params_chunk)
-                cursor.execute(f"""
-                    SELECT ForecastID, LocationID, TimestampISO
-                    FROM Forecast
-                    WHERE (LocationID, TimestampISO) IN ({placeholders})
-                """)
-                forecast_ids.extend([row[0] for row in cursor.fetchall()])
-
-        return forecast_ids
-    
-    except (Exception, psycopg2.DatabaseError) as error:
-        print(f'Error: {error}')
-        conn.rollback()
+        for location_id, fetched_at, payload in read_archive(archive_root, kind, since=since, until=until):
+            await writer.add((location_id,), payload)
     finally:
-        conn.close()
-
-
+        await writer.close()
+    return writer.rows_written
+
+
+#Forecast columns filled straight from a batch column of the same name
+forecast_names = ', '.join(name for name, sql_type, typecode in batch_columns
+                           if name not in ('Epoch', 'Rain', 'Snow'))
+
+#Forecast columns a refresh can change, compared before updating an existing row
+forecast_value_names = [name for name, sql_type, typecode in batch_columns
+                        if name not in ('LocationID', 'Epoch', 'Rain', 'Snow')]
+forecast_changed = '({}) IS DISTINCT FROM ({})'.format(
+    ', '.join(f'Forecast.{name}' for name in forecast_value_names),
+    ', '.join(f'EXCLUDED.{name}' for name in forecast_value_names))
+
+#Build the statement that upserts a batch of forecast records from source and writes their rain and snow.
+#Rain and Snow rows are keyed by ForecastID so reruns update them instead of adding duplicates, and a
+#volume that drops back to zero removes its row. Rows whose values haven't changed are left untouched,
+#so a refresh only creates new row versions (dead tuples, WAL) for real changes. A change to rain or snow
+#alone touches the row's ForecastRollup.UpdatedAt so incremental exports pick it up.
+#Returns the ForecastID, LocationID and TimestampISO of the rows inserted or changed.
+def merge_query(source):
+    return f"""
+    WITH batch AS (
+        -- DISTINCT ON keeps a duplicate key in the batch from failing the whole merge
+        SELECT DISTINCT ON (LocationID, Epoch) *, to_timestamp(Epoch) AT TIME ZONE 'UTC' AS TimestampISO
+        FROM {source}
+        ORDER BY LocationID, Epoch
+    ), written AS (
+        INSERT INTO Forecast ({forecast_names}, TimestampISO)
+        SELECT {forecast_names}, TimestampISO FROM batch
+        ON CONFLICT (LocationID, TimestampISO)
+        DO UPDATE SET
+            Temperature = EXCLUDED.Temperature,
+            Pressure = EXCLUDED.Pressure,
+            SeaLevelPressure = EXCLUDED.SeaLevelPressure,
+            GroundLevelPressure = EXCLUDED.GroundLevelPressure,
+            Humidity = EXCLUDED.Humidity,
+            WeatherConditionID = EXCLUDED.WeatherConditionID,
+            Cloudiness = EXCLUDED.Cloudiness,
+            WindSpeed = EXCLUDED.WindSpeed,
+            WindDirection = EXCLUDED.WindDirection,
+            Visibility = EXCLUDED.Visibility,
+            PrecipitationChance = EXCLUDED.PrecipitationChance
+        WHERE {forecast_changed}
+        RETURNING ForecastID, LocationID, TimestampISO
+    ), forecast_ids AS (
+        -- Unchanged rows aren't returned by written, their IDs come from the rows as they were before
+        SELECT ForecastID, LocationID, TimestampISO FROM written
+        UNION
+        SELECT f.ForecastID, f.LocationID, f.TimestampISO
+        FROM batch b
+        JOIN Forecast f USING (LocationID, TimestampISO)
+    ), precipitation AS (
+        SELECT i.ForecastID, b.Rain, b.Snow
+        FROM forecast_ids i
+        JOIN batch b USING (LocationID, TimestampISO)
+    ), rain_cleared AS (
+        DELETE FROM Rain USING precipitation p
+        WHERE Rain.ForecastID = p.ForecastID AND p.Rain = 0
+        RETURNING Rain.ForecastID
+    ), rain_written AS (
+        INSERT INTO Rain (ForecastID, Volume3h)
+        SELECT ForecastID, Rain FROM precipitation WHERE Rain <> 0
+        ON CONFLICT (ForecastID) DO UPDATE SET Volume3h = EXCLUDED.Volume3h
+        WHERE Rain.Volume3h IS DISTINCT FROM EXCLUDED.Volume3h
+        RETURNING ForecastID
+    ), snow_cleared AS (
+        DELETE FROM Snow USING precipitation p
+        WHERE Snow.ForecastID = p.ForecastID AND p.Snow = 0
+        RETURNING Snow.ForecastID
+    ), snow_written AS (
+        INSERT INTO Snow (ForecastID, Volume3h)
+        SELECT ForecastID, Snow FROM precipitation WHERE Snow <> 0
+        ON CONFLICT (ForecastID) DO UPDATE SET Volume3h = EXCLUDED.Volume3h
+        WHERE Snow.Volume3h IS DISTINCT FROM EXCLUDED.Volume3h
+        RETURNING ForecastID
+    ), precipitation_changed AS (
+        SELECT ForecastID FROM rain_cleared UNION SELECT ForecastID FROM rain_written
+        UNION SELECT ForecastID FROM snow_cleared UNION SELECT ForecastID FROM snow_written
+    ), rollup_touched AS (
+        -- Rain and Snow aren't in the rollup, but export.py finds changed days through its UpdatedAt
+        UPDATE ForecastRollup r SET UpdatedAt = now()
+        FROM forecast_ids i
+        JOIN precipitation_changed c USING (ForecastID)
+        WHERE r.LocationID = i.LocationID AND r.Day = i.TimestampISO::date
+    )
+    SELECT ForecastID, LocationID, TimestampISO FROM written;
+    """
 
-#insert rain and snow data into database
-def bulk_upsert_rain_snow(db_conn_params, forecast_ids, forecast_data):
+#upsert forecast, rain and snow data on an open cursor, loader is 'copy' (staging table merge) or 'values' (execute_values)
+def upsert_forecasts(cursor, batch, loader='copy'):
+    if loader == 'copy':
+        return copy_upsert_forecasts(cursor, batch)
+    return values_upsert_forecasts(cursor, batch)
+
+#bulk upsert forecast data into database in a single transaction and return the rows inserted or changed,
+#or None when the transaction failed and nothing was written.
+#Each hook(cursor, batch, written) runs in the same transaction after the upsert.
+def bulk_upsert_forecasts(db_conn_params, batch, loader='copy', hooks=()):
+    started = time.perf_counter()
+    # Getting the connection is inside the try too, a refused connection is a failed batch like any other
     try:
-        conn = psycopg2.connect(**db_conn_params)
-        cursor = conn.cursor()
-
-        # Create a list of tuples containing the forecast ID, rain volume, and snow volume for each forecast record
-        bulk_data = [(forecast_id, record[-2], record[-1]) for forecast_id, record in zip(forecast_ids, forecast_data)]
-
-        # Use executemany to execute the INSERT query for all forecast records at once
-        cursor.executemany('INSERT INTO Rain (ForecastID, Volume3h) VALUES (%s, %s);', [(forecast_id, rain) for forecast_id, rain, snow in bulk_data if rain != 0])
-        cursor.executemany('INSERT INTO Snow (ForecastID, Volume3h) VALUES (%s, %s);', [(forecast_id, snow) for forecast_id, rain, snow in bulk_data if snow != 0])
-        conn.commit()
+        with get_connection(db_conn_params) as conn:
+            cursor = conn.cursor()
+            try:
+                written = upsert_forecasts(cursor, batch, loader)
+                for hook in hooks:
+                    hook(cursor, batch, written)
+                conn.commit()
+            except (Exception, psycopg2.DatabaseError):
+                # Rolling back a dead connection raises as well, the outer handler reports whichever it was
+                conn.rollback()
+                raise
+            finally:
+                cursor.close()
     except (Exception, psycopg2.DatabaseError) as error:
-        print(f'Error: {error}')
-        conn.rollback()
-
-    finally:
-        cursor.close()
-        conn.close()
+        print(f"Error in bulk_upsert_forecasts: {error}")
+        inc('weather_db_write_errors_total', loader=loader)
+        return None
+
+    observe('weather_db_write_seconds', time.perf_counter() - started, loader=loader)
+    inc('weather_rows_written_total', len(batch))
+    inc('weather_rows_changed_total', len(written))
+    inc('weather_rows_unchanged_total', max(len(batch) - len(written), 0))
+    return written
+
+#upsert forecast data with one statement per page of records
+def values_upsert_forecasts(cursor, batch):
+    column_names = ', '.join(name for name, sql_type, typecode in batch_columns)
+    # Cast each value so NULLs get the right type inside VALUES
+    template = '(' + ', '.join(f'%s::{sql_type}' for name, sql_type, typecode in batch_columns) + ')'
+    source = f"(VALUES %s) AS v ({column_names})"
+
+    return psycopg2.extras.execute_values(cursor, merge_query(source), batch.rows(),
+                                          template=template, page_size=100, fetch=True)
+
+#upsert forecast data by streaming it through COPY into a temp table and merging with one statement
+def copy_upsert_forecasts(cursor, batch, chunk_size=50000):
+    column_names = ', '.join(name for name, sql_type, typecode in batch_columns)
+    column_defs = ', '.join(f'{name} {sql_type}' for name, sql_type, typecode in batch_columns)
+
+    # Temp tables skip WAL and disappear with the transaction
+    cursor.execute(f"""
+        DROP TABLE IF EXISTS pg_temp.forecast_staging;
+        CREATE TEMP TABLE forecast_staging ({column_defs}) ON COMMIT DROP;
+    """)
+
+    # Send the rows in chunks so the COPY text never holds the whole batch at once
+    for i in range(0, len(batch), chunk_size):
+        buffer = io.StringIO(batch.slice(i, i + chunk_size).copy_text())
+        cursor.copy_expert(f"COPY forecast_staging ({column_names}) FROM STDIN", buffer)
+
+    cursor.execute(merge_query('forecast_staging'))
+    return cursor.fetchall()
+
+
+#Hook for bulk_upsert_forecasts: record that every location in the batch was just refreshed,
+#refreshdaemon.py picks the stalest locations by it
+def record_refresh(cursor, batch, written):
+    location_ids = sorted(set(batch['LocationID']))
+    if not location_ids:
+        return
+    psycopg2.extras.execute_values(cursor, """
+        INSERT INTO LocationRefresh (LocationID, RefreshedAt)
+        VALUES %s
+        ON CONFLICT (LocationID) DO UPDATE SET RefreshedAt = EXCLUDED.RefreshedAt;
+    """, [(location_id,) for location_id in location_ids],
+        template="(%s, now() AT TIME ZONE 'UTC')", page_size=1000)
+
+
+#upsert one batch of forecast records along with their rain and snow data
+def write_forecasts(db_conn_params, batch, loader='copy', hooks=(refresh_rollup_hook,)):
+    return bulk_upsert_forecasts(db_conn_params, batch, loader, hooks)
+
+
+class ForecastWriter:
+    '''
+    Extract forecast responses as they arrive and upsert them in batches of batch_size rows.
+    Writes run on a worker thread so the event loop keeps fetching, and at most max_pending
+    batches wait for the database before add() blocks, which keeps memory bounded.
+    hooks are passed to bulk_upsert_forecasts and run inside each batch's transaction.
+    committed, if given, is awaited as committed(batch, written) on the event loop once each
+    batch's transaction has finished, with written None when it rolled back.
+
+    A response that doesn't decode or extract writes no rows, so its checkpoint and every later
+    checkpoint of the same location are dropped; progress never moves past a response that wasn't
+    written. skipped, if given, is called as skipped(location_id, checkpoint) for each such response.
+
+    With workers > 0, add() also accepts raw response bodies. They are decoded and extracted
+    in chunks of chunk_responses on a pool of worker processes, and the resulting batches are
+    merged back in the order the responses arrived.
+    '''
+    def __init__(self, db_conn_params, batch_size=10000, max_pending=2, extract=None, loader='copy',
+                 hooks=(refresh_rollup_hook,), workers=0, chunk_responses=64, committed=None, skipped=None):
+        self.db_conn_params = db_conn_params
+        self.batch_size = batch_size
+        self.loader = loader
+        self.hooks = hooks
+        self.committed = committed
+        self.skipped = skipped
+        # Locations with a skipped response, their later checkpoints are dropped
+        self.blocked = set()
+        # fetchhistorical passes its own extractor for hourly history responses
+        self.extract = extract or extract_forecast_data
+        self.queue = asyncio.Queue(maxsize=max_pending)
+        self.batch = ForecastBatch()
+        # Rows in batches that committed, and how many of those were inserted or changed
+        self.rows_written = 0
+        self.rows_changed = 0
+        self.task = None
+
+        self.workers = workers
+        self.chunk_responses = chunk_responses
+        self.decode_pool = None
+        self.raw_chunk = []
+        self.extracting = collections.deque()
+
+    def start(self):
+        if self.workers:
+            # spawn rather than fork, the DB and aiohttp threads don't survive a fork cleanly
+            self.decode_pool = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context('spawn'))
+        self.task = asyncio.ensure_future(self._run())
+
+    #Extract a single location's response into the pending batch, checkpoint commits along with it
+    async def add(self, location, forecast_data, checkpoint=None):
+        location_id = location[0]
+
+        # Raw bodies go to the worker processes in chunks
+        if self.decode_pool is not None and isinstance(forecast_data, bytes):
+            self.raw_chunk.append((location_id, forecast_data, checkpoint))
+            if len(self.raw_chunk) >= self.chunk_responses:
+                await self._submit_chunk()
+            return
+
+        rows_before = len(self.batch)
+        with timer('weather_extract_seconds'):
+            reason = extract_response(self.extract, self.batch, location_id, forecast_data)
+        # Responses without entries or with malformed ones are skipped, the rest of the batch carries on
+        if reason is not None:
+            print(f'Process forecast data failed at {location}: {reason}.')
+            self._skip(location_id, reason, checkpoint)
+            return
+        inc('weather_rows_extracted_total', len(self.batch) - rows_before)
+        if checkpoint is not None and location_id not in self.blocked:
+            self.batch.checkpoints.append(checkpoint)
+
+        if len(self.batch) >= self.batch_size:
+            await self.flush()
+
+    #Send the pending raw bodies to a worker, waiting on the oldest chunk once enough are in progress
+    async def _submit_chunk(self):
+        if self.raw_chunk:
+            chunk, self.raw_chunk = self.raw_chunk, []
+            loop = asyncio.get_running_loop()
+            future = loop.run_in_executor(self.decode_pool, extract_responses, self.extract, chunk)
+            self.extracting.append((future, time.perf_counter()))
+        while len(self.extracting) > self.workers * 2:
+            await self._merge_oldest()
+
+    #Wait for the oldest chunk in progress and add its rows to the pending batch
+    async def _merge_oldest(self):
+        future, submitted = self.extracting.popleft()
+        batch, failed = await future
+        observe('weather_extract_seconds', time.perf_counter() - submitted, mode='process')
+        inc('weather_rows_extracted_total', len(batch))
+        # The chunk already dropped checkpoints after its own failures, this drops the ones after earlier chunks'
+        batch.checkpoints = [checkpoint for checkpoint in batch.checkpoints if checkpoint[0] not in self.blocked]
+        for location_id, reason, checkpoint in failed:
+            print(f'Process forecast data failed at {location_id}: {reason}.')
+            self._skip(location_id, reason, checkpoint)
+
+        self.batch.extend(batch)
+        if len(self.batch) >= self.batch_size:
+            await self.flush()
+
+    #Count a response that wrote no rows and hold back its location's later checkpoints
+    def _skip(self, location_id, reason, checkpoint):
+        inc('weather_locations_failed_total', endpoint='extract', reason=reason.split(':')[0])
+        if checkpoint is not None:
+            self.blocked.add(location_id)
+            if self.skipped is not None:
+                self.skipped(location_id, checkpoint)
+
+    #Hand the pending batch to the writer task, waiting if too many batches are queued
+    async def flush(self):
+        if len(self.batch) or self.batch.checkpoints:
+            batch, self.batch = self.batch, ForecastBatch()
+            await self._put(batch)
+
+    #Queue an item for the writer task, raising rather than waiting forever on a task that has stopped
+    async def _put(self, item):
+        if self.task.done():
+            self.task.result()
+            raise RuntimeError('The forecast writer has stopped.')
+        await self.queue.put(item)
+
+    async def _run(self):
+        while True:
+            batch = await self.queue.get()
+            if batch is None:
+                break
+            try:
+                written = await run_db(write_forecasts, self.db_conn_params, batch, self.loader, self.hooks)
+            except Exception as error:
+                # Anything that escapes the write is a rolled back batch, the task keeps consuming
+                print(f"Error writing forecast batch: {error!r}")
+                written = None
+            # A batch that rolled back wrote nothing
+            if written is not None:
+                self.rows_written += len(batch)
+                self.rows_changed += len(written)
+            if self.committed is not None:
+                await self.committed(batch, written)
+
+    #Finish extracting every response added so far and hand the rows to the writer task
+    async def drain(self):
+        if self.decode_pool is not None:
+            await self._submit_chunk()
+            while self.extracting:
+                await self._merge_oldest()
+        await self.flush()
+
+    #Write whatever is left and wait for the writer task to finish
+    async def close(self):
+        try:
+            await self.drain()
+            await self._put(None)
+            await self.task
+        finally:
+            if self.decode_pool is not None:
+                self.decode_pool.shutdown()
+                self.decode_pool = None
 
 
 if __name__ == '__main__':
-    locations = get_locations(db_conn_params)
-    all_forecasts = []
-
+    parser = argparse.ArgumentParser(description='Fetch forecasts for every location and upsert them.')
+    parser.add_argument('--buffered', action='store_true',
+                        help='Fetch every location before writing anything (previous behaviour).')
+    parser.add_argument('--write-batch-size', type=int, default=10000,
+                        help='Rows per database write in streaming mode.')
+    parser.add_argument('--requests-per-minute', type=int, default=3000,
+                        help='API request budget per minute.')
+    parser.add_argument('--max-in-flight', type=int, default=500,
+                        help='Maximum number of requests waiting on the network at once.')
+    parser.add_argument('--loader', choices=['copy', 'values'], default='copy',
+                        help='copy streams rows into a staging table and merges them, values uses execute_values.')
+    parser.add_argument('--db-pool-size', type=int, default=None,
+                        help='Maximum pooled database connections (default DB_POOL_MAX or 8).')
+    parser.add_argument('--archive', metavar='DIR',
+                        help='Append every raw response to a compressed archive under DIR.')
+    parser.add_argument('--replay', metavar='DIR',
+                        help='Upsert archived responses from DIR instead of calling the API.')
+    parser.add_argument('--since', type=datetime.datetime.fromisoformat,
+                        help='With --replay, only responses fetched at or after this UTC time.')
+    parser.add_argument('--until', type=datetime.datetime.fromisoformat,
+                        help='With --replay, only responses fetched before this UTC time.')
+    parser.add_argument('--decode-workers', type=int, default=0,
+                        help='Decode and extract responses on this many worker processes (0 keeps it in the event loop).')
+    parser.add_argument('--flag-anomalies', action='store_true',
+                        help='Flag forecast values far from the running statistics in ForecastAnomaly.')
+    parser.add_argument('--record-issues', action='store_true',
+                        help='Also append each forecast issue to ForecastIssue for lead time error analysis.')
+    parser.add_argument('--metrics', metavar='FILE',
+                        help='Write run metrics to FILE, Prometheus text if it ends in .prom, JSON otherwise.')
+    parser.add_argument('--metrics-interval', type=float, default=30,
+                        help='Seconds between metrics writes during the run.')
+    args = parser.parse_args()
+    configure_pool(maxconn=args.db_pool_size)
+
+    # Forecasts run 5 days ahead, make sure a partitioned Forecast table has room for them
+    now = datetime.datetime.utcnow()
+    ensure_partitions_for_range(db_conn_params, now, now + datetime.timedelta(days=6))
 
     # Run the event loop
     loop = asyncio.get_event_loop()
-    forecast_data = loop.run_until_complete(main(api_key, locations))
-
+    scheduler = RateScheduler(args.requests_per_minute, args.max_in_flight)
+    archive = ResponseArchive(args.archive, 'forecast') if args.archive else None
+    reporter = MetricsReporter(args.metrics, args.metrics_interval) if args.metrics else None
+    if reporter is not None:
+        reporter.start()
 
+    hooks = (refresh_rollup_hook, flag_anomalies_hook) if args.flag_anomalies else (refresh_rollup_hook,)
 
-    # Iterate over locations and forecast data
-    for location, forecast_data in zip(locations, forecast_data):
-        location_id, latitude, longitude = location
-        
-        # Check if forecast data exists for location before processing
-        if forecast_data and 'list' in forecast_data:
-            # Process forecast data
-            processed_data = extract_forecast_data(forecast_data['list'])
-            upsert_data = [(location_id, *entry) for entry in processed_data]
-            all_forecasts.extend(upsert_data)
+    try:
+        if args.replay:
+            # Archived responses weren't issued now, so they aren't recorded as issues
+            rows_written = loop.run_until_complete(
+                replay(args.replay, db_conn_params, write_batch_size=args.write_batch_size, loader=args.loader,
+                       since=args.since, until=args.until, hooks=hooks))
+            print(f'{rows_written} forecast rows upserted from archive.')
+        elif not args.buffered:
+            hooks += (record_refresh,)
+            if args.record_issues:
+                hooks += (record_issues_hook,)
+            locations = get_locations(db_conn_params)
+            rows_written = loop.run_until_complete(
+                main_streaming(api_key, locations, db_conn_params, write_batch_size=args.write_batch_size,
+                               scheduler=scheduler, loader=args.loader, archive=archive,
+                               decode_workers=args.decode_workers, hooks=hooks))
+            print(f'{rows_written} forecast rows upserted.')
         else:
-            print(f'Process forecast data failed at {location}.')
-
-
-
-    if all_forecasts:
-        bulk_upsert_forecasts(db_conn_params, all_forecasts)
-        print(f'Forecast data successfully upserted.')
-    else:
-        print(f'Forecast data not upserted.')
-
-    #Retrieve ForecastID based on LocationID and TimestampISO and use to insert into Rain and Snow tables.
-    forecast_ids = get_forecast_ids(db_conn_params, all_forecasts)
-    bulk_upsert_rain_snow(db_conn_params, forecast_ids, all_forecasts)
-
-# # Fetch forecast data for all locations in parallel
-# with ThreadPoolExecutor() as executor:
-#     forecast_data = list(tqdm(executor.map(get_forecast_data, locations), 
-#                               total=len(locations), desc='Fetching forecast data', unit='location'))
+            hooks += (record_refresh,)
+            if args.record_issues:
+                hooks += (record_issues_hook,)
+            locations = get_locations(db_conn_params)
+            all_forecasts = ForecastBatch()
+            forecast_data = loop.run_until_complete(main(api_key, locations, scheduler=scheduler, archive=archive))
+
+            # Iterate over locations and forecast data
+            for location, forecast_data in zip(locations, forecast_data):
+                location_id, latitude, longitude = location
+
+                # Process forecast data, skipping locations without usable data
+                reason = extract_response(extract_forecast_data, all_forecasts, location_id, forecast_data)
+                if reason is not None:
+                    print(f'Process forecast data failed at {location}: {reason}.')
+
+            if len(all_forecasts) and write_forecasts(db_conn_params, all_forecasts, args.loader, hooks) is not None:
+                print(f'Forecast data successfully upserted.')
+            else:
+                print(f'Forecast data not upserted.')
+    finally:
+        # Close the archive even when the run fails so every response fetched so far is readable
+        if archive is not None:
+            archive.close()
+        if reporter is not None:
+            loop.run_until_complete(reporter.stop())
@@ -1,20 +1,29 @@
-import requests
-import json
+import argparse
 import os
 import psycopg2
 import psycopg2.extras
 import datetime
-from tqdm import tqdm
-from concurrent.futures import ThreadPoolExecutor
-import aiohttp
 import asyncio
 from tqdm.asyncio import tqdm as async_tqdm
 
-from fetchforecast import bulk_upsert_forecasts, get_forecast_ids, bulk_upsert_rain_snow
+from db import configure_pool, get_connection, run_db
+from extract import ForecastBatch, extract_historical_data, extract_response, loads
+from archive import ResponseArchive
+from fetchforecast import ForecastWriter, replay
+from forecasthistory import record_observations
+from httpclient import create_session, fetch_body
+from metrics import MetricsReporter, inc, timer
+from partitions import ensure_partitions_for_range
+from ratelimiter import RateScheduler
+from rollup import refresh_rollup_hook
+from stats import observe_stats_hook
 
 # OpenWeatherMap API key
 api_key = os.environ.get('OPENWEATHER_API_KEY')
 
+# History endpoint, can point at a local stand-in such as mockserver.py
+history_url = os.environ.get('OPENWEATHER_HISTORY_URL', 'https://history.openweathermap.org/data/2.5/history/city')
+
 db_conn_params = {
     "dbname": os.getenv('DB_NAME'),
     "user": os.getenv('DB_USER'),
@@ -22,18 +31,39 @@ db_conn_params = {
     "host": os.getenv('DB_HOST')
 }
 
-#Get oldest forecast date per location from database
+#Start a watermark for every location that doesn't have one yet, one day before its oldest forecast.
+#Each lookup is a single index probe on (LocationID, TimestampISO), so Forecast is never scanned as a whole.
+def seed_watermarks(cur):
+    cur.execute("""
+        INSERT INTO BackfillWatermark (LocationID, OldestTimestamp)
+        SELECT l.LocationID, oldest.TimestampISO - INTERVAL '1 day'
+        FROM Location l
+        CROSS JOIN LATERAL (
+            SELECT f.TimestampISO
+            FROM Forecast f
+            WHERE f.LocationID = l.LocationID
+            ORDER BY f.TimestampISO
+            LIMIT 1
+        ) oldest
+        WHERE l.data_available = TRUE
+          AND NOT EXISTS (SELECT 1 FROM BackfillWatermark w WHERE w.LocationID = l.LocationID);
+    """)
+
+
+#Get the backfill watermark per location from database
 def get_locations_time(db_conn_params):
     try:
-        with psycopg2.connect(**db_conn_params) as conn:
+        with get_connection(db_conn_params) as conn:
             with conn.cursor() as cur:
-                # Get location_id, latitude, longitude, and oldest forecast date
+                seed_watermarks(cur)
+                conn.commit()
+
+                # Get location_id, latitude, longitude, and the oldest time already backfilled
                 cur.execute("""
-                    SELECT l.locationid, l.latitude, l.longitude, MIN(f.timestampiso)
+                    SELECT l.locationid, l.latitude, l.longitude, w.oldesttimestamp
                     FROM location l
-                    JOIN forecast f ON l.locationid = f.locationid
+                    JOIN backfillwatermark w ON l.locationid = w.locationid
                     WHERE l.data_available = TRUE
-                    GROUP BY l.locationid, l.latitude, l.longitude
                     LIMIT 50000;
                 """)
                 results = cur.fetchall()
@@ -43,54 +73,140 @@ def get_locations_time(db_conn_params):
         return None
 
 
+#Move watermarks back to the windows committed in this batch, runs inside the batch's transaction
+def update_watermarks(cur, batch, written):
+    oldest = {}
+    for location_id, timestamp in batch.checkpoints:
+        if location_id not in oldest or timestamp < oldest[location_id]:
+            oldest[location_id] = timestamp
+    if not oldest:
+        return
 
-#fetch forecast data from OpenWeatherMap API
-async def get_historical_data(session, location, api_key=api_key):
-    location_id, latitude, longitude, end = location
+    psycopg2.extras.execute_values(cur, """
+        INSERT INTO BackfillWatermark (LocationID, OldestTimestamp)
+        VALUES %s
+        ON CONFLICT (LocationID) DO UPDATE SET
+            OldestTimestamp = LEAST(BackfillWatermark.OldestTimestamp, EXCLUDED.OldestTimestamp),
+            UpdatedAt = now();
+    """, list(oldest.items()), page_size=1000)
 
-    # Convert to unix timestamp and subtract 1 day from end
-    end = datetime.datetime.utcfromtimestamp(int(end.timestamp())) - datetime.timedelta(days=1)
 
-    limit = 50000//len(locations)
-    all_data = []
+#Summarise how far the backfill has got
+def backfill_progress(db_conn_params):
+    with get_connection(db_conn_params) as conn:
+        with conn.cursor() as cur:
+            cur.execute("""
+                SELECT COUNT(*) FILTER (WHERE l.data_available),
+                       COUNT(w.LocationID) FILTER (WHERE l.data_available),
+                       MIN(w.OldestTimestamp) FILTER (WHERE l.data_available),
+                       MAX(w.OldestTimestamp) FILTER (WHERE l.data_available),
+                       MAX(w.UpdatedAt)
+                FROM Location l
+                LEFT JOIN BackfillWatermark w ON l.LocationID = w.LocationID;
+            """)
+            available, tracked, oldest, newest, updated = cur.fetchone()
+            return {
+                'available_locations': available,
+                'tracked_locations': tracked,
+                'oldest_watermark': oldest,
+                'newest_watermark': newest,
+                'last_update': updated,
+            }
+
+
+#fetch one week of history for location, returns ('ok', data), ('unavailable', None) or ('error', None)
+async def get_historical_data(session, location, start, end, scheduler, api_key=api_key, archive=None,
+                              max_rate_limit_retries=10, decode=True, max_transient_retries=3):
+    location_id, latitude, longitude = location[:3]
+
+    #Convert to unix timestamp, database timestamps are UTC
+    start_ts = int(start.replace(tzinfo=datetime.timezone.utc).timestamp())
+    end_ts = int(end.replace(tzinfo=datetime.timezone.utc).timestamp())
+
+    url = f"{history_url}?lat={latitude}&lon={longitude}&type=hour&start={start_ts}&end={end_ts}&appid={api_key}&units=imperial"
+
+    status, body = await fetch_body(session, url, scheduler, 'history', f'location {location_id} window ending {end}',
+                                    max_rate_limit_retries, max_transient_retries)
+    if status is None:
+        return 'error', None
+    if status == 404 or status == 400: #No data for location or out of allowed range (1 year)
+        print(f"No data for location {location_id}. Marking as unavailable.")
+        await run_db(mark_data_available_false, db_conn_params, location_id)
+        return 'unavailable', None
+    if status != 200:
+        print(f"Error fetching history for {location_id}: {status}")
+        inc('weather_locations_failed_total', endpoint='history', reason=str(status))
+        return 'error', None
+
+    # Keep the raw response so it can be replayed without spending quota
+    if archive is not None:
+        archive.append(location_id, body)
+    # Without decode the raw body is returned for a worker process to parse
+    if not decode:
+        return 'ok', body
+    try:
+        with timer('weather_json_decode_seconds', endpoint='history'):
+            return 'ok', loads(body)
+    except ValueError as error:
+        print(f"Error decoding history for {location_id}: {error}")
+        inc('weather_locations_failed_total', endpoint='history', reason='undecodable')
+        return 'error', None
+
+
+class LocationBackfill:
+    '''
+    Week windows of one location. Windows are fetched concurrently and may finish in any order,
+    so finished windows wait here until every newer window has been written, which keeps the
+    watermark from skipping over a window that hasn't been committed yet.
+    '''
+    def __init__(self, location):
+        self.location = location
+        self.next_week = 0
+        self.finished = {}
+        # First week that failed, later weeks are still written but can't move the watermark
+        self.stop_week = None
+
+    #Window covered by week, counting back from the watermark
+    def window(self, week):
+        end = self.location[3] - datetime.timedelta(weeks=week)
+        return end - datetime.timedelta(weeks=1), end
+
+    def wanted(self, week):
+        return self.stop_week is None or week < self.stop_week
+
+    #Stop the watermark at week, e.g. when its window failed to fetch or to extract
+    def fail(self, week):
+        if self.stop_week is None or week < self.stop_week:
+            self.stop_week = week
+
+    #Week of the window starting at start
+    def week_of(self, start):
+        return round((self.location[3] - start) / datetime.timedelta(weeks=1)) - 1
+
+    #Record a finished window and return (data, checkpoint) pairs that are ready to write
+    def complete(self, week, start, status, data):
+        if status == 'ok':
+            self.finished[week] = (start, data)
+        else:
+            self.fail(week)
+
+        ready = []
+        while self.next_week in self.finished and self.wanted(self.next_week):
+            start, data = self.finished.pop(self.next_week)
+            ready.append((data, (self.location[0], start)))
+            self.next_week += 1
+
+        if self.stop_week is not None:
+            for week in sorted(w for w in self.finished if w > self.stop_week):
+                start, data = self.finished.pop(week)
+                ready.append((data, None))
+        return ready
 
-    #Loop for limit weeks as max depth is 1 week per call
-    for week in range(limit):
-               
-        #Subtract 1 week from end
-        start = end - datetime.timedelta(weeks=1)
 
-        #Convert to unix timestamp
-        start_ts = int(start.timestamp())
-        end_ts = int(end.timestamp())
-        
-        url = f"https://history.openweathermap.org/data/2.5/history/city?lat={latitude}&lon={longitude}&type=hour&start={start_ts}&end={end_ts}&appid={api_key}&units=imperial"
-    
-        async with session.get(url) as response:
-            if response.status == 200:
-                data = await response.json()
-                all_data.append(data)
-            elif response.status == 404 or response.status == 400: #No data for location or out of allowed range (1 year)g
-                print(f"No data for location {location_id}. Marking as unavailable.")
-                mark_data_available_false(db_conn_params, location_id)
-                return None
-            elif response.status == 429: #Too many requests
-                print(f"Too many requests. Day or minute limit exceeded.")
-                #Abort program
-                exit()
-            else:
-                print(f"Error fetching forecast data for {location_id}: {response.status}")
-                return None
-            
-        #Update end to start of previous week
-        end = start
-
-    return all_data
-        
 #Mark data_available as FALSE for location_id with no historical data
 def mark_data_available_false(db_conn_params, location_id):
     try:
-        with psycopg2.connect(**db_conn_params) as conn:
+        with get_connection(db_conn_params) as conn:
             with conn.cursor() as cur:
                 cur.execute("""
                     UPDATE location
@@ -102,89 +218,212 @@ def mark_data_available_false(db_conn_params, location_id):
         print(f"Error updating location availability: {error}")
         
 
-async def main(api_key, locations, batch_size=1000):
-    async with aiohttp.ClientSession() as session:
-        # Split locations into batches
-        batches = [locations[i:i + batch_size] for i in range(0, len(locations), batch_size)]
-        
-        for batch in batches:
-            tasks = []
-            for location in batch:
-                task = asyncio.ensure_future(get_historical_data(session, location, api_key))
-                tasks.append(task)
-        
-            forecast_data_list = []
-            for task in async_tqdm(asyncio.as_completed(tasks), total=len(batch), desc='Fetching historical data', unit='location'):
-                data = await task
-                if data is not None:
-                    forecast_data_list.extend(data)
-
-            all_forecasts = []
-            # Process and upsert the data for each batch
-            for location, data in zip(batch, forecast_data_list):
-                if data is not None:
-                    location_id, latitude, longitude = location[:3]
-
-                    # Process forecast data
-                    processed_data = extract_forecast_data(data['list'])
-                    upsert_data = [(location_id, *record) for record in processed_data]
-                    all_forecasts.extend(upsert_data)
-            
-            # Bulk upsert forecast data
-            if all_forecasts:
-                bulk_upsert_forecasts(db_conn_params, all_forecasts)
-
-                # Get forecast ids
-                forecast_ids = get_forecast_ids(db_conn_params, all_forecasts)
-                # Upsert rain and snow data
-                bulk_upsert_rain_snow(db_conn_params, forecast_ids, all_forecasts)
-
-    return None
+#Locations with recorded forecast issues and the (start, end) of forecast times still to observe for each.
+#Observation picks up after the latest hour already stored, so each run only fetches what's new.
+def get_observation_windows(db_conn_params, since, until):
+    with get_connection(db_conn_params) as conn:
+        cursor = conn.cursor()
+        try:
+            cursor.execute("""
+                SELECT l.LocationID, l.Latitude, l.Longitude,
+                       GREATEST(min(i.FirstTimestamp), %(since)s::timestamp,
+                                (SELECT max(o.TimestampISO) + INTERVAL '1 hour' FROM Observation o
+                                 WHERE o.LocationID = l.LocationID)),
+                       LEAST(max(i.LastTimestamp) + INTERVAL '1 hour', %(until)s::timestamp)
+                FROM ForecastIssue i
+                JOIN Location l ON l.LocationID = i.LocationID
+                WHERE i.LastTimestamp >= %(since)s AND i.FirstTimestamp < %(until)s AND l.data_available = TRUE
+                GROUP BY l.LocationID, l.Latitude, l.Longitude;
+            """, {'since': since, 'until': until})
+            return [((location_id, latitude, longitude), start, end)
+                    for location_id, latitude, longitude, start, end in cursor.fetchall() if start < end]
+        finally:
+            cursor.close()
+            conn.rollback()
 
-    
-#Extract forecast data for bulk upsert
-def extract_forecast_data(forecast_list):
-    extracted_data = []
 
-    for entry in forecast_list:
+#Upsert one batch of observations, returns False when the transaction failed
+def write_observations(db_conn_params, batch):
+    with get_connection(db_conn_params) as conn:
+        cursor = conn.cursor()
+        try:
+            record_observations(cursor, batch)
+            conn.commit()
+            return True
+        except (Exception, psycopg2.DatabaseError) as error:
+            print(f"Error in write_observations: {error}")
+            conn.rollback()
+            return False
+        finally:
+            cursor.close()
+
+
+async def observe_issues(api_key, db_conn_params, since, until, scheduler=None, batch_size=10000):
+    '''
+    Fetch observed history for the forecast times covered by ForecastIssue between since and until
+    and store it in Observation, for forecasthistory to score the issues against.
+
+    Unlike the backfill this only touches recent times that have recorded issues and never writes
+    to Forecast. Returns the number of observation rows written.
+    '''
+    if scheduler is None:
+        scheduler = RateScheduler()
+    windows = await run_db(get_observation_windows, db_conn_params, since, until)
 
-        #Convert dt to datetime oblect object in utc
-        dt_utc = datetime.datetime.utcfromtimestamp(entry['dt'])
+    # One request per week of each window, the most the history endpoint returns at once
+    def units():
+        for location, start, end in windows:
+            while start < end:
+                yield location, start, min(start + datetime.timedelta(weeks=1), end)
+                start += datetime.timedelta(weeks=1)
 
-        #Check 3 hour interval
-        if dt_utc.hour % 3 == 0:
+    rows_written = 0
+    batch = ForecastBatch()
+    async with create_session(max_connections=scheduler.max_in_flight) as session:
+        async def fetch(unit):
+            location, start, end = unit
+            status, data = await get_historical_data(session, location, start, end, scheduler, api_key)
+            return location, status, data
 
-            temp = entry['main']['temp']
-            pressure = entry['main']['pressure']
-            sea_level = entry['main'].get('sea_level')
-            grnd_level = entry['main'].get('grnd_level')
-            humidity = entry['main']['humidity']
-            
-            weather_condition_id = entry['weather'][0]['id']
-            
-            cloudiness = entry['clouds']['all']
-            wind_speed = entry['wind']['speed']
-            wind_direction = entry['wind'].get('deg')
-            visibility = entry.get('visibility')
-            pop = entry.get('pop')
-            
-            rain = entry['rain']['3h'] if 'rain' in entry and '3h' in entry['rain'] else 0
-            snow = entry['snow']['3h'] if 'snow' in entry and '3h' in entry['snow'] else 0
+        async for location, status, data in scheduler.map_unordered(fetch, units()):
+            if status != 'ok':
+                continue
+            reason = extract_response(extract_historical_data, batch, location[0], data)
+            if reason is not None:
+                print(f'Process observations failed at {location}: {reason}.')
+                inc('weather_locations_failed_total', endpoint='extract', reason=reason.split(':')[0])
+            if len(batch) >= batch_size:
+                if await run_db(write_observations, db_conn_params, batch):
+                    rows_written += len(batch)
+                batch = ForecastBatch()
+    if len(batch) and await run_db(write_observations, db_conn_params, batch):
+        rows_written += len(batch)
+    return rows_written
 
-            dt_txt = dt_utc.isoformat()
 
-            extracted_data.append((temp, pressure, sea_level, grnd_level, humidity,
-                               weather_condition_id,
-                               cloudiness, wind_speed, wind_direction, 
-                               visibility, pop, dt_txt, rain, snow))
-    return extracted_data
+async def main(api_key, locations, batch_size=10000, scheduler=None, loader='copy', archive=None, weeks=None,
+               decode_workers=0):
+    if scheduler is None:
+        scheduler = RateScheduler()
 
+    #Spread the daily call limit across all locations as max depth is 1 week per call
+    if weeks is None:
+        weeks = max(1, 50000 // max(len(locations), 1))
 
-locations = get_locations_time(db_conn_params)
-#Disabled as 65k locations added to database
-#batch_size = len(locations)
-loop = asyncio.get_event_loop()
-loop.run_until_complete(main(api_key, locations))
+    # Make sure a partitioned Forecast table covers every window this run can reach
+    if locations:
+        oldest = min(location[3] for location in locations) - datetime.timedelta(weeks=weeks)
+        await run_db(ensure_partitions_for_range, db_conn_params, oldest, datetime.datetime.utcnow())
+
+    # Responses are extracted and upserted in batches while fetching continues, each batch moves
+    # its locations' watermarks in the same transaction so a restart resumes from the last commit
+    backfills = [LocationBackfill(location) for location in locations]
+    by_location = {backfill.location[0]: backfill for backfill in backfills}
+
+    # A window that doesn't extract wrote nothing, it stops the watermark just like a failed request
+    def skipped(location_id, checkpoint):
+        backfill = by_location[location_id]
+        backfill.fail(backfill.week_of(checkpoint[1]))
+
+    writer = ForecastWriter(db_conn_params, batch_size=batch_size, extract=extract_historical_data, loader=loader,
+                            hooks=[update_watermarks, refresh_rollup_hook, observe_stats_hook], workers=decode_workers,
+                            skipped=skipped)
+    writer.start()
+
+    # Every week of every location is its own unit of work under the scheduler's budget. Going week
+    # by week across locations keeps the most recent history moving forward everywhere at once.
+    units = ((backfill, week) for week in range(weeks) for backfill in backfills)
+
+    async with create_session(max_connections=scheduler.max_in_flight) as session:
+        async def fetch(unit):
+            backfill, week = unit
+            start, end = backfill.window(week)
+            # Nothing to gain once an earlier window for this location failed
+            if not backfill.wanted(week):
+                return backfill, week, start, 'skipped', None
+            status, data = await get_historical_data(session, backfill.location, start, end, scheduler,
+                                                     api_key, archive, decode=not decode_workers)
+            return backfill, week, start, status, data
+
+        try:
+            results = scheduler.map_unordered(fetch, units)
+            async for backfill, week, start, status, data in async_tqdm(results, total=weeks * len(backfills), desc='Fetching historical data', unit='window'):
+                if status == 'skipped':
+                    continue
+                for week_data, checkpoint in backfill.complete(week, start, status, data):
+                    await writer.add(backfill.location, week_data, checkpoint=checkpoint)
+        finally:
+            await writer.close()
+
+    return writer.rows_written
+
+    
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Backfill historical weather for every available location.')
+    parser.add_argument('--requests-per-minute', type=int, default=3000,
+                        help='API request budget per minute.')
+    parser.add_argument('--max-in-flight', type=int, default=500,
+                        help='Maximum number of requests waiting on the network at once.')
+    parser.add_argument('--loader', choices=['copy', 'values'], default='copy',
+                        help='copy streams rows into a staging table and merges them, values uses execute_values.')
+    parser.add_argument('--db-pool-size', type=int, default=None,
+                        help='Maximum pooled database connections (default DB_POOL_MAX or 8).')
+    parser.add_argument('--archive', metavar='DIR',
+                        help='Append every raw response to a compressed archive under DIR.')
+    parser.add_argument('--replay', metavar='DIR',
+                        help='Upsert archived responses from DIR instead of calling the API.')
+    parser.add_argument('--observe-issues', action='store_true',
+                        help='Fetch observations for the times covered by recorded forecast issues instead of backfilling.')
+    parser.add_argument('--since', type=datetime.datetime.fromisoformat,
+                        help='With --replay, only responses fetched at or after this UTC time. '
+                             'With --observe-issues, the first forecast time to observe (default 7 days ago).')
+    parser.add_argument('--until', type=datetime.datetime.fromisoformat,
+                        help='With --replay, only responses fetched before this UTC time. '
+                             'With --observe-issues, observe forecast times before this (default now).')
+    parser.add_argument('--progress', action='store_true',
+                        help='Print backfill progress from the watermark table and exit.')
+    parser.add_argument('--decode-workers', type=int, default=0,
+                        help='Decode and extract responses on this many worker processes (0 keeps it in the event loop).')
+    parser.add_argument('--metrics', metavar='FILE',
+                        help='Write run metrics to FILE, Prometheus text if it ends in .prom, JSON otherwise.')
+    parser.add_argument('--metrics-interval', type=float, default=30,
+                        help='Seconds between metrics writes during the run.')
+    args = parser.parse_args()
+    configure_pool(maxconn=args.db_pool_size)
 
+    loop = asyncio.get_event_loop()
+    reporter = MetricsReporter(args.metrics, args.metrics_interval) if args.metrics and not args.progress else None
+    if reporter is not None:
+        reporter.start()
 
+    if args.progress:
+        for key, value in backfill_progress(db_conn_params).items():
+            print(f'{key}: {value}')
+    elif args.replay:
+        rows_written = loop.run_until_complete(
+            replay(args.replay, db_conn_params, loader=args.loader, since=args.since, until=args.until,
+                   kind='history', extract=extract_historical_data,
+                   hooks=[update_watermarks, refresh_rollup_hook, observe_stats_hook]))
+        print(f'{rows_written} historical rows upserted from archive.')
+    elif args.observe_issues:
+        now = datetime.datetime.utcnow()
+        scheduler = RateScheduler(args.requests_per_minute, args.max_in_flight)
+        rows_written = loop.run_until_complete(
+            observe_issues(api_key, db_conn_params, args.since or now - datetime.timedelta(days=7),
+                           min(args.until or now, now), scheduler=scheduler))
+        print(f'{rows_written} observations upserted.')
+    else:
+        locations = get_locations_time(db_conn_params)
+        #Disabled as 65k locations added to database
+        #batch_size = len(locations)
+        scheduler = RateScheduler(args.requests_per_minute, args.max_in_flight)
+        archive = ResponseArchive(args.archive, 'history') if args.archive else None
+        try:
+            loop.run_until_complete(main(api_key, locations, scheduler=scheduler, loader=args.loader, archive=archive,
+                                         decode_workers=args.decode_workers))
+        finally:
+            if archive is not None:
+                archive.close()
 
+    if reporter is not None:
+        loop.run_until_complete(reporter.stop())
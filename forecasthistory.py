@@ -0,0 +1,285 @@
+import argparse
+import datetime
+import os
+import zlib
+
+import psycopg2
+import psycopg2.extras
+
+from db import get_connection
+
+db_conn_params = {
+    "dbname": os.getenv('DB_NAME'),
+    "user": os.getenv('DB_USER'),
+    "password": os.getenv('DB_PASSWORD'),
+    "host": os.getenv('DB_HOST')
+}
+
+#Batch columns kept for every issue and the precision they are stored at
+issue_variables = [
+    ('Temperature', 0.01),
+    ('Pressure', 1),
+    ('Humidity', 1),
+    ('WeatherConditionID', 1),
+    ('Cloudiness', 1),
+    ('WindSpeed', 0.01),
+    ('WindDirection', 1),
+    ('Visibility', 1),
+    ('PrecipitationChance', 0.01),
+    ('Rain', 0.01),
+    ('Snow', 0.01),
+]
+issue_variable_names = [name for name, scale in issue_variables]
+
+encoding_version = 1
+
+
+def write_varint(out, value):
+    # Zigzag so small negative deltas stay small
+    value = (value << 1) ^ (value >> 63)
+    while value >= 0x80:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def read_varint(data, position):
+    value = 0
+    shift = 0
+    while True:
+        byte = data[position]
+        position += 1
+        value |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            break
+        shift += 7
+    return (value >> 1) ^ -(value & 1), position
+
+
+#Write each value as the difference from the one before it
+def write_deltas(out, values):
+    previous = 0
+    for value in values:
+        write_varint(out, value - previous)
+        previous = value
+
+
+def read_deltas(data, position, count):
+    values = []
+    previous = 0
+    for _ in range(count):
+        delta, position = read_varint(data, position)
+        previous += delta
+        values.append(previous)
+    return values, position
+
+
+def encode_issue(epochs, columns):
+    '''
+    Pack one location's forecast issue into bytes.
+
+    epochs are the forecast times in unix seconds and columns maps each issue variable to its
+    values (None or NaN when missing). Values are rounded to the variable's precision and stored
+    as zigzag varint deltas along lead time, where consecutive 3 hour steps rarely differ by much,
+    then the whole thing is zlib compressed. A 40 step issue takes a few hundred bytes instead of
+    40 table rows.
+    '''
+    out = bytearray([encoding_version])
+    write_varint(out, len(epochs))
+    write_deltas(out, epochs)
+    for name, scale in issue_variables:
+        values = columns[name]
+        present = [value is not None and value == value for value in values]
+        if all(present):
+            out.append(0)
+        else:
+            # Bitmap of which steps have a value, only stored when something is missing
+            out.append(1)
+            bitmap = bytearray((len(values) + 7) // 8)
+            for i, flag in enumerate(present):
+                if flag:
+                    bitmap[i // 8] |= 1 << (i % 8)
+            out.extend(bitmap)
+        write_deltas(out, [round(value / scale) for value, flag in zip(values, present) if flag])
+    return zlib.compress(bytes(out))
+
+
+#Unpack encode_issue output into (epochs, {variable: values with None for missing})
+def decode_issue(blob):
+    data = zlib.decompress(blob)
+    if data[0] != encoding_version:
+        raise ValueError(f'Unknown forecast issue encoding {data[0]}.')
+    count, position = read_varint(data, 1)
+    epochs, position = read_deltas(data, position, count)
+
+    columns = {}
+    for name, scale in issue_variables:
+        flag = data[position]
+        position += 1
+        if flag:
+            bitmap = data[position:position + (count + 7) // 8]
+            position += len(bitmap)
+            present = [bool(bitmap[i // 8] & (1 << (i % 8))) for i in range(count)]
+        else:
+            present = [True] * count
+        stored, position = read_deltas(data, position, sum(present))
+        stored = iter(stored)
+        columns[name] = [next(stored) * scale if flag else None for flag in present]
+    return epochs, columns
+
+
+def record_issues(cursor, batch, issued_at=None):
+    '''
+    Append every location in batch to ForecastIssue as one packed row issued at issued_at
+    (default now, UTC). Rows are never updated, so each issue stays available for comparing
+    forecasts made at different lead times.
+    '''
+    if not len(batch):
+        return
+    if issued_at is None:
+        issued_at = datetime.datetime.utcnow().replace(microsecond=0)
+
+    # Group row positions by location, a repeated forecast time keeps its last value
+    rows_by_location = {}
+    for i, (location_id, epoch) in enumerate(zip(batch['LocationID'], batch['Epoch'])):
+        rows_by_location.setdefault(location_id, {})[epoch] = i
+
+    values = []
+    for location_id, positions in rows_by_location.items():
+        epochs = sorted(positions)
+        rows = [positions[epoch] for epoch in epochs]
+        columns = {name: [batch[name][i] for i in rows] for name in issue_variable_names}
+        values.append((location_id, issued_at,
+                       datetime.datetime.utcfromtimestamp(epochs[0]), datetime.datetime.utcfromtimestamp(epochs[-1]),
+                       psycopg2.Binary(encode_issue(epochs, columns))))
+
+    psycopg2.extras.execute_values(cursor, """
+        INSERT INTO ForecastIssue (LocationID, IssuedAt, FirstTimestamp, LastTimestamp, Data)
+        VALUES %s
+        ON CONFLICT (LocationID, IssuedAt) DO NOTHING;
+    """, values, page_size=1000)
+
+
+#Hook for forecast writes: keep this issue alongside the overwritten Forecast rows
+def record_issues_hook(cursor, batch, written):
+    record_issues(cursor, batch)
+
+
+#Upsert observed values from a history batch into Observation, the ground truth forecast_error_by_lead scores against
+def record_observations(cursor, batch):
+    if not len(batch):
+        return
+    # Key by location and time so a repeated hour keeps its last value, one statement can't update a row twice
+    columns = [batch.column_values(name) for name in issue_variable_names]
+    rows = {}
+    for location_id, epoch, *values in zip(batch['LocationID'], batch['Epoch'], *columns):
+        rows[location_id, epoch] = (location_id, datetime.datetime.utcfromtimestamp(epoch), *values)
+
+    names = ', '.join(issue_variable_names)
+    updates = ', '.join(f'{name} = EXCLUDED.{name}' for name in issue_variable_names)
+    psycopg2.extras.execute_values(cursor, f"""
+        INSERT INTO Observation (LocationID, TimestampISO, {names})
+        VALUES %s
+        ON CONFLICT (LocationID, TimestampISO) DO UPDATE SET {updates};
+    """, list(rows.values()), page_size=1000)
+
+
+def forecast_error_by_lead(db_conn_params, variable, since, until, location_ids=None, bucket_hours=3):
+    '''
+    Forecast minus observed for variable at every lead time, for forecast times between since and until.
+
+    Observed values come from Observation, which `fetchhistorical.py --observe-issues` fills with the
+    provider's history for the times that recorded issues forecast. Forecast steps without an observation
+    are left out. Returns a list of (lead_hours, count, bias, mean_absolute_error, rmse) with leads
+    grouped into bucket_hours buckets.
+    '''
+    if variable not in issue_variable_names:
+        raise ValueError(f'Unknown variable {variable}.')
+    until = min(until, datetime.datetime.utcnow())
+
+    with get_connection(db_conn_params) as conn:
+        try:
+            with conn.cursor() as cursor:
+                # Only past forecast times have been observed; the range scan uses the Observation time index
+                cursor.execute(f"""
+                    SELECT LocationID, EXTRACT(EPOCH FROM TimestampISO)::bigint, {variable}::float
+                    FROM Observation
+                    WHERE TimestampISO >= %s AND TimestampISO < %s AND {variable} IS NOT NULL
+                      AND (%s::int[] IS NULL OR LocationID = ANY(%s::int[]));
+                """, (since, until, location_ids, location_ids))
+                observed = {(location_id, epoch): value for location_id, epoch, value in cursor.fetchall()}
+
+            totals = {}
+            # Issues are streamed with a named cursor, only the ones covering the window are read
+            with conn.cursor(name='forecast_issues') as cursor:
+                cursor.itersize = 5000
+                cursor.execute("""
+                    SELECT LocationID, EXTRACT(EPOCH FROM IssuedAt)::bigint, Data
+                    FROM ForecastIssue
+                    WHERE LastTimestamp >= %s AND FirstTimestamp < %s AND IssuedAt < %s
+                      AND (%s::int[] IS NULL OR LocationID = ANY(%s::int[]));
+                """, (since, until, until, location_ids, location_ids))
+                for location_id, issued_at, data in cursor:
+                    epochs, columns = decode_issue(bytes(data))
+                    for epoch, value in zip(epochs, columns[variable]):
+                        actual = observed.get((location_id, epoch))
+                        if actual is None or value is None or epoch < issued_at:
+                            continue
+                        bucket = (epoch - issued_at) // (bucket_hours * 3600) * bucket_hours
+                        error = value - actual
+                        total = totals.setdefault(bucket, [0, 0.0, 0.0, 0.0])
+                        total[0] += 1
+                        total[1] += error
+                        total[2] += abs(error)
+                        total[3] += error * error
+        finally:
+            conn.rollback()
+
+    return [(lead, count, error_sum / count, abs_sum / count, (square_sum / count) ** 0.5)
+            for lead, (count, error_sum, abs_sum, square_sum) in sorted(totals.items())]
+
+
+#Delete issues made before cutoff, returns how many were removed
+def prune_issues(db_conn_params, cutoff):
+    with get_connection(db_conn_params) as conn:
+        cursor = conn.cursor()
+        try:
+            cursor.execute("DELETE FROM ForecastIssue WHERE IssuedAt < %s;", (cutoff,))
+            deleted = cursor.rowcount
+            conn.commit()
+            return deleted
+        except (Exception, psycopg2.DatabaseError) as error:
+            print(f'Error: {error}')
+            conn.rollback()
+            return 0
+        finally:
+            cursor.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Forecast error by lead time from the recorded forecast issues.')
+    parser.add_argument('--variable', choices=issue_variable_names, default='Temperature')
+    parser.add_argument('--since', type=datetime.datetime.fromisoformat,
+                        help='First forecast time (UTC) to score, default 7 days ago.')
+    parser.add_argument('--until', type=datetime.datetime.fromisoformat,
+                        help='Forecast times before this UTC time, default now.')
+    parser.add_argument('--location', type=int, action='append', dest='location_ids',
+                        help='Only score this LocationID, can be repeated.')
+    parser.add_argument('--bucket-hours', type=int, default=3, help='Width of the lead time buckets.')
+    parser.add_argument('--prune-before', type=datetime.datetime.fromisoformat,
+                        help='Delete issues made before this UTC time instead of scoring.')
+    args = parser.parse_args()
+
+    if args.prune_before:
+        print(f'{prune_issues(db_conn_params, args.prune_before)} issues deleted.')
+    else:
+        now = datetime.datetime.utcnow()
+        try:
+            rows = forecast_error_by_lead(db_conn_params, args.variable, args.since or now - datetime.timedelta(days=7),
+                                          args.until or now, args.location_ids, args.bucket_hours)
+        except (Exception, psycopg2.DatabaseError) as error:
+            print(f'Error: {error}')
+        else:
+            print(f"{'lead h':>6} {'count':>9} {'bias':>8} {'MAE':>8} {'RMSE':>8}")
+            for lead, count, bias, mae, rmse in rows:
+                print(f'{lead:>6} {count:>9} {bias:>8.2f} {mae:>8.2f} {rmse:>8.2f}')
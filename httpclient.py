@@ -0,0 +1,129 @@
+import asyncio
+import random
+import time
+
+import aiohttp
+
+from metrics import inc, observe
+
+#HTTP statuses worth retrying, the server or something in front of it failed rather than the request
+transient_statuses = {500, 502, 503, 504}
+
+#Exceptions that mean the connection or the server hiccupped and the same request may well succeed
+transient_errors = (
+    asyncio.TimeoutError,
+    aiohttp.ServerDisconnectedError,
+    aiohttp.ClientConnectionError,
+    aiohttp.ClientPayloadError,
+    ConnectionResetError,
+)
+
+
+def create_session(max_connections=100, keepalive_timeout=30, dns_cache_seconds=300, connect_timeout=10,
+                   read_timeout=30):
+    '''
+    ClientSession shared by every fetcher.
+
+    Every request goes to one OpenWeatherMap host, so max_connections bounds both the pool and the
+    connections per host; pass the scheduler's max_in_flight so no request waits on the pool as well.
+    Connections are kept alive between requests and DNS lookups are cached, so a sweep of 65k requests
+    reuses a few hundred TLS handshakes instead of making one per request. Responses are requested
+    gzip compressed and decompressed transparently. connect_timeout and read_timeout are in seconds,
+    read_timeout applies between chunks of the body rather than to the whole request.
+    '''
+    connector = aiohttp.TCPConnector(
+        limit=max_connections,
+        limit_per_host=max_connections,
+        keepalive_timeout=keepalive_timeout,
+        use_dns_cache=True,
+        ttl_dns_cache=dns_cache_seconds,
+        enable_cleanup_closed=True,
+    )
+    timeout = aiohttp.ClientTimeout(total=None, connect=connect_timeout, sock_connect=connect_timeout,
+                                    sock_read=read_timeout)
+    return aiohttp.ClientSession(connector=connector, timeout=timeout,
+                                 headers={'Accept-Encoding': 'gzip, deflate'}, auto_decompress=True)
+
+
+#Check whether an exception raised by a request is worth retrying
+def is_transient(error):
+    return isinstance(error, transient_errors)
+
+
+#Label for metrics and log lines describing why a request is retried
+def retry_reason(error):
+    if isinstance(error, asyncio.TimeoutError):
+        return 'timeout'
+    if isinstance(error, aiohttp.ServerDisconnectedError):
+        return 'disconnect'
+    return type(error).__name__
+
+
+#Exponential backoff with full jitter so retries from many requests don't line up
+def retry_delay(attempt, base=1.0, cap=30.0):
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+#Seconds from a Retry-After header, None when it is missing or not a number of seconds
+def parse_retry_after(value):
+    return float(value) if value and value.isdigit() else None
+
+
+async def fetch_body(session, url, scheduler, endpoint, label, max_rate_limit_retries=10, max_transient_retries=3):
+    '''
+    GET url under scheduler's request budget and return (status, body).
+
+    A 200 returns its raw body. A 429 pauses every request through scheduler (honouring
+    Retry-After) and tries again, up to max_rate_limit_retries times. 5xx responses and
+    connection problems get max_transient_retries attempts with jittered backoff. Any other
+    status returns (status, None) for the caller to interpret. Giving up, or an error that won't
+    go away by retrying, returns (None, None). endpoint labels the metrics and label names the
+    request in log lines.
+    '''
+    transient_failures = 0
+    for attempt in range(max_rate_limit_retries):
+        retry_after = None
+        try:
+            # Wait for a slot in the request budget before each attempt
+            async with scheduler:
+                started = time.perf_counter()
+                async with session.get(url) as response:
+                    inc('weather_http_responses_total', endpoint=endpoint, status=response.status)
+                    if response.status == 200:
+                        scheduler.record_success()
+                        body = await response.read()
+                        observe('weather_http_request_seconds', time.perf_counter() - started, endpoint=endpoint)
+                        return 200, body
+                    if response.status == 429:
+                        retry_after = parse_retry_after(response.headers.get('Retry-After'))
+                        reason = '429'
+                    elif response.status in transient_statuses:
+                        reason = str(response.status)
+                    else:
+                        return response.status, None
+        except Exception as error:
+            # Bad URLs and the like fail the same way every time
+            if not is_transient(error):
+                print(f"Request for {label} failed: {error!r}")
+                inc('weather_locations_failed_total', endpoint=endpoint, reason=type(error).__name__)
+                return None, None
+            reason = retry_reason(error)
+
+        inc('weather_http_retries_total', endpoint=endpoint, reason=reason)
+        if reason == '429':
+            # Slow every request down rather than dropping this one, then try again
+            pause = scheduler.backoff(retry_after)
+            print(f"Too many requests, backing off for {pause:.0f} seconds.")
+        else:
+            transient_failures += 1
+            if transient_failures >= max_transient_retries:
+                print(f"Request for {label} failed ({reason}), max retries exceeded.")
+                inc('weather_locations_failed_total', endpoint=endpoint, reason=reason)
+                return None, None
+            delay = retry_delay(transient_failures - 1)
+            print(f"Request for {label} failed ({reason}), retrying in {delay:.1f} seconds.")
+            await asyncio.sleep(delay)
+
+    print(f"Giving up on {label} after repeated 429s.")
+    inc('weather_locations_failed_total', endpoint=endpoint, reason='429')
+    return None, None
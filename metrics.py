@@ -0,0 +1,207 @@
+import asyncio
+import bisect
+import contextlib
+import json
+import os
+import threading
+import time
+
+#Histogram bucket upper bounds in seconds, wide enough for a fast parse and a slow batch commit
+default_buckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+#Type and help text of every metric the ingest scripts record
+metric_definitions = {
+    'weather_http_request_seconds': ('histogram', 'Time from sending an API request to reading its body.'),
+    'weather_http_responses_total': ('counter', 'API responses by endpoint and HTTP status.'),
+    'weather_http_retries_total': ('counter', 'API requests retried, by endpoint and reason.'),
+    'weather_locations_failed_total': ('counter', 'Locations or windows given up on, by endpoint and reason.'),
+    'weather_json_decode_seconds': ('histogram', 'Time spent decoding one response body.'),
+    'weather_extract_seconds': ('histogram', 'Time spent extracting one response into a batch.'),
+    'weather_rows_extracted_total': ('counter', 'Forecast rows extracted from responses.'),
+    'weather_db_write_seconds': ('histogram', 'Time to upsert and commit one batch, by loader.'),
+    'weather_db_write_errors_total': ('counter', 'Batches whose upsert was rolled back, by loader.'),
+    'weather_rows_written_total': ('counter', 'Forecast rows in batches that committed.'),
+    'weather_rows_changed_total': ('counter', 'Forecast rows inserted or changed in the database.'),
+    'weather_rows_unchanged_total': ('counter', 'Forecast rows skipped because their values were unchanged.'),
+}
+
+
+class Histogram:
+    def __init__(self, buckets=default_buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    #Estimate a quantile by interpolating inside the bucket that holds it
+    def quantile(self, q):
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            if seen + count >= rank and count:
+                lower = self.buckets[i - 1] if i > 0 else 0.0
+                upper = self.buckets[i] if i < len(self.buckets) else self.buckets[-1]
+                return lower + (upper - lower) * (rank - seen) / count
+            seen += count
+        return self.buckets[-1]
+
+
+class Registry:
+    '''
+    Counters and histograms keyed by metric name and label values.
+    Safe to update from the event loop and the database threads at the same time.
+    '''
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+        self.started = time.time()
+
+    def inc(self, name, amount=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            if key not in self.histograms:
+                self.histograms[key] = Histogram()
+            self.histograms[key].observe(value)
+
+    @contextlib.contextmanager
+    def timer(self, name, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started, **labels)
+
+    def total(self, name):
+        with self.lock:
+            return sum(value for (metric, labels), value in self.counters.items() if metric == name)
+
+    def reset(self):
+        with self.lock:
+            self.counters.clear()
+            self.histograms.clear()
+            self.started = time.time()
+
+    #Prometheus text exposition format, suitable for the node_exporter textfile collector
+    def to_prometheus(self):
+        def format_labels(labels, extra=()):
+            pairs = list(labels) + list(extra)
+            if not pairs:
+                return ''
+            return '{' + ','.join(f'{key}="{value}"' for key, value in pairs) + '}'
+
+        lines = []
+        with self.lock:
+            described = set()
+            for (name, labels), value in sorted(self.counters.items()):
+                if name not in described:
+                    described.add(name)
+                    lines.append(f'# HELP {name} {metric_definitions.get(name, ("counter", name))[1]}')
+                    lines.append(f'# TYPE {name} counter')
+                lines.append(f'{name}{format_labels(labels)} {value}')
+
+            for (name, labels), histogram in sorted(self.histograms.items()):
+                if name not in described:
+                    described.add(name)
+                    lines.append(f'# HELP {name} {metric_definitions.get(name, ("histogram", name))[1]}')
+                    lines.append(f'# TYPE {name} histogram')
+                cumulative = 0
+                for bound, count in zip(histogram.buckets, histogram.counts):
+                    cumulative += count
+                    lines.append(f'{name}_bucket{format_labels(labels, [("le", bound)])} {cumulative}')
+                lines.append(f'{name}_bucket{format_labels(labels, [("le", "+Inf")])} {histogram.count}')
+                lines.append(f'{name}_sum{format_labels(labels)} {histogram.sum}')
+                lines.append(f'{name}_count{format_labels(labels)} {histogram.count}')
+
+        elapsed = time.time() - self.started
+        lines.append('# HELP weather_run_seconds Seconds since the run started.')
+        lines.append('# TYPE weather_run_seconds gauge')
+        lines.append(f'weather_run_seconds {elapsed:.3f}')
+        lines.append('# HELP weather_rows_written_per_second Rows committed per second over the run.')
+        lines.append('# TYPE weather_rows_written_per_second gauge')
+        lines.append(f'weather_rows_written_per_second {self.total("weather_rows_written_total") / max(elapsed, 1e-9):.3f}')
+        return '\n'.join(lines) + '\n'
+
+    #Run report with counters and histogram summaries as plain JSON
+    def to_json(self):
+        elapsed = time.time() - self.started
+        report = {
+            'started_at': self.started,
+            'elapsed_seconds': elapsed,
+            'rows_written_per_second': self.total('weather_rows_written_total') / max(elapsed, 1e-9),
+            'counters': {},
+            'histograms': {},
+        }
+        with self.lock:
+            for (name, labels), value in sorted(self.counters.items()):
+                report['counters'].setdefault(name, []).append({'labels': dict(labels), 'value': value})
+            for (name, labels), histogram in sorted(self.histograms.items()):
+                report['histograms'].setdefault(name, []).append({
+                    'labels': dict(labels),
+                    'count': histogram.count,
+                    'sum': histogram.sum,
+                    'mean': histogram.sum / histogram.count if histogram.count else None,
+                    'p50': histogram.quantile(0.5),
+                    'p95': histogram.quantile(0.95),
+                    'p99': histogram.quantile(0.99),
+                })
+        return json.dumps(report, indent=2)
+
+
+#Registry shared by every module in a run
+registry = Registry()
+inc = registry.inc
+observe = registry.observe
+timer = registry.timer
+
+
+class MetricsReporter:
+    '''
+    Write the registry to path every interval seconds while a run is going and once more at the end.
+    Files ending in .prom get Prometheus text format, anything else a JSON report. Each write
+    replaces the file atomically so a scraper never reads half of one.
+    '''
+    def __init__(self, path, interval=30, registry=registry):
+        self.path = path
+        self.interval = interval
+        self.registry = registry
+        self.task = None
+
+    def write(self):
+        text = self.registry.to_prometheus() if self.path.endswith('.prom') else self.registry.to_json()
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'w') as report_file:
+            report_file.write(text)
+        os.replace(temp_path, self.path)
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                self.write()
+            except OSError as error:
+                print(f'Error writing metrics: {error}')
+
+    def start(self):
+        self.task = asyncio.ensure_future(self._run())
+
+    #Stop the periodic writes and write the final report
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self.task
+            self.task = None
+        self.write()
@@ -0,0 +1,171 @@
+import argparse
+import os
+
+import psycopg2
+
+from db import get_connection
+from rollup import rollup_columns, rollup_group, rollup_select, rollup_upsert
+
+db_conn_params = {
+    "dbname": os.getenv('DB_NAME'),
+    "user": os.getenv('DB_USER'),
+    "password": os.getenv('DB_PASSWORD'),
+    "host": os.getenv('DB_HOST')
+}
+
+#Upgrade steps for a database created by an older create-table.py, in order.
+#Every step can run again safely, so the script is run after each upgrade without tracking what was applied.
+migrations = [
+    ('Rain and Snow keyed by ForecastID', '''
+        -- The forecast merge upserts ON CONFLICT (ForecastID), keep the newest row of any duplicates first
+        DELETE FROM Rain r USING Rain newer
+        WHERE newer.ForecastID = r.ForecastID AND newer.RainID > r.RainID;
+        CREATE UNIQUE INDEX IF NOT EXISTS rain_forecastid_key ON Rain (ForecastID);
+
+        DELETE FROM Snow s USING Snow newer
+        WHERE newer.ForecastID = s.ForecastID AND newer.SnowID > s.SnowID;
+        CREATE UNIQUE INDEX IF NOT EXISTS snow_forecastid_key ON Snow (ForecastID);
+    '''),
+    ('BackfillWatermark table', '''
+        CREATE TABLE IF NOT EXISTS BackfillWatermark (
+            LocationID int primary key references Location(LocationID),
+            OldestTimestamp timestamp not null,
+            UpdatedAt timestamp default now()
+        );
+    '''),
+    ('LocationRefresh table', '''
+        CREATE TABLE IF NOT EXISTS LocationRefresh (
+            LocationID int primary key references Location(LocationID),
+            RefreshedAt timestamp not null
+        );
+    '''),
+    ('ForecastRollup table', '''
+        -- Earlier versions were keyed by hour, it is derived data so it is recreated as daily aggregates
+        DO $$
+        BEGIN
+            IF EXISTS (SELECT 1 FROM information_schema.columns
+                       WHERE table_name = 'forecastrollup' AND column_name = 'hour') THEN
+                DROP TABLE ForecastRollup;
+            END IF;
+        END $$;
+
+        CREATE TABLE IF NOT EXISTS ForecastRollup (
+            LocationID int references Location(LocationID),
+            Day date,
+            SampleCount int,
+            Temperature float,
+            Humidity float,
+            WindSpeed float,
+            Pressure float,
+            Cloudiness float,
+            Visibility float,
+            PrecipitationChance float,
+            TemperatureMin float,
+            TemperatureMax float,
+            UpdatedAt timestamp default now(),
+            primary key (LocationID, Day)
+        );
+        CREATE INDEX IF NOT EXISTS forecastrollup_day ON ForecastRollup (Day);
+        CREATE INDEX IF NOT EXISTS forecastrollup_updatedat ON ForecastRollup (UpdatedAt);
+    '''),
+    ('ForecastStats table', '''
+        CREATE TABLE IF NOT EXISTS ForecastStats (
+            LocationID int references Location(LocationID),
+            Variable varchar(30),
+            Month smallint,
+            Hour smallint,
+            SampleCount bigint,
+            Mean float,
+            M2 float,
+            MinValue float,
+            MaxValue float,
+            UpdatedAt timestamp default now(),
+            primary key (LocationID, Variable, Month, Hour)
+        );
+    '''),
+    ('ForecastAnomaly table', '''
+        CREATE TABLE IF NOT EXISTS ForecastAnomaly (
+            LocationID int references Location(LocationID),
+            TimestampISO timestamp,
+            Variable varchar(30),
+            Value float,
+            Mean float,
+            StdDev float,
+            ZScore float,
+            FlaggedAt timestamp default now(),
+            primary key (LocationID, TimestampISO, Variable)
+        );
+        CREATE INDEX IF NOT EXISTS forecastanomaly_timestamp ON ForecastAnomaly (TimestampISO);
+    '''),
+    ('ForecastIssue table', '''
+        CREATE TABLE IF NOT EXISTS ForecastIssue (
+            LocationID int references Location(LocationID),
+            IssuedAt timestamp,
+            FirstTimestamp timestamp,
+            LastTimestamp timestamp,
+            Data bytea,
+            primary key (LocationID, IssuedAt)
+        );
+        CREATE INDEX IF NOT EXISTS forecastissue_lasttimestamp ON ForecastIssue USING brin (LastTimestamp);
+    '''),
+    ('Forecast time index', '''
+        -- Time range scans (point query cube, export) on the single heap table, partitioned tables have BRIN instead
+        DO $$
+        BEGIN
+            IF EXISTS (SELECT 1 FROM pg_class WHERE relname = 'forecast' AND relkind = 'r') THEN
+                CREATE INDEX IF NOT EXISTS forecast_timestamp ON Forecast (TimestampISO);
+            END IF;
+        END $$;
+    '''),
+    ('Observation table', '''
+        CREATE TABLE IF NOT EXISTS Observation (
+            LocationID int references Location(LocationID),
+            TimestampISO timestamp,
+            Temperature float,
+            Pressure int,
+            Humidity int,
+            WeatherConditionID int,
+            Cloudiness int,
+            WindSpeed float,
+            WindDirection int,
+            Visibility int,
+            PrecipitationChance float,
+            Rain float,
+            Snow float,
+            primary key (LocationID, TimestampISO)
+        );
+        CREATE INDEX IF NOT EXISTS observation_timestamp ON Observation (TimestampISO);
+    '''),
+]
+
+
+#Fill a new, empty ForecastRollup from Forecast so the dashboard and export see existing data
+def backfill_rollup(cursor):
+    cursor.execute("SELECT NOT EXISTS (SELECT 1 FROM ForecastRollup) AND EXISTS (SELECT 1 FROM Forecast);")
+    if cursor.fetchone()[0]:
+        print('Filling ForecastRollup from Forecast')
+        cursor.execute(rollup_columns + rollup_select + "FROM Forecast f" + rollup_group + rollup_upsert)
+
+
+#Apply every migration in one transaction, nothing is changed if any step fails
+def migrate(db_conn_params):
+    with get_connection(db_conn_params) as conn:
+        cursor = conn.cursor()
+        try:
+            for name, statements in migrations:
+                print(f'Applying: {name}')
+                cursor.execute(statements)
+            backfill_rollup(cursor)
+            conn.commit()
+            print('Database is up to date.')
+        except (Exception, psycopg2.DatabaseError) as error:
+            print(f'Error: {error}')
+            conn.rollback()
+        finally:
+            cursor.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Upgrade an existing database to the current schema without dropping data.')
+    parser.parse_args()
+    migrate(db_conn_params)
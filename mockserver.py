@@ -0,0 +1,178 @@
+import argparse
+import asyncio
+import json
+import random
+import time
+
+from aiohttp import web
+
+#Condition IDs used in generated responses, all present in WeatherConditionTypes
+condition_ids = [800, 801, 802, 803, 804, 500, 501, 600]
+
+
+class MockWeatherServer:
+    '''
+    Local stand-in for the OpenWeatherMap forecast and history endpoints.
+
+    Responses are generated from the coordinates and times in the request, so the same request
+    always returns the same payload. latency (seconds, plus up to jitter more) is added before
+    every response. error_rate of requests get a 500, rate_limit_rate get a 429, and
+    unavailable_rate of history locations get a 404 as if no data existed for them.
+    requests_per_minute, when set, answers 429 with Retry-After once a minute's quota is used.
+    '''
+    def __init__(self, latency=0.0, jitter=0.0, error_rate=0.0, rate_limit_rate=0.0, unavailable_rate=0.0,
+                 requests_per_minute=None, seed=0):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.unavailable_rate = unavailable_rate
+        self.requests_per_minute = requests_per_minute
+        self.random = random.Random(seed)
+        self.seed = seed
+        self.window_start = time.monotonic()
+        self.window_count = 0
+        self.counts = {}
+        self.runner = None
+
+        self.app = web.Application()
+        self.app.router.add_get('/data/2.5/forecast', self.forecast)
+        self.app.router.add_get('/data/2.5/history/city', self.history)
+
+    def count(self, status):
+        self.counts[status] = self.counts.get(status, 0) + 1
+
+    @property
+    def requests(self):
+        return sum(self.counts.values())
+
+    #Apply latency and fault injection, returns a response to send instead of data or None
+    async def faults(self):
+        delay = self.latency + (self.random.uniform(0, self.jitter) if self.jitter else 0)
+        if delay:
+            await asyncio.sleep(delay)
+
+        if self.requests_per_minute is not None:
+            now = time.monotonic()
+            if now - self.window_start >= 60:
+                self.window_start, self.window_count = now, 0
+            self.window_count += 1
+            if self.window_count > self.requests_per_minute:
+                retry_after = max(1, int(60 - (now - self.window_start)))
+                self.count(429)
+                return web.json_response({'cod': 429, 'message': 'quota exceeded'}, status=429,
+                                         headers={'Retry-After': str(retry_after)})
+
+        if self.rate_limit_rate and self.random.random() < self.rate_limit_rate:
+            self.count(429)
+            return web.json_response({'cod': 429, 'message': 'too many requests'}, status=429)
+        if self.error_rate and self.random.random() < self.error_rate:
+            self.count(500)
+            return web.json_response({'cod': 500, 'message': 'internal error'}, status=500)
+        return None
+
+    #One weather entry for the given coordinates and time, in the API's shape
+    def entry(self, latitude, longitude, dt, pop=False):
+        rng = random.Random(hash((self.seed, round(latitude, 4), round(longitude, 4), dt)))
+        temp = 60 - abs(latitude) * 0.8 + rng.uniform(-15, 15)
+        entry = {
+            'dt': dt,
+            'main': {
+                'temp': round(temp, 2),
+                'feels_like': round(temp - rng.uniform(0, 5), 2),
+                'temp_min': round(temp - rng.uniform(0, 3), 2),
+                'temp_max': round(temp + rng.uniform(0, 3), 2),
+                'pressure': rng.randint(980, 1040),
+                'sea_level': rng.randint(980, 1040),
+                'grnd_level': rng.randint(900, 1040),
+                'humidity': rng.randint(10, 100),
+            },
+            'weather': [{'id': rng.choice(condition_ids), 'main': 'Clear', 'description': 'clear sky', 'icon': '01d'}],
+            'clouds': {'all': rng.randint(0, 100)},
+            'wind': {'speed': round(rng.uniform(0, 30), 2), 'deg': rng.randint(0, 359),
+                     'gust': round(rng.uniform(0, 40), 2)},
+            'visibility': rng.randint(1000, 10000),
+        }
+        if pop:
+            entry['pop'] = round(rng.random(), 2)
+        if rng.random() < 0.2:
+            entry['rain'] = {'3h': round(rng.uniform(0.1, 5), 2)}
+        return entry
+
+    async def forecast(self, request):
+        fault = await self.faults()
+        if fault is not None:
+            return fault
+
+        latitude = float(request.query['lat'])
+        longitude = float(request.query['lon'])
+        # 40 entries every 3 hours starting at the next 3 hour mark, like the 5 day / 3 hour forecast
+        start = (int(time.time()) // 10800 + 1) * 10800
+        entries = [self.entry(latitude, longitude, start + i * 10800, pop=True) for i in range(40)]
+
+        self.count(200)
+        return web.Response(body=json.dumps({'cod': '200', 'message': 0, 'cnt': len(entries), 'list': entries,
+                                             'city': {'coord': {'lat': latitude, 'lon': longitude}}}),
+                            content_type='application/json')
+
+    async def history(self, request):
+        fault = await self.faults()
+        if fault is not None:
+            return fault
+
+        latitude = float(request.query['lat'])
+        longitude = float(request.query['lon'])
+        if self.unavailable_rate and random.Random(hash((self.seed, latitude, longitude))).random() < self.unavailable_rate:
+            self.count(404)
+            return web.json_response({'cod': '404', 'message': 'data not found'}, status=404)
+
+        # Hourly entries between start and end, the 3 hour rain volume is what extraction reads
+        start = (int(request.query['start']) // 3600 + 1) * 3600
+        end = int(request.query['end'])
+        entries = [self.entry(latitude, longitude, dt) for dt in range(start, end + 1, 3600)]
+
+        self.count(200)
+        return web.Response(body=json.dumps({'message': f'Count: {len(entries)}', 'cod': '200', 'city_id': 0,
+                                             'calctime': 0.01, 'cnt': len(entries), 'list': entries}),
+                            content_type='application/json')
+
+    #Start listening and return the base URL, port 0 picks a free port
+    async def start(self, host='127.0.0.1', port=0):
+        self.runner = web.AppRunner(self.app, access_log=None)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, host, port)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        return f'http://{host}:{port}'
+
+    async def stop(self):
+        if self.runner is not None:
+            await self.runner.cleanup()
+            self.runner = None
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve fake OpenWeatherMap forecast and history responses locally.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--latency', type=float, default=0.0, help='Seconds added to every response.')
+    parser.add_argument('--jitter', type=float, default=0.0, help='Up to this many extra seconds of random latency.')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Fraction of requests answered with 500.')
+    parser.add_argument('--rate-limit-rate', type=float, default=0.0, help='Fraction of requests answered with 429.')
+    parser.add_argument('--unavailable-rate', type=float, default=0.0,
+                        help='Fraction of history locations answered with 404.')
+    parser.add_argument('--requests-per-minute', type=int, default=None, help='Quota enforced with 429 and Retry-After.')
+    args = parser.parse_args()
+
+    server = MockWeatherServer(args.latency, args.jitter, args.error_rate, args.rate_limit_rate,
+                               args.unavailable_rate, args.requests_per_minute)
+    loop = asyncio.get_event_loop()
+    base_url = loop.run_until_complete(server.start(args.host, args.port))
+    print(f'Serving on {base_url}, set OPENWEATHER_FORECAST_URL={base_url}/data/2.5/forecast '
+          f'and OPENWEATHER_HISTORY_URL={base_url}/data/2.5/history/city')
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        loop.run_until_complete(server.stop())
@@ -0,0 +1,143 @@
+import argparse
+import datetime
+import os
+import re
+
+import psycopg2
+
+from db import get_connection
+
+db_conn_params = {
+    "dbname": os.getenv('DB_NAME'),
+    "user": os.getenv('DB_USER'),
+    "password": os.getenv('DB_PASSWORD'),
+    "host": os.getenv('DB_HOST')
+}
+
+#Monthly partitions are named forecast_YYYY_MM
+partition_pattern = re.compile(r'^forecast_(\d{4})_(\d{2})$')
+
+
+#First day of the month containing moment
+def month_start(moment):
+    return datetime.datetime(moment.year, moment.month, 1)
+
+
+#First day of the month after start
+def next_month(start):
+    return datetime.datetime(start.year + start.month // 12, start.month % 12 + 1, 1)
+
+
+def partition_name(start):
+    return f'forecast_{start.year:04d}_{start.month:02d}'
+
+
+#Check whether Forecast was created with PARTITION BY RANGE (TimestampISO)
+def is_partitioned(cursor):
+    cursor.execute("SELECT relkind = 'p' FROM pg_class WHERE oid = to_regclass('forecast');")
+    row = cursor.fetchone()
+    return bool(row and row[0])
+
+
+#Names of the existing Forecast partitions
+def list_partitions(cursor):
+    cursor.execute("""
+        SELECT c.relname
+        FROM pg_inherits i
+        JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = 'forecast'::regclass;
+    """)
+    return sorted(row[0] for row in cursor.fetchall())
+
+
+#Create any missing monthly partitions covering start to end, returns the partition names in range
+def ensure_partitions(cursor, start, end):
+    month = month_start(start)
+    names = []
+    while month < end:
+        following = next_month(month)
+        name = partition_name(month)
+        # Indexes declared on Forecast are created on each new partition automatically
+        cursor.execute(f"""
+            CREATE TABLE IF NOT EXISTS {name} PARTITION OF Forecast
+            FOR VALUES FROM ('{month:%Y-%m-%d}') TO ('{following:%Y-%m-%d}');
+        """)
+        names.append(name)
+        month = following
+    return names
+
+
+#Make sure partitions exist for rows between start and end, does nothing if Forecast isn't partitioned
+def ensure_partitions_for_range(db_conn_params, start, end):
+    with get_connection(db_conn_params) as conn:
+        cursor = conn.cursor()
+        try:
+            if is_partitioned(cursor):
+                ensure_partitions(cursor, start, end)
+                conn.commit()
+        except (Exception, psycopg2.DatabaseError) as error:
+            print(f'Error creating Forecast partitions: {error}')
+            conn.rollback()
+        finally:
+            cursor.close()
+
+
+def apply_retention(cursor, keep_months):
+    '''
+    Drop Forecast partitions that end more than keep_months months before the current month.
+    Rain and Snow rows of those forecasts are deleted first since they can't cascade from a partition,
+    and the month's ForecastRollup and ForecastAnomaly rows go with it so derived tables stay bounded too.
+    '''
+    cutoff = month_start(datetime.datetime.utcnow())
+    for _ in range(keep_months):
+        cutoff = datetime.datetime(cutoff.year - (cutoff.month == 1), (cutoff.month - 2) % 12 + 1, 1)
+
+    dropped = []
+    for name in list_partitions(cursor):
+        match = partition_pattern.match(name)
+        if not match:
+            continue
+        start = datetime.datetime(int(match.group(1)), int(match.group(2)), 1)
+        if next_month(start) > cutoff:
+            continue
+
+        cursor.execute(f"DELETE FROM Rain WHERE ForecastID IN (SELECT ForecastID FROM {name});")
+        cursor.execute(f"DELETE FROM Snow WHERE ForecastID IN (SELECT ForecastID FROM {name});")
+        cursor.execute("DELETE FROM ForecastRollup WHERE Day >= %s AND Day < %s;", (start.date(), next_month(start).date()))
+        cursor.execute("DELETE FROM ForecastAnomaly WHERE TimestampISO >= %s AND TimestampISO < %s;",
+                       (start, next_month(start)))
+        cursor.execute(f"ALTER TABLE Forecast DETACH PARTITION {name};")
+        cursor.execute(f"DROP TABLE {name};")
+        dropped.append(name)
+    return dropped
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Create upcoming Forecast partitions and drop expired ones.')
+    parser.add_argument('--months-ahead', type=int, default=2,
+                        help='Create partitions this many months past the current one.')
+    parser.add_argument('--keep-months', type=int, default=None,
+                        help='Drop partitions older than this many months (default keeps everything).')
+    args = parser.parse_args()
+
+    with get_connection(db_conn_params) as conn:
+        cursor = conn.cursor()
+        try:
+            if not is_partitioned(cursor):
+                print('Forecast is not partitioned, nothing to do.')
+            else:
+                now = datetime.datetime.utcnow()
+                end = month_start(now)
+                for _ in range(args.months_ahead + 1):
+                    end = next_month(end)
+                ensure_partitions(cursor, now, end)
+                if args.keep_months is not None:
+                    for name in apply_retention(cursor, args.keep_months):
+                        print(f'Dropped partition {name}.')
+                conn.commit()
+                print('Partitions successfully maintained.')
+        except (Exception, psycopg2.DatabaseError) as error:
+            print(f'Error: {error}')
+            conn.rollback()
+        finally:
+            cursor.close()
@@ -0,0 +1,248 @@
+import argparse
+import datetime
+import os
+import threading
+import time
+
+import numpy as np
+import psycopg2
+
+from db import get_connection
+
+db_conn_params = {
+    "dbname": os.getenv('DB_NAME'),
+    "user": os.getenv('DB_USER'),
+    "password": os.getenv('DB_PASSWORD'),
+    "host": os.getenv('DB_HOST')
+}
+
+#Forecast fields held in the cube, WindDirection is interpolated as a vector rather than in degrees
+cube_fields = ['Temperature', 'Pressure', 'Humidity', 'Cloudiness', 'WindSpeed', 'WindDirection',
+               'Visibility', 'PrecipitationChance', 'Rain', 'Snow']
+
+#Grid spacing in degrees the cube is built on. Locations off this grid (e.g. a finer regional grid)
+#are left out so one dense region can't blow the world cube up to its resolution.
+grid_step = float(os.getenv('POINTQUERY_GRID_STEP', 1.0))
+
+#Forecast steps are 3 hours apart and reach 5 days ahead, the cube holds a day more to be safe
+time_step = 3 * 3600
+horizon_steps = 6 * 24 // 3
+
+#Condition keeping only locations whose coordinates are whole multiples of %(step)s
+on_grid = """
+    abs(l.Latitude / %(step)s - round(l.Latitude / %(step)s)) < 1e-6
+    AND abs(l.Longitude / %(step)s - round(l.Longitude / %(step)s)) < 1e-6
+"""
+
+extent_query = """
+    SELECT min(l.Latitude), max(l.Latitude), min(l.Longitude), max(l.Longitude)
+    FROM Location l
+    WHERE """ + on_grid + ";"
+
+cube_query = """
+    SELECT l.Latitude, l.Longitude, EXTRACT(EPOCH FROM f.TimestampISO)::bigint,
+           f.Temperature, f.Pressure, f.Humidity, f.Cloudiness, f.WindSpeed, f.WindDirection,
+           f.Visibility, f.PrecipitationChance, COALESCE(r.Volume3h, 0), COALESCE(s.Volume3h, 0)
+    FROM Forecast f
+    JOIN Location l ON l.LocationID = f.LocationID
+    LEFT JOIN Rain r ON r.ForecastID = f.ForecastID
+    LEFT JOIN Snow s ON s.ForecastID = f.ForecastID
+    WHERE f.TimestampISO >= %(since)s AND f.TimestampISO < %(until)s AND """ + on_grid + ";"
+
+
+class ForecastCube:
+    '''
+    Latest forecasts as dense arrays indexed [time, latitude, longitude].
+
+    The cube covers one regular grid of step degrees, so a coordinate maps to its cell by arithmetic
+    on the grid origin and step instead of a nearest-row search. Grid points without data hold NaN
+    and are left out of the interpolation weights. Rows are added in chunks with add() and finish()
+    is called once they're all in.
+    '''
+    def __init__(self, lat_range, lon_range, step, first_epoch, time_count):
+        self.lat_step = self.lon_step = step
+        self.lat0, lat_size = self.axis(*lat_range)
+        self.lon0, lon_size = self.axis(*lon_range)
+        self.times = first_epoch + np.arange(time_count, dtype=np.int64) * time_step
+        # float32 halves the cube, forecast values don't carry more precision than that
+        self.fields = {name: np.full((time_count, lat_size, lon_size), np.nan, dtype=np.float32) for name in cube_fields}
+
+    #Origin and number of points of the axis from low to high
+    def axis(self, low, high):
+        start = round(low / self.lat_step)
+        return start * self.lat_step, round(high / self.lat_step) - start + 1
+
+    #Place a chunk of rows into the cube, rows between forecast steps are dropped
+    def add(self, latitudes, longitudes, epochs, values):
+        lat_index = np.rint((latitudes - self.lat0) / self.lat_step).astype(np.intp)
+        lon_index = np.rint((longitudes - self.lon0) / self.lon_step).astype(np.intp)
+        offset = epochs - self.times[0]
+        keep = (offset % time_step == 0) & (offset >= 0) & (offset // time_step < len(self.times))
+        time_index = (offset // time_step).astype(np.intp)
+        for name, column in values.items():
+            self.fields[name][time_index[keep], lat_index[keep], lon_index[keep]] = column[keep]
+
+    def finish(self):
+        # Drop trailing steps nobody has forecasts for yet, slicing keeps it a view rather than a copy
+        filled = ~np.all(np.isnan(self.fields['Temperature']), axis=(1, 2))
+        count = int(np.nonzero(filled)[0][-1]) + 1 if filled.any() else 1
+        self.times = self.times[:count]
+        self.fields = {name: cube[:count] for name, cube in self.fields.items()}
+
+        # Directions are averaged as unit vectors so 350 and 10 degrees meet at 0, not 180
+        radians = np.deg2rad(self.fields.pop('WindDirection'))
+        self.fields['_WindDirectionSin'] = np.sin(radians)
+        self.fields['_WindDirectionCos'] = np.cos(radians)
+        self.loaded_at = time.monotonic()
+        return self
+
+    @classmethod
+    def from_database(cls, db_conn_params, since=None, step=None, chunk_size=100000):
+        step = step or grid_step
+        # Start of the current 3 hour forecast step, older rows are history rather than forecast
+        if since is None:
+            now = datetime.datetime.utcnow()
+            since = now.replace(hour=now.hour - now.hour % 3, minute=0, second=0, microsecond=0)
+        params = {'since': since, 'until': since + datetime.timedelta(seconds=horizon_steps * time_step), 'step': step}
+
+        with get_connection(db_conn_params) as conn:
+            try:
+                with conn.cursor() as cursor:
+                    cursor.execute(extent_query, params)
+                    lat_min, lat_max, lon_min, lon_max = cursor.fetchone()
+                if lat_min is None:
+                    raise ValueError(f'No locations on a {step} degree grid.')
+                cube = cls((lat_min, lat_max), (lon_min, lon_max), step,
+                           int(since.replace(tzinfo=datetime.timezone.utc).timestamp()), horizon_steps)
+
+                # A named cursor streams the rows so only one chunk is ever held as Python tuples
+                rows_read = 0
+                with conn.cursor(name='forecast_cube') as cursor:
+                    cursor.itersize = chunk_size
+                    cursor.execute(cube_query, params)
+                    while True:
+                        rows = cursor.fetchmany(chunk_size)
+                        if not rows:
+                            break
+                        columns = list(zip(*rows))
+                        # dtype=float turns NULLs into NaN
+                        values = {name: np.array(column, dtype=float) for name, column in zip(cube_fields, columns[3:])}
+                        cube.add(np.array(columns[0], dtype=float), np.array(columns[1], dtype=float),
+                                 np.array(columns[2], dtype=np.int64), values)
+                        rows_read += len(rows)
+            finally:
+                conn.rollback()
+
+        if not rows_read:
+            raise ValueError(f'No forecasts found from {since}.')
+        return cube.finish()
+
+    #Index of the forecast time closest to each requested time (unix seconds)
+    def time_index(self, when):
+        when = np.asarray(when, dtype=np.int64)
+        if len(self.times) == 1:
+            return np.zeros(when.shape, dtype=np.intp)
+        right = np.clip(np.searchsorted(self.times, when), 1, len(self.times) - 1)
+        left = right - 1
+        return np.where(np.abs(self.times[left] - when) <= np.abs(self.times[right] - when), left, right)
+
+    def interpolate(self, latitudes, longitudes, when=None, fields=None):
+        '''
+        Bilinearly interpolate forecast fields at arrays of latitudes and longitudes.
+
+        when is a unix time or array of times, one per point, snapped to the nearest forecast step;
+        the first step is used when it's None. Returns {field: array} with NaN for points outside the
+        grid or whose surrounding grid points have no data.
+        '''
+        latitudes = np.atleast_1d(np.asarray(latitudes, dtype=float))
+        longitudes = np.atleast_1d(np.asarray(longitudes, dtype=float))
+        t = np.zeros(latitudes.shape, dtype=np.intp) if when is None else \
+            np.broadcast_to(self.time_index(when), latitudes.shape)
+
+        lat_size, lon_size = next(iter(self.fields.values())).shape[1:]
+        y = (latitudes - self.lat0) / self.lat_step
+        x = (longitudes - self.lon0) / self.lon_step
+        outside = (y < 0) | (y > lat_size - 1) | (x < 0) | (x > lon_size - 1)
+
+        # Lower corner of each point's cell, clamped so points on the last row or column still have a cell
+        y0 = np.clip(np.floor(y), 0, max(lat_size - 2, 0)).astype(np.intp)
+        x0 = np.clip(np.floor(x), 0, max(lon_size - 2, 0)).astype(np.intp)
+        y1 = np.minimum(y0 + 1, lat_size - 1)
+        x1 = np.minimum(x0 + 1, lon_size - 1)
+        fy = np.clip(y - y0, 0, 1)
+        fx = np.clip(x - x0, 0, 1)
+        corners = [(y0, x0, (1 - fy) * (1 - fx)), (y0, x1, (1 - fy) * fx),
+                   (y1, x0, fy * (1 - fx)), (y1, x1, fy * fx)]
+
+        requested = fields or cube_fields
+        names = set(requested) - {'WindDirection'}
+        if 'WindDirection' in requested:
+            names |= {'_WindDirectionSin', '_WindDirectionCos'}
+
+        result = {}
+        for name in names:
+            cube = self.fields[name]
+            total = np.zeros(latitudes.shape)
+            weights = np.zeros(latitudes.shape)
+            for yi, xi, weight in corners:
+                value = cube[t, yi, xi]
+                valid = ~np.isnan(value)
+                total += np.where(valid, value, 0) * weight
+                weights += np.where(valid, weight, 0)
+            # Renormalize over the corners that have data, e.g. next to ocean cells with no forecasts
+            with np.errstate(invalid='ignore', divide='ignore'):
+                interpolated = total / weights
+            interpolated[outside | (weights == 0)] = np.nan
+            result[name] = interpolated
+
+        if 'WindDirection' in requested:
+            result['WindDirection'] = np.rad2deg(np.arctan2(result.pop('_WindDirectionSin'),
+                                                            result.pop('_WindDirectionCos'))) % 360
+        result['TimestampISO'] = self.times[t].astype('datetime64[s]')
+        return result
+
+
+cube_lock = threading.Lock()
+cached_cube = None
+
+
+#Shared cube, reloaded from the database once it is older than max_age seconds
+def get_cube(db_conn_params, max_age=600):
+    global cached_cube
+    with cube_lock:
+        if cached_cube is None or time.monotonic() - cached_cube.loaded_at > max_age:
+            cached_cube = ForecastCube.from_database(db_conn_params)
+        return cached_cube
+
+
+#Interpolated forecast fields for many points with a single cached cube, no database query per point
+def query_points(db_conn_params, latitudes, longitudes, when=None, fields=None, max_age=600):
+    return get_cube(db_conn_params, max_age).interpolate(latitudes, longitudes, when, fields)
+
+
+def parse_point(text):
+    latitude, longitude = text.split(',')
+    return float(latitude), float(longitude)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Interpolate the latest forecast at arbitrary coordinates.')
+    parser.add_argument('points', nargs='+', type=parse_point, help='Coordinates as lat,lon.')
+    parser.add_argument('--time', type=datetime.datetime.fromisoformat,
+                        help='UTC forecast time, defaults to the current forecast step.')
+    parser.add_argument('--fields', nargs='+', choices=cube_fields, help='Fields to return, defaults to all.')
+    args = parser.parse_args()
+
+    when = None
+    if args.time is not None:
+        when = int(args.time.replace(tzinfo=datetime.timezone.utc).timestamp())
+
+    try:
+        latitudes, longitudes = zip(*args.points)
+        result = query_points(db_conn_params, latitudes, longitudes, when, args.fields)
+    except (Exception, psycopg2.DatabaseError) as error:
+        print(f'Error: {error}')
+    else:
+        for i, (latitude, longitude) in enumerate(args.points):
+            values = ', '.join(f'{name}={result[name][i]:.2f}' for name in (args.fields or cube_fields))
+            print(f'{latitude},{longitude} @ {result["TimestampISO"][i]}: {values}')
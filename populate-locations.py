@@ -1,41 +1,126 @@
+import argparse
+import io
 import psycopg2
-import psycopg2.extras
+import numpy as np
 import os
 
-def create_location_points(lat_start=24,lat_end=50,long_start=-125,long_end=-67, step=1.0):
+from db import get_connection
+
+#Bounding boxes as (lat_start, lat_end, long_start, long_end)
+regions = {
+    'world': (-90, 90, -180, 180),
+    'us': (24, 50, -125, -67),
+}
+
+#Coordinates are rounded to this many decimals so repeated runs hit the unique (Latitude, Longitude) constraint
+coordinate_decimals = 6
+
+#Spacing in degrees of the existing grid whose unavailable points exclude new ones, the same grid pointquery.py uses
+existing_grid_step = float(os.getenv('POINTQUERY_GRID_STEP', 1.0))
+
+
+#Evenly spaced values from start to end inclusive, counted in whole steps so 0.1 steps don't drift
+def axis_points(start, end, step):
+    count = int(np.floor((end - start) / step + 1e-9)) + 1
+    return np.round(start + np.arange(count) * step, coordinate_decimals)
+
+
+def create_location_points(lat_start=24,lat_end=50,long_start=-125,long_end=-67, step=1.0, mask=None, exclude=None):
     '''
-    Generate a grid of latitude and longitude points. Default is contiguous US with a 1 degree step.
+    Generate a grid of latitude and longitude points as an (n, 2) array. Default is contiguous US with a 1 degree step.
+    step can be fractional. mask is a function of (latitudes, longitudes) arrays returning True for points to keep,
+    exclude is a function of the same arrays returning True for points to drop.
     '''
-    locations = []
-    for lat in range(int(lat_start), int(lat_end)+1, int(step)):
-        for long in range(int(long_start), int(long_end)+1, int(step)):
-            locations.append((lat,long))
-    return locations
+    lats, longs = np.meshgrid(axis_points(lat_start, lat_end, step), axis_points(long_start, long_end, step), indexing='ij')
+    lats = lats.ravel()
+    longs = longs.ravel()
+
+    keep = np.ones(lats.shape, dtype=bool)
+    if mask is not None:
+        keep &= mask(lats, longs)
+    if exclude is not None:
+        keep &= ~exclude(lats, longs)
+    return np.column_stack((lats[keep], longs[keep]))
+
 
-def bulk_insert_locations(db_conn_params,locations):
+#Pack grid indices into one integer so point sets can be compared with np.isin
+def grid_keys(lats, longs, lat0, long0, step):
+    lat_index = np.rint((lats - lat0) / step).astype(np.int64)
+    long_index = np.rint((longs - long0) / step).astype(np.int64)
+    return lat_index * 1_000_000 + long_index
+
+
+def mask_from_points(points, step):
+    '''
+    Mask keeping only grid points present in points (an (n, 2) array of lat, long), e.g. a land mask.
+    Points are matched on the grid with the given step.
+    '''
+    keys = grid_keys(points[:, 0], points[:, 1], -90, -180, step)
+    return lambda lats, longs: np.isin(grid_keys(lats, longs, -90, -180, step), keys)
+
+
+def unavailable_exclusion(db_conn_params, existing_step=None):
+    '''
+    Exclusion for points in cells of the existing grid already marked data_available = FALSE.
+    existing_step is that grid's spacing (default existing_grid_step). Only points on it count, so a finer
+    regional grid doesn't shrink the cells. Each new point is snapped to the nearest existing grid point,
+    so a finer grid skips the areas the coarser one found to have no data. Returns None when nothing on
+    the grid is marked unavailable.
+    '''
+    existing_step = existing_step or existing_grid_step
+    with get_connection(db_conn_params) as conn:
+        cursor = conn.cursor()
+        try:
+            cursor.execute("SELECT Latitude, Longitude FROM Location WHERE data_available = FALSE;")
+            rows = cursor.fetchall()
+        finally:
+            cursor.close()
+            conn.rollback()
+
+    unavailable = np.array(rows, dtype=float).reshape(-1, 2)
+    # Keep the points that lie on the existing grid
+    on_grid = np.all(np.abs(unavailable / existing_step - np.round(unavailable / existing_step)) < 1e-6, axis=1)
+    unavailable = unavailable[on_grid]
+    if not len(unavailable):
+        return None
+
+    keys = grid_keys(unavailable[:, 0], unavailable[:, 1], -90, -180, existing_step)
+    return lambda lats, longs: np.isin(grid_keys(lats, longs, -90, -180, existing_step), keys)
+
+
+def bulk_insert_locations(db_conn_params,locations, chunk_size=500000):
     '''
     Bulk insert locations into database.
+    Points are streamed with COPY into a staging table and merged in one statement, existing points are left as they are.
     '''
-    conn = psycopg2.connect(**db_conn_params)
-    cursor = conn.cursor()
-
-    try:
-        #Use execute_values for bulk insert
-        psycopg2.extras.execute_values(
-            cursor,
-            "INSERT INTO Location (Latitude, Longitude) VALUES %s ON CONFLICT (Latitude, Longitude) DO NOTHING;",
-            locations,
-            template=None,
-            page_size=100
-        )
-        conn.commit()
-        print('Locations successfully inserted.')
-    except (Exception, psycopg2.DatabaseError) as error:
-        print(f'Error: {error}')
-        conn.rollback()
-    finally:
-        cursor.close()
-        conn.close()
+    locations = np.asarray(locations, dtype=float).reshape(-1, 2)
+    with get_connection(db_conn_params) as conn:
+        cursor = conn.cursor()
+
+        try:
+            cursor.execute("""
+                DROP TABLE IF EXISTS pg_temp.location_staging;
+                CREATE TEMP TABLE location_staging (Latitude float, Longitude float) ON COMMIT DROP;
+            """)
+            for i in range(0, len(locations), chunk_size):
+                buffer = io.StringIO()
+                np.savetxt(buffer, locations[i:i + chunk_size], fmt=f'%.{coordinate_decimals}f', delimiter='\t')
+                buffer.seek(0)
+                cursor.copy_expert("COPY location_staging (Latitude, Longitude) FROM STDIN", buffer)
+
+            cursor.execute("""
+                INSERT INTO Location (Latitude, Longitude)
+                SELECT DISTINCT Latitude, Longitude FROM location_staging
+                ON CONFLICT (Latitude, Longitude) DO NOTHING;
+            """)
+            inserted = cursor.rowcount
+            conn.commit()
+            print(f'{inserted} of {len(locations)} locations successfully inserted.')
+        except (Exception, psycopg2.DatabaseError) as error:
+            print(f'Error: {error}')
+            conn.rollback()
+        finally:
+            cursor.close()
 
 
 db_conn_params = {
@@ -46,9 +131,25 @@ db_conn_params = {
 }
 
 if __name__ == "__main__":
-    #Grid for world
-    locations = create_location_points(-90,90,-180,180)
+    parser = argparse.ArgumentParser(description='Insert a grid of locations into the Location table.')
+    parser.add_argument('--region', choices=sorted(regions), default='world', help='Named bounding box for the grid.')
+    parser.add_argument('--bbox', type=float, nargs=4, metavar=('LAT_START', 'LAT_END', 'LONG_START', 'LONG_END'),
+                        help='Custom bounding box, overrides --region.')
+    parser.add_argument('--step', type=float, default=1.0, help='Grid spacing in degrees, e.g. 0.5 or 0.25.')
+    parser.add_argument('--mask-file', help='CSV of lat,long grid points to keep, points not in it are skipped.')
+    parser.add_argument('--include-unavailable', action='store_true',
+                        help='Keep points in cells already marked data_available = FALSE.')
+    parser.add_argument('--existing-step', type=float, default=existing_grid_step,
+                        help='Spacing in degrees of the existing grid whose unavailable cells are skipped '
+                             '(default POINTQUERY_GRID_STEP or 1.0).')
+    args = parser.parse_args()
+
+    #Grid for world by default, --region us for contiguous US
+    bounds = args.bbox or regions[args.region]
+    mask = None
+    if args.mask_file:
+        mask = mask_from_points(np.loadtxt(args.mask_file, delimiter=',', ndmin=2), args.step)
+    exclude = None if args.include_unavailable else unavailable_exclusion(db_conn_params, args.existing_step)
 
-    #Grid for contiguous US
-    #locations = create_location_points() 
-    bulk_insert_locations(db_conn_params,locations)
\ No newline at end of file
+    locations = create_location_points(*bounds, step=args.step, mask=mask, exclude=exclude)
+    bulk_insert_locations(db_conn_params,locations)
@@ -3,6 +3,8 @@ import psycopg2
 import psycopg2.extras
 import os
 
+from db import get_connection
+
 # Read the HTML file
 with open("projects/weather/weather-conditions.html", "r") as file:
     html_content = file.read()
@@ -42,20 +44,19 @@ db_conn_params = {
 }
 
 # Connect to database
-conn = psycopg2.connect(**db_conn_params)
-cursor = conn.cursor()
-#Insert into database
-try:
-    cursor.executemany(
-        "INSERT INTO WeatherConditionTypes (WeatherConditionID, Main, Description) VALUES (%s, %s, %s);",
-        weather_conditions
-    )
-    conn.commit()
-    print('Weather conditions successfully inserted.')
-except (Exception, psycopg2.DatabaseError) as error:
-    print(f'Error: {error}')
-    conn.rollback()
-finally:
-    cursor.close()
-    conn.close()
+with get_connection(db_conn_params) as conn:
+    cursor = conn.cursor()
+    #Insert into database
+    try:
+        cursor.executemany(
+            "INSERT INTO WeatherConditionTypes (WeatherConditionID, Main, Description) VALUES (%s, %s, %s);",
+            weather_conditions
+        )
+        conn.commit()
+        print('Weather conditions successfully inserted.')
+    except (Exception, psycopg2.DatabaseError) as error:
+        print(f'Error: {error}')
+        conn.rollback()
+    finally:
+        cursor.close()
 
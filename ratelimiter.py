@@ -0,0 +1,130 @@
+import asyncio
+import time
+
+
+class RateScheduler:
+    '''
+    Token bucket that spreads requests evenly across the API quota.
+
+    Tokens refill continuously at requests_per_minute / 60 per second up to burst, so
+    requests go out at a steady pace instead of all at once at the top of each minute.
+    max_in_flight caps how many requests may be waiting on the network at the same time.
+
+    Use "async with scheduler:" around each HTTP request, and map_unordered() to run
+    a coroutine over many items without creating a task for every item up front.
+
+    When the API answers 429, call backoff(): every request pauses, the rate is halved, and it
+    then climbs back linearly to requests_per_minute over recovery_seconds. Repeated 429s without
+    a success in between double the pause, up to max_pause seconds.
+    '''
+    def __init__(self, requests_per_minute=3000, max_in_flight=500, burst=None,
+                 min_requests_per_minute=60, recovery_seconds=60, base_pause=5, max_pause=900):
+        self.requests_per_minute = requests_per_minute
+        self.max_in_flight = max_in_flight
+        self.max_rate = requests_per_minute / 60.0
+        self.min_rate = min(min_requests_per_minute / 60.0, self.max_rate)
+        self.rate = self.max_rate
+        # Default to one second's worth of tokens so a short stall can be made up without
+        # going meaningfully over the per-minute quota
+        self.capacity = float(burst) if burst is not None else max(1.0, self.max_rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+        self.in_flight = asyncio.Semaphore(max_in_flight)
+
+        self.recovery_seconds = recovery_seconds
+        self.base_pause = base_pause
+        self.max_pause = max_pause
+        self.paused_until = 0.0
+        self.reduced_rate = self.max_rate
+        self.reduced_at = None
+        self.consecutive_limits = 0
+
+    #Rate after recovering linearly from the last backoff
+    def current_rate(self, now):
+        if self.reduced_at is None:
+            return self.max_rate
+        recovered = (now - max(self.reduced_at, self.paused_until)) / self.recovery_seconds
+        if recovered >= 1:
+            self.reduced_at = None
+            return self.max_rate
+        return self.reduced_rate + (self.max_rate - self.reduced_rate) * max(recovered, 0.0)
+
+    def _refill(self):
+        now = time.monotonic()
+        self.rate = self.current_rate(now)
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    #Wait until a request token is available and take it
+    async def wait(self):
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    await asyncio.sleep(self.paused_until - now)
+                    continue
+                self._refill()
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def backoff(self, retry_after=None):
+        '''
+        Slow down after a 429. retry_after is the server's Retry-After in seconds, if it sent one.
+        Returns how long requests are paused for.
+        '''
+        now = time.monotonic()
+        # Requests already in flight will report the same limit, only the first one slows the rate
+        if now >= self.paused_until:
+            self.consecutive_limits += 1
+            self.reduced_rate = max(self.min_rate, self.current_rate(now) / 2)
+            self.reduced_at = now
+            self.tokens = 0.0
+            self.updated = now
+
+            pause = retry_after if retry_after is not None else self.base_pause * 2 ** (self.consecutive_limits - 1)
+            self.paused_until = now + min(pause, self.max_pause)
+        return self.paused_until - now
+
+    #A successful response ends a run of 429s
+    def record_success(self):
+        self.consecutive_limits = 0
+
+    async def __aenter__(self):
+        await self.in_flight.acquire()
+        try:
+            await self.wait()
+        except BaseException:
+            self.in_flight.release()
+            raise
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.in_flight.release()
+
+    async def map_unordered(self, func, items, max_tasks=None):
+        '''
+        Run func(item) for every item and yield results as they complete.
+        At most max_tasks (default max_in_flight) tasks exist at once.
+        '''
+        max_tasks = max_tasks or self.max_in_flight
+        pending = set()
+
+        try:
+            for item in items:
+                if len(pending) >= max_tasks:
+                    done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                    for task in done:
+                        yield task.result()
+                pending.add(asyncio.ensure_future(func(item)))
+
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    yield task.result()
+        finally:
+            # Don't leave work running if the caller stops early
+            for task in pending:
+                task.cancel()
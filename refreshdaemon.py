@@ -0,0 +1,289 @@
+import argparse
+import asyncio
+import collections
+import datetime
+import heapq
+import os
+import signal
+import time
+
+import psycopg2
+
+from archive import ResponseArchive
+from db import configure_pool, get_connection, run_db
+from fetchforecast import ForecastWriter, get_forecast_data, record_refresh
+from forecasthistory import record_issues_hook
+from httpclient import create_session
+from metrics import MetricsReporter
+from partitions import ensure_partitions_for_range
+from ratelimiter import RateScheduler
+from rollup import refresh_rollup_hook
+from stats import flag_anomalies_hook
+
+# OpenWeatherMap API key
+api_key = os.environ.get('OPENWEATHER_API_KEY')
+
+db_conn_params = {
+    "dbname": os.getenv('DB_NAME'),
+    "user": os.getenv('DB_USER'),
+    "password": os.getenv('DB_PASSWORD'),
+    "host": os.getenv('DB_HOST')
+}
+
+
+#Every location with the unix time of its last successful refresh, 0 when it has never been refreshed
+def get_locations_refreshed(db_conn_params):
+    with get_connection(db_conn_params) as conn:
+        cursor = conn.cursor()
+        try:
+            cursor.execute("""
+                SELECT l.LocationID, l.Latitude, l.Longitude,
+                       COALESCE(EXTRACT(EPOCH FROM COALESCE(r.RefreshedAt, newest.IssuedAt) AT TIME ZONE 'UTC'), 0)::float
+                FROM Location l
+                LEFT JOIN LocationRefresh r ON r.LocationID = l.LocationID
+                -- Locations fetched before LocationRefresh was kept: the newest forecast row reaches 5 days past its
+                -- issue, so that gives roughly when it was fetched. One probe of (LocationID, TimestampISO) each.
+                LEFT JOIN LATERAL (
+                    SELECT LEAST(f.TimestampISO - INTERVAL '5 days', now() AT TIME ZONE 'UTC') AS IssuedAt
+                    FROM Forecast f
+                    WHERE f.LocationID = l.LocationID AND r.LocationID IS NULL
+                    ORDER BY f.TimestampISO DESC
+                    LIMIT 1
+                ) newest ON TRUE;
+            """)
+            return [((location_id, latitude, longitude), refreshed_at)
+                    for location_id, latitude, longitude, refreshed_at in cursor.fetchall()]
+        finally:
+            cursor.close()
+            conn.rollback()
+
+
+class RefreshQueue:
+    '''
+    Locations ordered by when they were last refreshed, stalest first.
+
+    A location isn't handed out again until min_age seconds after its last refresh, since the
+    provider only issues a new forecast every few hours and fetching sooner spends quota for nothing.
+    '''
+    def __init__(self, min_age):
+        self.min_age = min_age
+        self.heap = []
+        self.known = set()
+        self.condition = asyncio.Condition()
+
+    def __len__(self):
+        return len(self.heap)
+
+    #Add locations not seen before, e.g. after new points are inserted into Location
+    async def add_new(self, locations):
+        async with self.condition:
+            for location, refreshed_at in locations:
+                if location[0] not in self.known:
+                    self.known.add(location[0])
+                    heapq.heappush(self.heap, (refreshed_at, location[0], location))
+            self.condition.notify_all()
+
+    async def push(self, location, refreshed_at):
+        async with self.condition:
+            heapq.heappush(self.heap, (refreshed_at, location[0], location))
+            self.condition.notify()
+
+    #Wait for the stalest location to come due and take it
+    async def next_due(self):
+        async with self.condition:
+            while True:
+                timeout = None
+                if self.heap:
+                    timeout = self.heap[0][0] + self.min_age - time.time()
+                    if timeout <= 0:
+                        return heapq.heappop(self.heap)[2]
+                try:
+                    await asyncio.wait_for(self.condition.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+
+    #Mean seconds since the last refresh over queued locations, and how many are due now
+    def staleness(self):
+        now = time.time()
+        ages = [now - refreshed_at for refreshed_at, location_id, location in self.heap if refreshed_at > 0]
+        due = sum(1 for refreshed_at, location_id, location in self.heap if refreshed_at + self.min_age <= now)
+        return (sum(ages) / len(ages) if ages else None), due
+
+
+async def run_daemon(api_key, db_conn_params, scheduler, min_age=3 * 3600, failure_delay=900, reload_interval=3600,
+                     flush_interval=60, write_batch_size=10000, loader='copy', archive=None, decode_workers=0,
+                     stop=None, hooks=(refresh_rollup_hook,)):
+    '''
+    Refresh forecasts continuously, always fetching the location whose last refresh is oldest.
+
+    Fetches are paced by scheduler, so the quota is used evenly around the clock instead of in
+    one burst per cron run. A location that fails is retried failure_delay seconds later. New
+    locations are picked up every reload_interval seconds and partial batches are written at
+    least every flush_interval seconds. Runs until stop (an asyncio.Event) is set.
+    '''
+    stop = stop or asyncio.Event()
+    queue = RefreshQueue(min_age)
+    await queue.add_new(await run_db(get_locations_refreshed, db_conn_params))
+
+    # Locations handed to the writer whose batch hasn't committed yet, in the order they were added
+    handed_over = collections.deque()
+
+    #Re-queue locations once the batch holding them has finished, so a location only counts as refreshed after its commit
+    async def settle(batch, written):
+        if not batch.checkpoints:
+            return
+        # Batches commit in the order responses were added, so everything up to the last checkpoint is settled,
+        # including responses that were skipped as malformed and never made it into a batch
+        last_id = batch.checkpoints[-1][0]
+        refreshed = set(batch['LocationID']) if written is not None else set()
+        now = time.time()
+        while handed_over:
+            location = handed_over.popleft()
+            if location[0] in refreshed:
+                await queue.push(location, now)
+            else:
+                await queue.push(location, now - min_age + failure_delay)
+            if location[0] == last_id:
+                break
+
+    writer = ForecastWriter(db_conn_params, batch_size=write_batch_size, loader=loader,
+                            hooks=tuple(hooks) + (record_refresh,), workers=decode_workers, committed=settle)
+    writer.start()
+    # Responses are handed to the writer by one coroutine, ForecastWriter.add isn't meant for concurrent callers
+    responses = asyncio.Queue(maxsize=scheduler.max_in_flight)
+
+    async with create_session(max_connections=scheduler.max_in_flight) as session:
+        async def fetch_loop():
+            while True:
+                location = await queue.next_due()
+                data = await get_forecast_data(session, location, api_key, scheduler, archive,
+                                               decode=not decode_workers)
+                if data is None:
+                    # Come back to it later rather than hammering a location that keeps failing
+                    await queue.push(location, time.time() - min_age + failure_delay)
+                else:
+                    # settle() puts it back in the queue once its batch has committed
+                    await responses.put((location, data))
+
+        async def write_loop():
+            drained = time.monotonic()
+            while True:
+                try:
+                    response = await asyncio.wait_for(responses.get(), flush_interval)
+                except asyncio.TimeoutError:
+                    response = ()
+                # None means the fetchers have stopped and everything before it has been added
+                if response is None:
+                    return
+                if response:
+                    location, data = response
+                    handed_over.append(location)
+                    await writer.add(location, data, checkpoint=location)
+                # A slow trickle of responses would otherwise sit in a partial batch for a long time
+                if time.monotonic() - drained >= flush_interval:
+                    await writer.drain()
+                    drained = time.monotonic()
+
+        async def maintenance_loop():
+            while True:
+                await asyncio.sleep(reload_interval)
+                now = datetime.datetime.utcnow()
+                await run_db(ensure_partitions_for_range, db_conn_params, now, now + datetime.timedelta(days=6))
+                await queue.add_new(await run_db(get_locations_refreshed, db_conn_params))
+                mean_age, due = queue.staleness()
+                mean_age = f'{mean_age / 3600:.1f}h' if mean_age is not None else 'n/a'
+                print(f'{len(queue.known)} locations, {due} due, mean time since refresh {mean_age}, '
+                      f'{writer.rows_written} rows written.')
+
+        tasks = [asyncio.ensure_future(fetch_loop()) for _ in range(scheduler.max_in_flight)]
+        tasks.append(asyncio.ensure_future(maintenance_loop()))
+        write_task = asyncio.ensure_future(write_loop())
+        stop_task = asyncio.ensure_future(stop.wait())
+        try:
+            # A task only finishes on its own if it failed, surface that instead of running on without it
+            done, pending = await asyncio.wait(tasks + [write_task, stop_task], return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task is not stop_task:
+                    task.result()
+        finally:
+            stop_task.cancel()
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            # The write loop isn't cancelled, that could cut it off inside writer.add with a batch half handed over.
+            # It finishes the responses already fetched and returns at the None behind them.
+            if not write_task.done():
+                await responses.put(None)
+                await write_task
+            await writer.close()
+
+    return writer.rows_written
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Keep forecasts fresh by continuously refreshing the stalest locations.')
+    parser.add_argument('--requests-per-minute', type=int, default=3000,
+                        help='API request budget per minute.')
+    parser.add_argument('--max-in-flight', type=int, default=500,
+                        help='Maximum number of requests waiting on the network at once.')
+    parser.add_argument('--min-age', type=float, default=3,
+                        help='Hours before a location is refreshed again.')
+    parser.add_argument('--failure-delay', type=float, default=15,
+                        help='Minutes before a failed location is tried again.')
+    parser.add_argument('--reload-interval', type=float, default=60,
+                        help='Minutes between checks for new locations and status lines.')
+    parser.add_argument('--write-batch-size', type=int, default=10000,
+                        help='Rows per database write.')
+    parser.add_argument('--loader', choices=['copy', 'values'], default='copy',
+                        help='copy streams rows into a staging table and merges them, values uses execute_values.')
+    parser.add_argument('--db-pool-size', type=int, default=None,
+                        help='Maximum pooled database connections (default DB_POOL_MAX or 8).')
+    parser.add_argument('--decode-workers', type=int, default=0,
+                        help='Decode and extract responses on this many worker processes (0 keeps it in the event loop).')
+    parser.add_argument('--archive', metavar='DIR',
+                        help='Append every raw response to a compressed archive under DIR.')
+    parser.add_argument('--flag-anomalies', action='store_true',
+                        help='Flag forecast values far from the running statistics in ForecastAnomaly.')
+    parser.add_argument('--record-issues', action='store_true',
+                        help='Also append each forecast issue to ForecastIssue for lead time error analysis.')
+    parser.add_argument('--metrics', metavar='FILE',
+                        help='Write run metrics to FILE, Prometheus text if it ends in .prom, JSON otherwise.')
+    parser.add_argument('--metrics-interval', type=float, default=30,
+                        help='Seconds between metrics writes.')
+    args = parser.parse_args()
+    configure_pool(maxconn=args.db_pool_size)
+
+    now = datetime.datetime.utcnow()
+    ensure_partitions_for_range(db_conn_params, now, now + datetime.timedelta(days=6))
+
+    loop = asyncio.get_event_loop()
+    stop = asyncio.Event()
+    # Finish the batches in progress on Ctrl-C or a service stop
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, stop.set)
+
+    scheduler = RateScheduler(args.requests_per_minute, args.max_in_flight)
+    archive = ResponseArchive(args.archive, 'forecast') if args.archive else None
+    reporter = MetricsReporter(args.metrics, args.metrics_interval) if args.metrics else None
+    if reporter is not None:
+        reporter.start()
+
+    hooks = (refresh_rollup_hook, flag_anomalies_hook) if args.flag_anomalies else (refresh_rollup_hook,)
+    if args.record_issues:
+        hooks += (record_issues_hook,)
+
+    try:
+        rows_written = loop.run_until_complete(
+            run_daemon(api_key, db_conn_params, scheduler, min_age=args.min_age * 3600,
+                       failure_delay=args.failure_delay * 60, reload_interval=args.reload_interval * 60,
+                       write_batch_size=args.write_batch_size, loader=args.loader, archive=archive,
+                       decode_workers=args.decode_workers, stop=stop,
+                       hooks=hooks))
+        print(f'{rows_written} forecast rows upserted.')
+    except (Exception, psycopg2.DatabaseError) as error:
+        print(f'Error: {error}')
+    finally:
+        if archive is not None:
+            archive.close()
+        if reporter is not None:
+            loop.run_until_complete(reporter.stop())
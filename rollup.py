@@ -0,0 +1,95 @@
+import argparse
+import datetime
+import os
+
+import psycopg2
+
+from db import get_connection
+
+db_conn_params = {
+    "dbname": os.getenv('DB_NAME'),
+    "user": os.getenv('DB_USER'),
+    "password": os.getenv('DB_PASSWORD'),
+    "host": os.getenv('DB_HOST')
+}
+
+#ForecastRollup holds one row per (LocationID, Day): how many forecast steps the day has, the daily mean of
+#each mapped variable and the temperature range. The dashboard's daily view reads one day across every
+#location from the Day index instead of aggregating Forecast; single hours are read from Forecast itself.
+rollup_value_names = ['Temperature', 'Humidity', 'WindSpeed', 'Pressure', 'Cloudiness', 'Visibility',
+                      'PrecipitationChance']
+
+rollup_select = """
+    SELECT f.LocationID,
+           f.TimestampISO::date AS Day,
+           count(*) AS SampleCount,
+           {means},
+           min(f.Temperature), max(f.Temperature)
+""".format(means=', '.join(f'avg(f.{name})' for name in rollup_value_names))
+
+rollup_group = """
+    GROUP BY f.LocationID, f.TimestampISO::date
+"""
+
+#UpdatedAt records when a forecast of the day last changed in any column, export.py finds changed days with it
+rollup_upsert = """
+    ON CONFLICT (LocationID, Day) DO UPDATE SET
+        SampleCount = EXCLUDED.SampleCount,
+        {assignments},
+        TemperatureMin = EXCLUDED.TemperatureMin,
+        TemperatureMax = EXCLUDED.TemperatureMax,
+        UpdatedAt = now();
+""".format(assignments=',\n        '.join(f'{name} = EXCLUDED.{name}' for name in rollup_value_names))
+
+rollup_columns = f"""
+    INSERT INTO ForecastRollup (LocationID, Day, SampleCount, {', '.join(rollup_value_names)}, TemperatureMin, TemperatureMax)
+"""
+
+
+#Recompute the rollup for the (location, day) of each (location_id, timestamp) key
+def refresh_rollup(cursor, keys):
+    days = {(location_id, timestamp.date()) for location_id, timestamp in keys}
+    if not days:
+        return
+    location_ids, days = zip(*days)
+
+    # Each day is one range scan of the (LocationID, TimestampISO) unique index
+    cursor.execute(rollup_columns + rollup_select + """
+        FROM unnest(%s::int[], %s::date[]) AS k(LocationID, Day)
+        JOIN Forecast f
+          ON f.LocationID = k.LocationID
+         AND f.TimestampISO >= k.Day
+         AND f.TimestampISO < k.Day + 1
+    """ + rollup_group + rollup_upsert, (list(location_ids), list(days)))
+
+
+#Hook for bulk_upsert_forecasts: recompute the days of the rows just inserted or changed,
+#a batch of 3 hour steps touches each day once instead of writing a rollup row per forecast
+def refresh_rollup_hook(cursor, batch, written):
+    refresh_rollup(cursor, ((location_id, timestamp) for forecast_id, location_id, timestamp in written))
+
+
+#Rebuild the rollup from Forecast, optionally only from since onwards
+def rebuild_rollup(db_conn_params, since=None):
+    with get_connection(db_conn_params) as conn:
+        cursor = conn.cursor()
+        try:
+            cursor.execute(rollup_columns + rollup_select + """
+                FROM Forecast f
+                WHERE %(since)s::timestamp IS NULL OR f.TimestampISO >= %(since)s::timestamp::date
+            """ + rollup_group + rollup_upsert, {'since': since})
+            conn.commit()
+            print('Rollup successfully rebuilt.')
+        except (Exception, psycopg2.DatabaseError) as error:
+            print(f'Error: {error}')
+            conn.rollback()
+        finally:
+            cursor.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Rebuild the ForecastRollup table from Forecast.')
+    parser.add_argument('--since', type=datetime.datetime.fromisoformat,
+                        help='Only rebuild days from this UTC time onwards.')
+    args = parser.parse_args()
+    rebuild_rollup(db_conn_params, args.since)
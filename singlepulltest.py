@@ -1,7 +1,9 @@
-import requests
+import asyncio
 import json
 import os
 
+from httpclient import create_session
+
 # OpenWeatherMap API key
 api_key = os.environ.get('OPENWEATHER_API_KEY')
 # Example for a specific city
@@ -10,20 +12,26 @@ city_name = 'New York'
 # lat, lon = 40.7128, -74.0060
 
 # API endpoint URL
-url = f"http://api.openweathermap.org/data/2.5/forecast?q={city_name}&appid={api_key}"
+url = f"https://api.openweathermap.org/data/2.5/forecast?q={city_name}&appid={api_key}"
 
-# Make the request
-response = requests.get(url)
 
-# Check if the request was successful
-if response.status_code == 200:
-    # Convert the response to JSON
-    data = response.json()
+# Make the request with the same client the fetchers use
+async def fetch(url):
+    async with create_session(max_connections=1) as session:
+        async with session.get(url) as response:
+            if response.status == 200:
+                return response.status, await response.json()
+            return response.status, None
+
 
+status, data = asyncio.run(fetch(url))
+
+# Check if the request was successful
+if status == 200:
     # Save the data to a JSON file
     with open('weather_data.json', 'w') as file:
         json.dump(data, file)
 
     print("Data saved to weather_data.json")
 else:
-    print("Failed to retrieve data: ", response.status_code)
+    print("Failed to retrieve data: ", status)
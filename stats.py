@@ -0,0 +1,192 @@
+import argparse
+import datetime
+import os
+
+import psycopg2
+
+from db import get_connection
+
+db_conn_params = {
+    "dbname": os.getenv('DB_NAME'),
+    "user": os.getenv('DB_USER'),
+    "password": os.getenv('DB_PASSWORD'),
+    "host": os.getenv('DB_HOST')
+}
+
+#Forecast columns tracked in ForecastStats
+stat_variables = ['Temperature', 'Pressure', 'Humidity', 'WindSpeed', 'Cloudiness', 'Visibility']
+
+#Values further than this many standard deviations from the location's mean for that month and hour are flagged
+anomaly_threshold = float(os.getenv('ANOMALY_THRESHOLD', 3))
+
+#Don't flag anything until the running statistics have seen this many values
+anomaly_min_samples = int(os.getenv('ANOMALY_MIN_SAMPLES', 30))
+
+#One row per (LocationID, TimestampISO, Variable) with its month and hour of day
+observation_values = ', '.join(f"('{name}', f.{name}::float)" for name in stat_variables)
+observations_select = f"""
+    SELECT f.LocationID, f.TimestampISO,
+           EXTRACT(MONTH FROM f.TimestampISO)::smallint AS Month,
+           EXTRACT(HOUR FROM f.TimestampISO)::smallint AS Hour,
+           v.Variable, v.Value
+    FROM {{source}}
+    CROSS JOIN LATERAL (VALUES {observation_values}) AS v(Variable, Value)
+    WHERE v.Value IS NOT NULL
+"""
+
+#Rows of the batch, looked up on the (LocationID, TimestampISO) unique index
+keyed_source = """unnest(%(location_ids)s::int[], %(timestamps)s::timestamp[]) AS k(LocationID, TimestampISO)
+    JOIN Forecast f ON f.LocationID = k.LocationID AND f.TimestampISO = k.TimestampISO"""
+
+#Merge per-group count, mean and sum of squared deviations (M2) into the running values.
+#This is the parallel form of Welford's algorithm, so a batch is combined in one step without revisiting old rows.
+stats_merge = """
+    INSERT INTO ForecastStats (LocationID, Variable, Month, Hour, SampleCount, Mean, M2, MinValue, MaxValue)
+    SELECT LocationID, Variable, Month, Hour,
+           COUNT(*), AVG(Value), COALESCE(VAR_POP(Value) * COUNT(*), 0), MIN(Value), MAX(Value)
+    FROM observations
+    GROUP BY LocationID, Variable, Month, Hour
+    ON CONFLICT (LocationID, Variable, Month, Hour) DO UPDATE SET
+        SampleCount = ForecastStats.SampleCount + EXCLUDED.SampleCount,
+        Mean = ForecastStats.Mean + (EXCLUDED.Mean - ForecastStats.Mean)
+               * EXCLUDED.SampleCount / (ForecastStats.SampleCount + EXCLUDED.SampleCount),
+        M2 = ForecastStats.M2 + EXCLUDED.M2 + (EXCLUDED.Mean - ForecastStats.Mean) ^ 2
+             * ForecastStats.SampleCount * EXCLUDED.SampleCount / (ForecastStats.SampleCount + EXCLUDED.SampleCount),
+        MinValue = LEAST(ForecastStats.MinValue, EXCLUDED.MinValue),
+        MaxValue = GREATEST(ForecastStats.MaxValue, EXCLUDED.MaxValue),
+        UpdatedAt = now();
+"""
+
+
+def batch_keys(written):
+    return {
+        'location_ids': [location_id for forecast_id, location_id, timestamp in written],
+        'timestamps': [timestamp for forecast_id, location_id, timestamp in written],
+    }
+
+
+#Fold the written rows' values into ForecastStats
+def update_stats(cursor, written):
+    if not written:
+        return
+    cursor.execute("WITH observations AS (" + observations_select.format(source=keyed_source) + ")" + stats_merge,
+                   batch_keys(written))
+
+
+def flag_anomalies(cursor, written, threshold=None, min_samples=None):
+    '''
+    Compare the written rows against ForecastStats and record values more than threshold sample
+    standard deviations from the mean in ForecastAnomaly. Earlier flags on these rows are replaced,
+    so a value corrected by a later refresh loses its flag.
+    '''
+    if not written:
+        return
+    params = batch_keys(written)
+    params['threshold'] = anomaly_threshold if threshold is None else threshold
+    params['min_samples'] = anomaly_min_samples if min_samples is None else min_samples
+
+    cursor.execute("""
+        DELETE FROM ForecastAnomaly a
+        USING unnest(%(location_ids)s::int[], %(timestamps)s::timestamp[]) AS k(LocationID, TimestampISO)
+        WHERE a.LocationID = k.LocationID AND a.TimestampISO = k.TimestampISO;
+    """, params)
+    cursor.execute("WITH observations AS (" + observations_select.format(source=keyed_source) + """
+        ), scored AS (
+            SELECT o.LocationID, o.TimestampISO, o.Variable, o.Value, s.Mean,
+                   sqrt(s.M2 / (s.SampleCount - 1)) AS StdDev
+            FROM observations o
+            JOIN ForecastStats s USING (LocationID, Variable, Month, Hour)
+            WHERE s.SampleCount >= %(min_samples)s AND s.M2 > 0
+        )
+        INSERT INTO ForecastAnomaly (LocationID, TimestampISO, Variable, Value, Mean, StdDev, ZScore)
+        SELECT LocationID, TimestampISO, Variable, Value, Mean, StdDev, (Value - Mean) / StdDev
+        FROM scored
+        WHERE abs(Value - Mean) > %(threshold)s * StdDev;
+    """, params)
+
+
+#Hook for forecast writes: flag unusual forecast values without counting them as observations
+def flag_anomalies_hook(cursor, batch, written):
+    flag_anomalies(cursor, written)
+
+
+#Hook for historical writes: flag against the statistics so far, then add the observed values to them.
+#Only inserted or changed rows are written, so replaying a window doesn't count it twice.
+def observe_stats_hook(cursor, batch, written):
+    flag_anomalies(cursor, written)
+    update_stats(cursor, written)
+
+
+#Recompute ForecastStats from every observed (past) Forecast row
+def rebuild_stats(db_conn_params):
+    with get_connection(db_conn_params) as conn:
+        cursor = conn.cursor()
+        try:
+            cursor.execute("TRUNCATE ForecastStats;")
+            cursor.execute("WITH observations AS (" + observations_select.format(source="Forecast f") +
+                           " AND f.TimestampISO <= now() AT TIME ZONE 'UTC')" + stats_merge)
+            conn.commit()
+            print('Statistics successfully rebuilt.')
+        except (Exception, psycopg2.DatabaseError) as error:
+            print(f'Error: {error}')
+            conn.rollback()
+        finally:
+            cursor.close()
+
+
+#Flagged values from since onwards, newest first, optionally for one variable
+def get_anomalies(db_conn_params, since, variable=None, limit=1000):
+    with get_connection(db_conn_params) as conn:
+        cursor = conn.cursor()
+        try:
+            cursor.execute("""
+                SELECT a.LocationID, l.Latitude, l.Longitude, a.TimestampISO, a.Variable, a.Value, a.Mean, a.ZScore
+                FROM ForecastAnomaly a
+                JOIN Location l ON l.LocationID = a.LocationID
+                WHERE a.TimestampISO >= %s AND (%s::varchar IS NULL OR a.Variable = %s)
+                ORDER BY a.TimestampISO DESC, abs(a.ZScore) DESC
+                LIMIT %s;
+            """, (since, variable, variable, limit))
+            return cursor.fetchall()
+        finally:
+            cursor.close()
+            conn.rollback()
+
+
+#Mean, standard deviation, min and max of variable at every location for one month and hour, one index range each
+def get_climatology(db_conn_params, variable, month, hour):
+    with get_connection(db_conn_params) as conn:
+        cursor = conn.cursor()
+        try:
+            cursor.execute("""
+                SELECT LocationID, SampleCount, Mean,
+                       CASE WHEN SampleCount > 1 THEN sqrt(M2 / (SampleCount - 1)) END AS StdDev,
+                       MinValue, MaxValue
+                FROM ForecastStats
+                WHERE Variable = %s AND Month = %s AND Hour = %s;
+            """, (variable, month, hour))
+            return cursor.fetchall()
+        finally:
+            cursor.close()
+            conn.rollback()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Maintain running forecast statistics and list anomalies.')
+    parser.add_argument('--rebuild', action='store_true', help='Recompute the statistics from Forecast.')
+    parser.add_argument('--since', type=datetime.datetime.fromisoformat,
+                        help='List anomalies from this UTC time onwards (default the last day).')
+    parser.add_argument('--variable', choices=stat_variables, help='Only list anomalies for this variable.')
+    args = parser.parse_args()
+
+    if args.rebuild:
+        rebuild_stats(db_conn_params)
+    else:
+        since = args.since or datetime.datetime.utcnow() - datetime.timedelta(days=1)
+        try:
+            for location_id, latitude, longitude, timestamp, variable, value, mean, zscore in \
+                    get_anomalies(db_conn_params, since, args.variable):
+                print(f'{timestamp} {latitude},{longitude} (Location {location_id}) {variable} {value:.1f} '
+                      f'vs mean {mean:.1f}, z = {zscore:+.1f}')
+        except (Exception, psycopg2.DatabaseError) as error:
+            print(f'Error: {error}')